@@ -1,13 +1,23 @@
 import sqlite3
 import random
 import json
+import numpy as np
 from datetime import datetime, timedelta
-from telegram import Update
-from telegram.ext import Application, CommandHandler, ContextTypes
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram.error import BadRequest, RetryAfter
 import logging
 import os
 from dotenv import load_dotenv
 import asyncio
+import threading
+import queue
+import time
+import bisect
+import heapq
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 # Load environment variables
 load_dotenv()
@@ -23,104 +33,1192 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+CITIZEN_ROLES = ['worker', 'miner', 'fighter', 'teacher', 'professor', 'healer', 'engineer', 'trader', 'scout', 'workless']
+STARTING_CITIZENS = 10000
+
+# Database connections
+# Connections are long-lived and shared through a small pool instead of being
+# opened per command, so the page cache and the per-connection prepared
+# statement cache stay warm. Every setting can be overridden from .env.
+DB_PATH = os.getenv('BATTLE_FORGE_DB', 'battle_forge.db')
+DB_POOL_SIZE = int(os.getenv('BATTLE_FORGE_DB_POOL_SIZE', '4'))
+DB_BUSY_TIMEOUT = float(os.getenv('BATTLE_FORGE_DB_BUSY_TIMEOUT', '5'))
+DB_STATEMENT_CACHE = int(os.getenv('BATTLE_FORGE_DB_STATEMENT_CACHE', '256'))
+DB_PRAGMAS = {
+    'journal_mode': os.getenv('BATTLE_FORGE_DB_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.getenv('BATTLE_FORGE_DB_SYNCHRONOUS', 'NORMAL'),
+    'cache_size': os.getenv('BATTLE_FORGE_DB_CACHE_SIZE', '-65536'),  # negative means KiB
+    'mmap_size': os.getenv('BATTLE_FORGE_DB_MMAP_SIZE', '268435456'),
+    'temp_store': os.getenv('BATTLE_FORGE_DB_TEMP_STORE', 'MEMORY'),
+}
+
+def open_connection():
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT, check_same_thread=False, cached_statements=DB_STATEMENT_CACHE)
+    for pragma, value in DB_PRAGMAS.items():
+        conn.execute(f'PRAGMA {pragma} = {value}')
+    return conn
+
+class ConnectionPool:
+    def __init__(self, size):
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return open_connection()
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error as e:
+            logger.error(f"Error resetting pooled connection: {str(e)}")
+            conn.close()
+            return
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+db_pool = ConnectionPool(DB_POOL_SIZE)
+
+# Player state cache
+# Hot player rows live in a process-local LRU cache. Repository operations
+# change the cached row and mark the touched columns dirty, and the db writer
+# flushes dirty columns to SQLite periodically or when too many pile up, so a
+# burst of coin and resource changes collapses into one UPDATE per player.
+# Only units of work (i.e. the writer) load rows into the cache; readers use
+# it on a hit and otherwise read SQLite directly. Every change is recorded
+# against the open unit of work and undone if that unit rolls back.
+# Write-behind only covers units that change nothing but player columns (e.g.
+# collecting resources): a unit that also writes another table (a wager, an
+# order, a trade, a citizen) writes its players' dirty columns in its own
+# transaction, so a crash never keeps a stake, escrow or payout's other half
+# without it. Scans over the players table may lag the cache by up to one
+# flush interval, and a crash loses at most that much standalone player state.
+PLAYER_COLUMNS = ['player_id', 'username', 'sperms', 'eggs', 'water', 'food', 'medicine', 'ore',
+                  'water_quality', 'food_quality', 'medicine_quality', 'ore_quality', 'coins', 'war_wins',
+                  'last_resource_collect', 'last_supplies_collect', 'last_event']
+PLAYER_CACHE_SIZE = int(os.getenv('BATTLE_FORGE_PLAYER_CACHE_SIZE', '10000'))
+PLAYER_CACHE_FLUSH_SECONDS = float(os.getenv('BATTLE_FORGE_PLAYER_CACHE_FLUSH_SECONDS', '1'))
+PLAYER_CACHE_MAX_DIRTY = int(os.getenv('BATTLE_FORGE_PLAYER_CACHE_MAX_DIRTY', '1000'))
+
+class PlayerCache:
+    def __init__(self, capacity, flush_interval, max_dirty):
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.max_dirty = max_dirty
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.rows_written_through = 0
+        self.evictions = 0
+        self._rows = OrderedDict()
+        self._dirty = {}
+        # Committed values of the rows an open unit of work has changed, for
+        # readers outside it until it commits or rolls back
+        self._committed = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    def _undo_stack(self):
+        if not hasattr(self._local, 'undo'):
+            self._local.undo = []
+        return self._local.undo
+
+    # Unit of work hooks
+    def begin(self):
+        self._undo_stack().append([])
+
+    def release(self):
+        stack = self._undo_stack()
+        changes = stack.pop()
+        if stack:
+            stack[-1].extend(changes)
+            return
+        with self._lock:
+            for change in changes:
+                if change[0] == 'snapshot':
+                    self._committed.pop(change[1], None)
+                elif change[0] == 'written':
+                    self._mark_clean(change[1])
+
+    def rollback(self):
+        changes = self._undo_stack().pop()
+        with self._lock:
+            for change in reversed(changes):
+                if change[0] == 'load':
+                    self._rows.pop(change[1], None)
+                    self._dirty.pop(change[1], None)
+                elif change[0] == 'snapshot':
+                    self._committed.pop(change[1], None)
+                elif change[0] == 'written':
+                    continue
+                else:
+                    _, player_id, index, old_value, was_dirty = change
+                    row = self._rows.get(player_id)
+                    if row is None:
+                        continue
+                    row[index] = old_value
+                    if not was_dirty:
+                        self._dirty[player_id].discard(index)
+                        if not self._dirty[player_id]:
+                            del self._dirty[player_id]
+
+    def get(self, conn, player_id, load=False):
+        # Rows are only cached by writers: inside a unit of work or when load=True.
+        # Outside a unit of work a row being changed reads as last committed.
+        stack = self._undo_stack()
+        with self._lock:
+            if not stack and player_id in self._committed:
+                self.hits += 1
+                return self._committed[player_id]
+            row = self._rows.get(player_id)
+            if row is not None:
+                self._rows.move_to_end(player_id)
+                self.hits += 1
+                return tuple(row)
+            self.misses += 1
+        c = conn.cursor()
+        c.execute('SELECT * FROM players WHERE player_id = ?', (player_id,))
+        fetched = c.fetchone()
+        if fetched is None or not (stack or load):
+            return fetched
+        with self._lock:
+            if player_id not in self._rows:
+                self._rows[player_id] = list(fetched)
+                if stack:
+                    stack[-1].append(('load', player_id))
+            return tuple(self._rows[player_id])
+
+    def _row_for_update(self, conn, player_id):
+        self.get(conn, player_id, load=True)
+        return self._rows.get(player_id)
+
+    def update(self, conn, player_id, check, changes):
+        # check(row) -> bool sees the current row; changes(row) -> {column: value}
+        with self._lock:
+            row = self._row_for_update(conn, player_id)
+            if row is None or not check(row):
+                return False
+            new_values = changes(row)
+            if not new_values:
+                return True
+            stack = self._undo_stack()
+            if stack and player_id not in self._committed:
+                self._committed[player_id] = tuple(row)
+                stack[-1].append(('snapshot', player_id))
+            dirty = self._dirty.setdefault(player_id, set())
+            for column, value in new_values.items():
+                index = PLAYER_COLUMNS.index(column)
+                if stack:
+                    stack[-1].append(('set', player_id, index, row[index], index in dirty))
+                row[index] = value
+                dirty.add(index)
+            if 'coins' in new_values or 'war_wins' in new_values:
+                rankings.stage(player_id, row[12], row[13])
+            return True
+
+    def cached(self, player_ids):
+        with self._lock:
+            return {player_id for player_id in player_ids if player_id in self._rows}
+
+    def dirty_count(self):
+        return len(self._dirty)
+
+    def dirty_ids(self):
+        with self._lock:
+            return list(self._dirty)
+
+    def flush_due(self):
+        with self._lock:
+            if len(self._dirty) >= self.max_dirty or len(self._rows) > self.capacity:
+                return True
+            return bool(self._dirty) and time.monotonic() - self._last_flush >= self.flush_interval
+
+    def _pending(self, player_ids):
+        # -> {player_id: {index: value}} for the dirty columns of player_ids
+        return {player_id: {index: self._rows[player_id][index] for index in self._dirty[player_id]}
+                for player_id in player_ids if player_id in self._dirty}
+
+    @staticmethod
+    def _write(conn, pending):
+        c = conn.cursor()
+        for player_id, values in pending.items():
+            assignments = ', '.join(f'{PLAYER_COLUMNS[index]} = ?' for index in values)
+            c.execute(f'UPDATE players SET {assignments} WHERE player_id = ?', list(values.values()) + [player_id])
+
+    def _mark_clean(self, pending):
+        # Columns changed again since they were written stay dirty
+        for player_id, values in pending.items():
+            dirty = self._dirty.get(player_id)
+            if dirty is not None:
+                dirty.difference_update(index for index, value in values.items() if self._rows[player_id][index] == value)
+                if not dirty:
+                    del self._dirty[player_id]
+
+    def write_through(self, conn):
+        # Writes the dirty columns of the players the open (outermost) unit of
+        # work changed into its transaction; they count as clean once it commits
+        stack = self._undo_stack()
+        with self._lock:
+            pending = self._pending({change[1] for change in stack[-1] if change[0] == 'set'})
+        if pending:
+            self._write(conn, pending)
+            stack[-1].append(('written', pending))
+            self.rows_written_through += len(pending)
+
+    def flush(self, conn):
+        # Writes every dirty column in one unit of work, then trims the LRU.
+        # Must not run inside another unit, so only the writer calls it.
+        with self._lock:
+            pending = self._pending(list(self._dirty))
+        if pending:
+            with unit_of_work(conn):
+                self._write(conn, pending)
+            self.flushes += 1
+            self.rows_flushed += len(pending)
+            logger.debug(f"Flushed {len(pending)} cached players")
+        with self._lock:
+            self._mark_clean(pending)
+            while len(self._rows) > self.capacity:
+                player_id = next((player_id for player_id in self._rows if player_id not in self._dirty), None)
+                if player_id is None:
+                    break
+                del self._rows[player_id]
+                self.evictions += 1
+            self._last_flush = time.monotonic()
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+            self._dirty.clear()
+            self._committed.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'flushes': self.flushes, 'rows_flushed': self.rows_flushed,
+                'rows_written_through': self.rows_written_through, 'evictions': self.evictions, 'cached': len(self._rows), 'dirty': len(self._dirty)}
+
+player_cache = PlayerCache(PLAYER_CACHE_SIZE, PLAYER_CACHE_FLUSH_SECONDS, PLAYER_CACHE_MAX_DIRTY)
+
+# Leaderboard
+# Every player's standing (coins, then war wins) is kept in memory as one
+# sorted list, so the top K is a slice and a player's rank a binary search.
+# It's loaded from the players table at startup and then follows committed
+# changes: a coin or war win change is staged against the open unit of work
+# and applied when the outermost unit commits, or dropped if it rolls back.
+class Leaderboard:
+    def __init__(self):
+        self._keys = []
+        self._standings = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def load(self, conn):
+        c = conn.cursor()
+        c.execute('SELECT player_id, coins, war_wins FROM players')
+        with self._lock:
+            self._standings = {player_id: (-coins, -war_wins, player_id) for player_id, coins, war_wins in c.fetchall()}
+            self._keys = sorted(self._standings.values())
+
+    def _staged(self):
+        if not hasattr(self._local, 'staged'):
+            self._local.staged = []
+        return self._local.staged
+
+    # Unit of work hooks
+    def begin(self):
+        self._staged().append({})
+
+    def release(self):
+        stack = self._staged()
+        changes = stack.pop()
+        if stack:
+            stack[-1].update(changes)
+        else:
+            self._apply(changes)
+
+    def rollback(self):
+        self._staged().pop()
+
+    def stage(self, player_id, coins, war_wins):
+        stack = self._staged()
+        if stack:
+            stack[-1][player_id] = (coins, war_wins)
+        else:
+            self._apply({player_id: (coins, war_wins)})
+
+    def _apply(self, changes):
+        with self._lock:
+            for player_id, (coins, war_wins) in changes.items():
+                old = self._standings.get(player_id)
+                if old is not None:
+                    del self._keys[bisect.bisect_left(self._keys, old)]
+                key = self._standings[player_id] = (-coins, -war_wins, player_id)
+                bisect.insort(self._keys, key)
+
+    def top(self, k):
+        # -> [(player_id, coins, war_wins)], best first
+        with self._lock:
+            return [(player_id, -coins, -war_wins) for coins, war_wins, player_id in self._keys[:k]]
+
+    def rank(self, player_id):
+        # -> (rank, players ranked, (player_id, coins, war_wins) of the player
+        # just above or None), or None for an unknown player
+        with self._lock:
+            key = self._standings.get(player_id)
+            if key is None:
+                return None
+            index = bisect.bisect_left(self._keys, key)
+            above = self._keys[index - 1] if index else None
+            return index + 1, len(self._keys), above and (above[2], -above[0], -above[1])
+
+rankings = Leaderboard()
+
+# Order book
+# Open resource orders from the trades table, indexed per (currency, item,
+# side) by price and then age: asks cheapest first, bids dearest first. Like
+# the rankings, changes are staged per unit of work and only reach the book
+# when the unit commits, so readers see committed orders only. Matching runs
+# on the writer thread and sees the changes staged so far through resting().
+# Orders are (trade_id, player_id, currency, item, side, price, remaining).
+class OrderBook:
+    def __init__(self):
+        self._keys = {}
+        self._orders = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def load(self, conn):
+        c = conn.cursor()
+        c.execute('''SELECT trade_id, seller_id, currency, item, side, price, remaining FROM trades
+                     WHERE status = 'open' AND item NOT LIKE 'citizen%' ''')
+        with self._lock:
+            self._orders = {order[0]: order for order in c.fetchall()}
+            self._keys = {}
+            for order in self._orders.values():
+                self._keys.setdefault(order[2:5], []).append(self._key(order))
+            for keys in self._keys.values():
+                keys.sort()
+
+    @staticmethod
+    def _key(order):
+        return (order[5] if order[4] == 'sell' else -order[5], order[0])
+
+    def _staged(self):
+        if not hasattr(self._local, 'staged'):
+            self._local.staged = []
+        return self._local.staged
+
+    # Unit of work hooks
+    def begin(self):
+        self._staged().append({})
+
+    def release(self):
+        stack = self._staged()
+        changes = stack.pop()
+        if stack:
+            stack[-1].update(changes)
+        else:
+            self._apply(changes)
+
+    def rollback(self):
+        self._staged().pop()
+
+    def stage(self, order):
+        # A remaining quantity of 0 takes the order off the book
+        stack = self._staged()
+        if stack:
+            stack[-1][order[0]] = order
+        else:
+            self._apply({order[0]: order})
+
+    def _apply(self, changes):
+        with self._lock:
+            for trade_id, order in changes.items():
+                old = self._orders.pop(trade_id, None)
+                if old is not None:
+                    keys = self._keys[old[2:5]]
+                    del keys[bisect.bisect_left(keys, self._key(old))]
+                if order[6] > 0:
+                    self._orders[trade_id] = order
+                    bisect.insort(self._keys.setdefault(order[2:5], []), self._key(order))
+
+    def resting(self, currency, item, side):
+        # -> open orders on one side of a book, best first, as this unit of
+        # work sees them. Walks the book lazily, so only call it from the
+        # writer thread, the only one that changes the book.
+        staged = {}
+        for changes in self._staged():
+            staged.update(changes)
+        committed = ((key, self._orders[key[1]]) for key in self._keys.get((currency, item, side), []))
+        added = sorted((self._key(order), order) for trade_id, order in staged.items()
+                       if trade_id not in self._orders and order[2:5] == (currency, item, side))
+        for key, order in heapq.merge(committed, added, key=lambda entry: entry[0]):
+            order = staged.get(order[0], order)
+            if order[6] > 0:
+                yield order
+
+    def depth(self, currency, item, levels):
+        # -> (asks, bids), each [(price, quantity, orders)] for the best
+        # `levels` prices, best first
+        with self._lock:
+            return tuple(self._levels(self._keys.get((currency, item, side), []), levels) for side in ('sell', 'buy'))
+
+    def _levels(self, keys, levels):
+        result = []
+        for price, trade_id in keys:
+            remaining = self._orders[trade_id][6]
+            if result and result[-1][0] == abs(price):
+                result[-1] = (abs(price), result[-1][1] + remaining, result[-1][2] + 1)
+            elif len(result) == levels:
+                break
+            else:
+                result.append((abs(price), remaining, 1))
+        return result
+
+order_book = OrderBook()
+
+# Units of work
+# A command (or a match tick) is one transaction: helpers never commit on
+# their own, the surrounding unit commits once on success and rolls the whole
+# command back on error. Nested units become savepoints.
+@contextmanager
+def unit_of_work(conn):
+    if conn.in_transaction:
+        conn.execute('SAVEPOINT unit_of_work')
+        player_cache.begin()
+        rankings.begin()
+        order_book.begin()
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK TO unit_of_work')
+            conn.execute('RELEASE unit_of_work')
+            player_cache.rollback()
+            rankings.rollback()
+            order_book.rollback()
+            raise
+        conn.execute('RELEASE unit_of_work')
+        player_cache.release()
+        rankings.release()
+        order_book.release()
+        return
+    conn.execute('BEGIN')
+    changes = conn.total_changes
+    player_cache.begin()
+    rankings.begin()
+    order_book.begin()
+    try:
+        yield conn
+        if conn.total_changes != changes:
+            # Writes to other tables commit together with the player changes
+            player_cache.write_through(conn)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        player_cache.rollback()
+        rankings.rollback()
+        order_book.rollback()
+        raise
+    player_cache.release()
+    rankings.release()
+    order_book.release()
+
+# Database executor
+# sqlite3 calls block, so nothing touches a connection on the event loop.
+# Writes are serialized on one writer thread (SQLite only ever has a single
+# writer) and reads run on a small reader pool against WAL snapshots. Each
+# worker thread holds one pooled connection for its whole lifetime.
+#
+# With a group commit window the writer keeps collecting queued units for up
+# to that many milliseconds and commits them together; each unit still runs
+# in its own savepoint, so one failing command doesn't take the batch down.
+DB_READERS = int(os.getenv('BATTLE_FORGE_DB_READERS', '2'))
+DB_GROUP_COMMIT_MS = float(os.getenv('BATTLE_FORGE_DB_GROUP_COMMIT_MS', '0'))
+
+class DatabaseExecutor:
+    def __init__(self, readers, group_commit_ms=0, inline=False):
+        # inline=True runs every call directly on the caller's thread, which is
+        # how the bot behaved before; only benchmarks should use it
+        self.inline = inline
+        self.group_commit_window = group_commit_ms / 1000
+        self.commits = 0
+        self.units = 0
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name='db-writer', daemon=True)
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-reader')
+        self._local = threading.local()
+        self._conns = []
+        self._lock = threading.Lock()
+        if not inline:
+            self._writer.start()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = db_pool.acquire()
+            self._local.conn = conn
+            with self._lock:
+                self._conns.append(conn)
+        return conn
+
+    def _next_batch(self):
+        # Blocks for the first unit, then gathers whatever else arrives within
+        # the group commit window. None in the queue means shut down. While
+        # cached players are dirty the wait is bounded so they get flushed.
+        try:
+            job = self._queue.get(timeout=player_cache.flush_interval if player_cache.dirty_count() else None)
+        except queue.Empty:
+            return [], False
+        if job is None:
+            return None, True
+        batch = [job]
+        deadline = time.monotonic() + self.group_commit_window
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return batch, False
+            try:
+                job = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                return batch, False
+            if job is None:
+                return batch, True
+            batch.append(job)
+
+    def _write_loop(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if batch:
+                self._commit_batch(self._connection(), batch)
+            if stopping or player_cache.flush_due():
+                self._flush_players()
+
+    def _flush_players(self):
+        try:
+            player_cache.flush(self._connection())
+        except Exception as e:
+            logger.error(f"Error flushing player cache: {str(e)}")
+
+    def _commit_batch(self, conn, batch):
+        outcomes = []
+        try:
+            with unit_of_work(conn):
+                for fn, args, kwargs, future, loop in batch:
+                    try:
+                        with unit_of_work(conn):
+                            outcomes.append((future, loop, fn(conn, *args, **kwargs), None))
+                    except Exception as e:
+                        outcomes.append((future, loop, None, e))
+            self.commits += 1
+            self.units += len(batch)
+        except Exception as e:
+            logger.error(f"Error committing {len(batch)} database writes: {str(e)}")
+            # Every job fails, including those BEGIN or COMMIT never let run
+            outcomes = [(future, loop, None, e) for _, _, _, future, loop in batch]
+        for future, loop, result, error in outcomes:
+            loop.call_soon_threadsafe(self._resolve, future, result, error)
+
+    @staticmethod
+    def _resolve(future, result, error):
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _run_read(self, fn, args, kwargs):
+        conn = self._connection()
+        try:
+            return fn(conn, *args, **kwargs)
+        finally:
+            # End the read transaction so the snapshot doesn't pin the WAL
+            if conn.in_transaction:
+                conn.rollback()
+
+    async def write(self, fn, *args, **kwargs):
+        if self.inline:
+            conn = self._connection()
+            with unit_of_work(conn):
+                result = fn(conn, *args, **kwargs)
+            self.commits += 1
+            self.units += 1
+            if player_cache.flush_due():
+                self._flush_players()
+            return result
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put((fn, args, kwargs, future, loop))
+        return await future
+
+    async def read(self, fn, *args, **kwargs):
+        if self.inline:
+            return self._run_read(fn, args, kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, self._run_read, fn, args, kwargs)
+
+    def shutdown(self):
+        # The writer flushes the player cache on its way out; inline mode has
+        # no writer thread, so flush here
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        elif self.inline:
+            self._flush_players()
+        logger.info(f"Player cache: {player_cache.stats()}")
+        self._readers.shutdown(wait=True)
+        with self._lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            db_pool.release(conn)
+
+db = DatabaseExecutor(DB_READERS, DB_GROUP_COMMIT_MS)
+
+# Outbound messages
+# Telegram throttles bots per chat (about 20 messages a minute in groups) and
+# overall (about 30 a second), so match commentary goes through the outbox:
+# every Bot API call first takes a token from its chat's bucket and from the
+# global bucket, waiting if either is empty. A match keeps one live message
+# that is edited in place instead of being replaced; updates arriving within
+# the coalesce window (or while waiting for a token) replace each other and
+# only the newest text is sent.
+OUTBOX_COALESCE_MS = float(os.getenv('BATTLE_FORGE_OUTBOX_COALESCE_MS', '1000'))
+OUTBOX_CHAT_RATE = float(os.getenv('BATTLE_FORGE_OUTBOX_CHAT_RATE', '0.33'))
+OUTBOX_CHAT_BURST = float(os.getenv('BATTLE_FORGE_OUTBOX_CHAT_BURST', '3'))
+OUTBOX_GLOBAL_RATE = float(os.getenv('BATTLE_FORGE_OUTBOX_GLOBAL_RATE', '25'))
+OUTBOX_GLOBAL_BURST = float(os.getenv('BATTLE_FORGE_OUTBOX_GLOBAL_BURST', '25'))
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+def chunk_lines(lines, limit=TELEGRAM_MESSAGE_LIMIT):
+    # Packs lines into as few messages as fit the limit
+    chunks = []
+    current = ''
+    for line in lines:
+        line = line[:limit]
+        if current and len(current) + 1 + len(line) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        # Takes a token and returns how long to wait before using it. The
+        # balance may go negative, which queues later callers behind this one.
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def full(self):
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+class LiveMessage:
+    def __init__(self, outbox, bot, chat_id, message_id, text):
+        self.outbox = outbox
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.pending = None
+        self.edits = 0
+        self.coalesced = 0
+        self._closing = asyncio.Event()
+        self._flusher = None
+
+    def update(self, text):
+        # Never waits; the flusher picks up the newest text when it's allowed to
+        if self.pending is not None:
+            self.coalesced += 1
+        self.pending = text
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            while self.pending is not None:
+                try:
+                    await asyncio.wait_for(self._closing.wait(), self.outbox.coalesce_window)
+                except asyncio.TimeoutError:
+                    pass
+                await self._flush()
+        except Exception as e:
+            logger.error(f"Error updating live message {self.message_id} in chat {self.chat_id}: {str(e)}")
+        finally:
+            self._flusher = None
+
+    async def _flush(self):
+        await self.outbox.throttle(self.chat_id)
+        text, self.pending = self.pending, None
+        if text is None or text == self.text:
+            return
+        try:
+            await self.outbox.call(self.bot.edit_message_text, chat_id=self.chat_id, message_id=self.message_id, text=text)
+        except BadRequest as e:
+            # The message is gone (deleted by an admin, say); carry on in a new one
+            logger.warning(f"Could not edit live message {self.message_id} in chat {self.chat_id}: {str(e)}")
+            message = await self.outbox.call(self.bot.send_message, chat_id=self.chat_id, text=text)
+            self.message_id = message.message_id
+        self.text = text
+        self.edits += 1
+
+    async def close(self):
+        # Sends whatever is still pending without waiting out the window
+        self._closing.set()
+        if self._flusher is not None:
+            await self._flusher
+        logger.debug(f"Live message {self.message_id} in chat {self.chat_id}: {self.edits} edits, {self.coalesced} updates coalesced")
+
+class Outbox:
+    def __init__(self, coalesce_ms, chat_rate, chat_burst, global_rate, global_burst):
+        self.coalesce_window = coalesce_ms / 1000
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.calls = 0
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats = {}
+
+    async def throttle(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= 10000:
+                self._chats = {chat: bucket for chat, bucket in self._chats.items() if not bucket.full()}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        wait = max(bucket.reserve(), self._global.reserve())
+        if wait:
+            await asyncio.sleep(wait)
+
+    async def call(self, method, **kwargs):
+        # One Bot API call that has already been throttled; if Telegram still
+        # says to slow down, wait as long as it asks and try once more
+        self.calls += 1
+        try:
+            return await method(**kwargs)
+        except RetryAfter as e:
+            logger.warning(f"Flood control in chat {kwargs.get('chat_id')}, retrying in {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+            self.calls += 1
+            return await method(**kwargs)
+
+    async def send(self, bot, chat_id, text, **kwargs):
+        await self.throttle(chat_id)
+        return await self.call(bot.send_message, chat_id=chat_id, text=text, **kwargs)
+
+    async def open_live(self, bot, chat_id, text, **kwargs):
+        message = await self.send(bot, chat_id, text, **kwargs)
+        return LiveMessage(self, bot, chat_id, message.message_id, text)
+
+outbox = Outbox(OUTBOX_COALESCE_MS, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_BURST)
+
 # Database initialization
+# Schema changes are applied as ordered, numbered migrations. schema_version
+# records every applied step, so existing databases upgrade in place on
+# startup and each step runs exactly once.
+def migrate_base_tables(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS players (
+        player_id INTEGER PRIMARY KEY,
+        username TEXT,
+        sperms INTEGER DEFAULT 0,
+        eggs INTEGER DEFAULT 0,
+        water INTEGER DEFAULT 100,
+        food INTEGER DEFAULT 100,
+        medicine INTEGER DEFAULT 100,
+        ore INTEGER DEFAULT 100,
+        water_quality TEXT DEFAULT 'medium',
+        food_quality TEXT DEFAULT 'medium',
+        medicine_quality TEXT DEFAULT 'medium',
+        ore_quality TEXT DEFAULT 'medium',
+        coins INTEGER DEFAULT 10,
+        war_wins INTEGER DEFAULT 0,
+        last_resource_collect TEXT,
+        last_supplies_collect TEXT,
+        last_event TEXT
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS citizens (
+        citizen_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        player_id INTEGER,
+        name TEXT,
+        role TEXT,
+        health INTEGER,
+        attack INTEGER,
+        defense INTEGER,
+        created_at TEXT,
+        status TEXT DEFAULT 'active',
+        injured_until TEXT,
+        FOREIGN KEY (player_id) REFERENCES players (player_id)
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS babies (
+        baby_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        player_id INTEGER,
+        name TEXT,
+        created_at TEXT,
+        born_at TEXT,
+        is_born INTEGER DEFAULT 0,
+        FOREIGN KEY (player_id) REFERENCES players (player_id)
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS trades (
+        trade_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        seller_id INTEGER,
+        item TEXT,
+        quantity INTEGER,
+        price INTEGER,
+        currency TEXT,
+        status TEXT DEFAULT 'open',
+        FOREIGN KEY (seller_id) REFERENCES players (player_id)
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS teams (
+        team_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        player_id INTEGER,
+        name TEXT UNIQUE,
+        wins INTEGER DEFAULT 0,
+        win_streak INTEGER DEFAULT 0,
+        power INTEGER DEFAULT 100,
+        FOREIGN KEY (player_id) REFERENCES players (player_id)
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS matches (
+        match_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sport TEXT,
+        team_ids TEXT,  -- JSON list of team IDs
+        max_teams INTEGER,
+        status TEXT DEFAULT 'open',
+        start_time TEXT,
+        last_update_message_id INTEGER
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS wagers (
+        wager_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        player_id INTEGER,
+        match_id INTEGER,
+        team_id INTEGER,
+        amount INTEGER,
+        FOREIGN KEY (player_id) REFERENCES players (player_id),
+        FOREIGN KEY (match_id) REFERENCES matches (match_id),
+        FOREIGN KEY (team_id) REFERENCES teams (team_id)
+    )''')
+
+def migrate_citizen_cohorts(conn):
+    # Fold per-citizen rows into cohorts, keeping only the citizens that are
+    # listed on the market as individual rows
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS citizen_cohorts (
+        player_id INTEGER,
+        role TEXT,
+        status TEXT,
+        count INTEGER DEFAULT 0,
+        PRIMARY KEY (player_id, role, status),
+        FOREIGN KEY (player_id) REFERENCES players (player_id)
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS citizen_stats (
+        player_id INTEGER,
+        role TEXT,
+        stat TEXT,
+        value NUMERIC,
+        count INTEGER DEFAULT 0,
+        PRIMARY KEY (player_id, role, stat, value),
+        FOREIGN KEY (player_id) REFERENCES players (player_id)
+    )''')
+    listed = "('citizen_' || citizen_id) IN (SELECT item FROM trades WHERE status = 'open')"
+    c.execute(f'''INSERT INTO citizen_cohorts (player_id, role, status, count)
+                  SELECT player_id, role, status, COUNT(*) FROM citizens WHERE status != 'dead' AND NOT {listed}
+                  GROUP BY player_id, role, status
+                  ON CONFLICT (player_id, role, status) DO UPDATE SET count = count + excluded.count''')
+    for stat in ('health', 'attack', 'defense'):
+        c.execute(f'''INSERT INTO citizen_stats (player_id, role, stat, value, count)
+                      SELECT player_id, role, '{stat}', {stat}, COUNT(*) FROM citizens WHERE status != 'dead' AND NOT {listed}
+                      GROUP BY player_id, role, {stat}
+                      ON CONFLICT (player_id, role, stat, value) DO UPDATE SET count = count + excluded.count''')
+    c.execute(f"DELETE FROM citizens WHERE status = 'dead' OR NOT {listed}")
+    logger.info(f"Folded {c.rowcount} citizen rows into cohorts")
+
+def migrate_indexes(conn):
+    c = conn.cursor()
+    c.execute('CREATE INDEX IF NOT EXISTS idx_citizens_player_status_role ON citizens (player_id, status, role)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_babies_player_born ON babies (player_id, is_born)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_teams_player ON teams (player_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_wagers_match ON wagers (match_id, team_id, player_id, amount)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_trades_status_item ON trades (status, item)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_matches_status ON matches (status)')
+
+def migrate_baby_batches(conn):
+    # A babies row is a batch of `count` babies sharing created_at/born_at
+    c = conn.cursor()
+    c.execute('ALTER TABLE babies ADD COLUMN count INTEGER NOT NULL DEFAULT 1')
+
+def migrate_match_supervisor(conn):
+    # Enough state to resume a match after a restart: where to post, when it
+    # starts, when it started and the seed its events are replayed from
+    c = conn.cursor()
+    for column in ('chat_id INTEGER', 'group_name TEXT', 'seed INTEGER', 'starts_at TEXT', 'started_at TEXT'):
+        c.execute(f'ALTER TABLE matches ADD COLUMN {column}')
+
+def migrate_wager_odds(conn):
+    # Wagers pay out at the multiplier quoted when they were placed; older
+    # wagers keep the flat 2x they were made at
+    c = conn.cursor()
+    c.execute('ALTER TABLE wagers ADD COLUMN multiplier REAL NOT NULL DEFAULT 2.0')
+
+def migrate_match_events(conn):
+    # One compact row per match event; see MatchLog
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS match_events (
+        match_id INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        clock INTEGER NOT NULL,
+        kind INTEGER NOT NULL,
+        team INTEGER,
+        points INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (match_id, seq)
+    ) WITHOUT ROWID''')
+
+def migrate_tournaments(conn):
+    # Bracket state for the tournament scheduler; matches also record their
+    # outcome so a tournament can read the result of a fixture played live
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS tournaments (
+        tournament_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sport TEXT NOT NULL,
+        format TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        round INTEGER NOT NULL DEFAULT 0,
+        rounds INTEGER NOT NULL DEFAULT 0,
+        chat_id INTEGER,
+        group_name TEXT,
+        created_by INTEGER,
+        starts_at TEXT,
+        winner_team_id INTEGER
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS tournament_teams (
+        tournament_id INTEGER NOT NULL,
+        team_id INTEGER NOT NULL,
+        seed INTEGER,
+        points INTEGER NOT NULL DEFAULT 0,
+        score_diff INTEGER NOT NULL DEFAULT 0,
+        eliminated INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (tournament_id, team_id)
+    ) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS tournament_fixtures (
+        fixture_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tournament_id INTEGER NOT NULL,
+        round INTEGER NOT NULL,
+        slot INTEGER NOT NULL,
+        home_team_id INTEGER,
+        away_team_id INTEGER,
+        status TEXT NOT NULL DEFAULT 'pending',
+        seed INTEGER,
+        match_id INTEGER,
+        home_score INTEGER,
+        away_score INTEGER,
+        winner_team_id INTEGER,
+        UNIQUE (tournament_id, round, slot)
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_tournaments_status ON tournaments (status)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_tournament_fixtures_match ON tournament_fixtures (match_id)')
+    for column in ('winner_team_id INTEGER', 'scores TEXT'):
+        c.execute(f'ALTER TABLE matches ADD COLUMN {column}')
+
+def migrate_chat_jobs(conn):
+    # Recurring per-chat jobs, one row per chat and job, with when each runs next
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS chat_jobs (
+        chat_id INTEGER NOT NULL,
+        job TEXT NOT NULL,
+        group_name TEXT,
+        next_run_at TEXT NOT NULL,
+        last_run_at TEXT,
+        PRIMARY KEY (chat_id, job)
+    ) WITHOUT ROWID''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chat_jobs_next_run ON chat_jobs (next_run_at)')
+
+def migrate_population_counters(conn):
+    # Living citizens (cohorts plus materialized rows) and unborn or growing
+    # babies per player, kept current by triggers so every path that adds,
+    # kills, moves, trades or grows population is counted without each one
+    # having to remember to
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS player_population (
+        player_id INTEGER PRIMARY KEY,
+        citizens INTEGER NOT NULL DEFAULT 0,
+        babies INTEGER NOT NULL DEFAULT 0
+    )''')
+    def bump(column, player, delta):
+        return f'''INSERT INTO player_population (player_id, {column}) VALUES ({player}, {delta})
+                   ON CONFLICT (player_id) DO UPDATE SET {column} = {column} + excluded.{column};'''
+    triggers = {
+        'cohorts_insert': ('AFTER INSERT ON citizen_cohorts', bump('citizens', 'NEW.player_id', 'NEW.count')),
+        'cohorts_update': ('AFTER UPDATE OF count, player_id ON citizen_cohorts',
+                           bump('citizens', 'OLD.player_id', '-OLD.count') + bump('citizens', 'NEW.player_id', 'NEW.count')),
+        'cohorts_delete': ('AFTER DELETE ON citizen_cohorts', bump('citizens', 'OLD.player_id', '-OLD.count')),
+        'citizens_insert': ('AFTER INSERT ON citizens', bump('citizens', 'NEW.player_id', "NEW.status != 'dead'")),
+        'citizens_update': ('AFTER UPDATE OF status, player_id ON citizens',
+                            bump('citizens', 'OLD.player_id', "-(OLD.status != 'dead')") + bump('citizens', 'NEW.player_id', "NEW.status != 'dead'")),
+        'citizens_delete': ('AFTER DELETE ON citizens', bump('citizens', 'OLD.player_id', "-(OLD.status != 'dead')")),
+        'babies_insert': ('AFTER INSERT ON babies', bump('babies', 'NEW.player_id', 'NEW.count')),
+        'babies_update': ('AFTER UPDATE OF count, player_id ON babies',
+                          bump('babies', 'OLD.player_id', '-OLD.count') + bump('babies', 'NEW.player_id', 'NEW.count')),
+        'babies_delete': ('AFTER DELETE ON babies', bump('babies', 'OLD.player_id', '-OLD.count')),
+    }
+    for name, (event, body) in triggers.items():
+        c.execute(f'CREATE TRIGGER IF NOT EXISTS population_{name} {event} BEGIN {body} END')
+    c.execute('''INSERT OR REPLACE INTO player_population (player_id, citizens, babies)
+                 SELECT player_id, SUM(citizens), SUM(babies) FROM (
+                     SELECT player_id, count AS citizens, 0 AS babies FROM citizen_cohorts
+                     UNION ALL
+                     SELECT player_id, COUNT(*), 0 FROM citizens WHERE status != 'dead' GROUP BY player_id
+                     UNION ALL
+                     SELECT player_id, 0, count FROM babies
+                 ) GROUP BY player_id''')
+
+def migrate_citizen_browsing(conn):
+    # Keyset pages over a player's citizens, all roles or one, in id order
+    c = conn.cursor()
+    c.execute('CREATE INDEX IF NOT EXISTS idx_citizens_player ON citizens (player_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_citizens_player_role ON citizens (player_id, role)')
+
+def migrate_order_book(conn):
+    # Trades become orders on either side with a remaining quantity. Resource
+    # listings used to price the whole lot and leave the goods with the seller
+    # until accepted; as asks they are priced per unit, rounded up, and their
+    # goods are held by the order, or they are closed if the seller no longer
+    # has them
+    c = conn.cursor()
+    c.execute("ALTER TABLE trades ADD COLUMN side TEXT DEFAULT 'sell'")
+    c.execute('ALTER TABLE trades ADD COLUMN remaining INTEGER DEFAULT 0')
+    c.execute("UPDATE trades SET remaining = CASE WHEN status = 'open' THEN quantity ELSE 0 END")
+    c.execute("SELECT trade_id, seller_id, item, quantity FROM trades WHERE status = 'open' AND item NOT LIKE 'citizen%' ORDER BY trade_id")
+    for trade_id, seller_id, item, quantity in c.fetchall():
+        held = False
+        if item in ('sperms', 'eggs', 'water', 'food', 'medicine', 'ore'):
+            c.execute(f'UPDATE players SET {item} = {item} - ? WHERE player_id = ? AND {item} >= ?', (quantity, seller_id, quantity))
+            held = c.rowcount == 1
+        if held:
+            c.execute('UPDATE trades SET price = (price + quantity - 1) / quantity WHERE trade_id = ?', (trade_id,))
+        else:
+            c.execute("UPDATE trades SET status = 'closed' WHERE trade_id = ?", (trade_id,))
+    c.execute('CREATE INDEX IF NOT EXISTS idx_trades_seller_status ON trades (seller_id, status)')
+
+def migrate_citizen_stat_repair(conn):
+    # citizen_stats kept the samples of cohort members that died or became
+    # citizens rows. Take out the samples of every citizens row still with
+    # its owner, then trim each role's histogram down to the cohort's head
+    # count, drawing the excess without replacement
+    c = conn.cursor()
+    for stat in ('health', 'attack', 'defense'):
+        c.execute(f'''UPDATE citizen_stats SET count = MAX(citizen_stats.count - rows.n, 0)
+                      FROM (SELECT player_id, role, {stat} AS value, COUNT(*) AS n FROM citizens GROUP BY player_id, role, {stat}) AS rows
+                      WHERE citizen_stats.stat = '{stat}' AND citizen_stats.player_id = rows.player_id
+                        AND citizen_stats.role = rows.role AND citizen_stats.value = rows.value''')
+    c.execute('''SELECT stats.player_id, stats.role, stats.stat, stats.n - COALESCE(cohorts.n, 0) FROM
+                     (SELECT player_id, role, stat, SUM(count) AS n FROM citizen_stats GROUP BY player_id, role, stat) AS stats
+                     LEFT JOIN (SELECT player_id, role, SUM(count) AS n FROM citizen_cohorts GROUP BY player_id, role) AS cohorts
+                     ON cohorts.player_id = stats.player_id AND cohorts.role = stats.role
+                 WHERE stats.n > COALESCE(cohorts.n, 0)''')
+    rng = np.random.default_rng(random.getrandbits(64))
+    for player_id, role, stat, excess in c.fetchall():
+        c.execute('SELECT value, count FROM citizen_stats WHERE player_id = ? AND role = ? AND stat = ? AND count > 0',
+                  (player_id, role, stat))
+        values, counts = zip(*c.fetchall())
+        taken = rng.multivariate_hypergeometric(list(counts), excess)
+        c.executemany('UPDATE citizen_stats SET count = count - ? WHERE player_id = ? AND role = ? AND stat = ? AND value = ?',
+                      [(int(n), player_id, role, stat, value) for value, n in zip(values, taken) if n])
+    c.execute('DELETE FROM citizen_stats WHERE count <= 0')
+
+def migrate_single_citizen_listings(conn):
+    # A citizen listing always sold one citizen for its price, whatever
+    # quantity it advertised
+    c = conn.cursor()
+    c.execute("UPDATE trades SET quantity = 1, remaining = 1 WHERE status = 'open' AND item LIKE 'citizen%' AND quantity != 1")
+
+def migrate_orphan_citizen_listings(conn):
+    # /trade citizen_<role> could list a citizen it failed to take from the
+    # cohort as citizen_None, which nobody can accept; nothing left the cohort
+    c = conn.cursor()
+    c.execute("UPDATE trades SET status = 'closed' WHERE status = 'open' AND item = 'citizen_None'")
+
+SCHEMA_MIGRATIONS = [
+    (1, 'base tables', migrate_base_tables),
+    (2, 'citizen cohorts', migrate_citizen_cohorts),
+    (3, 'secondary indexes', migrate_indexes),
+    (4, 'baby batches', migrate_baby_batches),
+    (5, 'match supervisor', migrate_match_supervisor),
+    (6, 'wager odds', migrate_wager_odds),
+    (7, 'match events', migrate_match_events),
+    (8, 'tournaments', migrate_tournaments),
+    (9, 'chat jobs', migrate_chat_jobs),
+    (10, 'population counters', migrate_population_counters),
+    (11, 'citizen browsing', migrate_citizen_browsing),
+    (12, 'order book', migrate_order_book),
+    (13, 'citizen stat repair', migrate_citizen_stat_repair),
+    (14, 'single citizen listings', migrate_single_citizen_listings),
+    (15, 'orphan citizen listings', migrate_orphan_citizen_listings),
+]
+
+def apply_migrations(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at TEXT
+    )''')
+    c.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+    current = c.fetchone()[0]
+    for version, description, migrate in SCHEMA_MIGRATIONS:
+        if version <= current:
+            continue
+        with unit_of_work(conn):
+            migrate(conn)
+            c.execute('INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)',
+                      (version, description, datetime.now().isoformat()))
+        logger.info(f"Applied schema migration {version}: {description}")
+        current = version
+    return current
+
+AI_TEAM_NAMES = [
+    "ThunderBolts", "IronVanguards", "BlazeCrusaders", "ShadowSprinters", "StormRiders",
+    "CrimsonWolves", "FrostTitans", "NightSpecters", "SolarKnights", "LunarDefenders",
+    "SteelPhantoms", "WildStallions", "GoldenHawks", "DarkScorpions", "SilverEagles",
+    "EmeraldVipers", "ObsidianBears", "SapphireSharks"
+]
+
 def init_db():
     try:
-        conn = sqlite3.connect('battle_forge.db')
+        conn = open_connection()
         c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS players (
-            player_id INTEGER PRIMARY KEY,
-            username TEXT,
-            sperms INTEGER DEFAULT 0,
-            eggs INTEGER DEFAULT 0,
-            water INTEGER DEFAULT 100,
-            food INTEGER DEFAULT 100,
-            medicine INTEGER DEFAULT 100,
-            ore INTEGER DEFAULT 100,
-            water_quality TEXT DEFAULT 'medium',
-            food_quality TEXT DEFAULT 'medium',
-            medicine_quality TEXT DEFAULT 'medium',
-            ore_quality TEXT DEFAULT 'medium',
-            coins INTEGER DEFAULT 10,
-            war_wins INTEGER DEFAULT 0,
-            last_resource_collect TEXT,
-            last_supplies_collect TEXT,
-            last_event TEXT
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS citizens (
-            citizen_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            player_id INTEGER,
-            name TEXT,
-            role TEXT,
-            health INTEGER,
-            attack INTEGER,
-            defense INTEGER,
-            created_at TEXT,
-            status TEXT DEFAULT 'active',
-            injured_until TEXT,
-            FOREIGN KEY (player_id) REFERENCES players (player_id)
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS babies (
-            baby_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            player_id INTEGER,
-            name TEXT,
-            created_at TEXT,
-            born_at TEXT,
-            is_born INTEGER DEFAULT 0,
-            FOREIGN KEY (player_id) REFERENCES players (player_id)
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS trades (
-            trade_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            seller_id INTEGER,
-            item TEXT,
-            quantity INTEGER,
-            price INTEGER,
-            currency TEXT,
-            status TEXT DEFAULT 'open',
-            FOREIGN KEY (seller_id) REFERENCES players (player_id)
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS teams (
-            team_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            player_id INTEGER,
-            name TEXT UNIQUE,
-            wins INTEGER DEFAULT 0,
-            win_streak INTEGER DEFAULT 0,
-            power INTEGER DEFAULT 100,
-            FOREIGN KEY (player_id) REFERENCES players (player_id)
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS matches (
-            match_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            sport TEXT,
-            team_ids TEXT,  -- JSON list of team IDs
-            max_teams INTEGER,
-            status TEXT DEFAULT 'open',
-            start_time TEXT,
-            last_update_message_id INTEGER
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS wagers (
-            wager_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            player_id INTEGER,
-            match_id INTEGER,
-            team_id INTEGER,
-            amount INTEGER,
-            FOREIGN KEY (player_id) REFERENCES players (player_id),
-            FOREIGN KEY (match_id) REFERENCES matches (match_id),
-            FOREIGN KEY (team_id) REFERENCES teams (team_id)
-        )''')
+        version = apply_migrations(conn)
         # Initialize AI teams
         c.execute('SELECT COUNT(*) FROM teams WHERE player_id IS NULL')
         if c.fetchone()[0] == 0:
-            ai_teams = [
-                "ThunderBolts", "IronVanguards", "BlazeCrusaders", "ShadowSprinters", "StormRiders",
-                "CrimsonWolves", "FrostTitans", "NightSpecters", "SolarKnights", "LunarDefenders",
-                "SteelPhantoms", "WildStallions", "GoldenHawks", "DarkScorpions", "SilverEagles",
-                "EmeraldVipers", "ObsidianBears", "SapphireSharks"
-            ]
-            for name in ai_teams:
-                c.execute('INSERT INTO teams (name, power) VALUES (?, 100)', (name,))
-            conn.commit()
-        conn.commit()
-        logger.info("Database initialized successfully")
+            with unit_of_work(conn):
+                for name in AI_TEAM_NAMES:
+                    c.execute('INSERT INTO teams (name, power) VALUES (?, 100)', (name,))
+        rankings.load(conn)
+        order_book.load(conn)
+        logger.info(f"Database initialized successfully (schema version {version})")
     except Exception as e:
         logger.error(f"Database initialization error: {str(e)}")
         raise
@@ -133,23 +1231,86 @@ init_db()
 # Helper functions
 def get_player(conn, player_id):
     try:
-        c = conn.cursor()
-        c.execute('SELECT * FROM players WHERE player_id = ?', (player_id,))
-        return c.fetchone()
+        return player_cache.get(conn, player_id)
     except Exception as e:
         logger.error(f"Error fetching player {player_id}: {str(e)}")
         return None
 
-def update_player(conn, player_id, username, sperms, eggs, water, food, medicine, ore, water_quality, food_quality, medicine_quality, ore_quality, coins, war_wins, last_resource_collect, last_supplies_collect, last_event):
+# Player repository
+# Player state is changed through targeted operations on the cached row (see
+# PlayerCache), so commands never write back a stale copy of the whole row.
+# Decrements are guarded: the change only applies if no counter would drop
+# below zero, and the caller gets False instead of a negative balance.
+PLAYER_RESOURCES = ['sperms', 'eggs', 'water', 'food', 'medicine', 'ore']
+PLAYER_COUNTERS = PLAYER_RESOURCES + ['coins', 'war_wins']
+PLAYER_TIMESTAMPS = ['last_resource_collect', 'last_supplies_collect', 'last_event']
+
+def adjust_resources(conn, player_id, **deltas):
+    for column in deltas:
+        if column not in PLAYER_COUNTERS:
+            raise ValueError(f"Unknown player counter: {column}")
+    changes = {PLAYER_COLUMNS.index(column): delta for column, delta in deltas.items() if delta}
+    if not changes:
+        return True
     try:
-        c = conn.cursor()
-        c.execute('''INSERT OR REPLACE INTO players (player_id, username, sperms, eggs, water, food, medicine, ore, water_quality, food_quality, medicine_quality, ore_quality, coins, war_wins, last_resource_collect, last_supplies_collect, last_event)
-                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                  (player_id, username, sperms, eggs, water, food, medicine, ore, water_quality, food_quality, medicine_quality, ore_quality, coins, war_wins, last_resource_collect, last_supplies_collect, last_event))
-        conn.commit()
-        logger.debug(f"Updated player {player_id}")
+        applied = player_cache.update(
+            conn, player_id,
+            lambda row: all(row[index] + delta >= 0 for index, delta in changes.items() if delta < 0),
+            lambda row: {PLAYER_COLUMNS[index]: row[index] + delta for index, delta in changes.items()})
+        logger.debug(f"Adjusted player {player_id}: {deltas}")
+        return applied
+    except Exception as e:
+        logger.error(f"Error adjusting player {player_id}: {str(e)}")
+        return False
+
+def add_coins(conn, player_id, amount, clamp=False):
+    # clamp=True takes what is there instead of refusing, e.g. for penalties
+    if not clamp:
+        return adjust_resources(conn, player_id, coins=amount)
+    try:
+        applied = player_cache.update(conn, player_id, lambda row: True, lambda row: {'coins': max(row[12] + amount, 0)})
+        logger.debug(f"Adjusted coins for player {player_id} by {amount} (clamped)")
+        return applied
     except Exception as e:
-        logger.error(f"Error updating player {player_id}: {str(e)}")
+        logger.error(f"Error adjusting coins for player {player_id}: {str(e)}")
+        return False
+
+def set_quality(conn, player_id, resource, current, quality, cost):
+    # Only applies while the quality is still `current` and the player can pay
+    if resource not in ['water', 'food', 'medicine', 'ore']:
+        raise ValueError(f"Unknown resource: {resource}")
+    index = PLAYER_COLUMNS.index(f'{resource}_quality')
+    try:
+        applied = player_cache.update(conn, player_id,
+                                      lambda row: row[index] == current and row[12] >= cost,
+                                      lambda row: {f'{resource}_quality': quality, 'coins': row[12] - cost})
+        logger.debug(f"Set {resource} quality to {quality} for player {player_id}")
+        return applied
+    except Exception as e:
+        logger.error(f"Error setting {resource} quality for player {player_id}: {str(e)}")
+        return False
+
+def claim_collection(conn, player_id, column, cooldown, **gains):
+    # Applies gains and stamps `column` only if its cooldown has passed, so two
+    # racing commands can't both collect
+    if column not in PLAYER_TIMESTAMPS:
+        raise ValueError(f"Unknown player timestamp: {column}")
+    for resource in gains:
+        if resource not in PLAYER_COUNTERS:
+            raise ValueError(f"Unknown player counter: {resource}")
+    index = PLAYER_COLUMNS.index(column)
+    now = datetime.now()
+    cutoff = (now - cooldown).isoformat()
+    try:
+        applied = player_cache.update(
+            conn, player_id,
+            lambda row: row[index] is None or row[index] <= cutoff,
+            lambda row: {column: now.isoformat(), **{resource: row[PLAYER_COLUMNS.index(resource)] + gain for resource, gain in gains.items()}})
+        logger.debug(f"Player {player_id} claimed {column}: {gains}")
+        return applied
+    except Exception as e:
+        logger.error(f"Error claiming {column} for player {player_id}: {str(e)}")
+        return False
 
 def get_babies(conn, player_id):
     try:
@@ -160,6 +1321,9 @@ def get_babies(conn, player_id):
         logger.error(f"Error fetching babies for player {player_id}: {str(e)}")
         return []
 
+def count_babies(babies):
+    return sum(baby[6] for baby in babies)
+
 def get_citizens(conn, player_id):
     try:
         c = conn.cursor()
@@ -169,37 +1333,192 @@ def get_citizens(conn, player_id):
         logger.error(f"Error fetching citizens for player {player_id}: {str(e)}")
         return []
 
-def create_citizen(conn, player_id, name, role, health, attack, defense, created_at):
+def roll_citizen_stats(role):
+    health = random.randint(50, 80) + (10 if role == 'healer' else 0)
+    attack = random.randint(15, 25) if role == 'fighter' else random.randint(5, 15)
+    defense = random.randint(15, 25) if role == 'fighter' else random.randint(5, 15)
+    return health, attack, defense
+
+# Population is stored as cohorts: a head count per (player, role, status) in
+# citizen_cohorts plus a per-role stat histogram in citizen_stats. A citizens
+# row only exists once a specific citizen has to be addressed by id (e.g. when
+# listed on the market), see materialize_citizen.
+def add_citizens(conn, player_id, citizens, status='active'):
+    # citizens: iterable of (role, health, attack, defense)
+    counts = {}
+    stats = {}
+    for role, health, attack, defense in citizens:
+        counts[role] = counts.get(role, 0) + 1
+        for stat, value in (('health', health), ('attack', attack), ('defense', defense)):
+            stats[(role, stat, value)] = stats.get((role, stat, value), 0) + 1
+    c = conn.cursor()
+    c.executemany('''INSERT INTO citizen_cohorts (player_id, role, status, count) VALUES (?, ?, ?, ?)
+                     ON CONFLICT (player_id, role, status) DO UPDATE SET count = count + excluded.count''',
+                  [(player_id, role, status, count) for role, count in counts.items()])
+    c.executemany('''INSERT INTO citizen_stats (player_id, role, stat, value, count) VALUES (?, ?, ?, ?, ?)
+                     ON CONFLICT (player_id, role, stat, value) DO UPDATE SET count = count + excluded.count''',
+                  [(player_id, role, stat, value, count) for (role, stat, value), count in stats.items()])
+    return sum(counts.values())
+
+def get_population(conn, player_id):
+    # {(role, status): count} over cohorts and materialized citizens
     try:
         c = conn.cursor()
-        c.execute('INSERT INTO citizens (player_id, name, role, health, attack, defense, created_at, status) VALUES (?, ?, ?, ?, ?, ?, ?, "active")',
-                  (player_id, name, role, health, attack, defense, created_at))
-        conn.commit()
-        logger.debug(f"Created citizen for player {player_id}")
+        c.execute('''SELECT role, status, SUM(n) FROM (
+                         SELECT role, status, count AS n FROM citizen_cohorts WHERE player_id = ? AND count > 0
+                         UNION ALL
+                         SELECT role, status, COUNT(*) FROM citizens WHERE player_id = ? AND status != 'dead' GROUP BY role, status
+                     ) GROUP BY role, status''', (player_id, player_id))
+        return {(role, status): count for role, status, count in c.fetchall()}
     except Exception as e:
-        logger.error(f"Error creating citizen for player {player_id}: {str(e)}")
+        logger.error(f"Error fetching population for player {player_id}: {str(e)}")
+        return {}
+
+def count_citizens(population, role=None, status=None):
+    return sum(count for (r, s), count in population.items() if (role is None or r == role) and (status is None or s == status))
+
+def count_population(conn, player_id):
+    # Living citizens plus babies, from the counters
+    c = conn.cursor()
+    c.execute('SELECT citizens + babies FROM player_population WHERE player_id = ?', (player_id,))
+    row = c.fetchone()
+    return row[0] if row else 0
+
+def get_stat_histogram(conn, player_id, role):
+    # {stat: [(value, count), ...]}
+    c = conn.cursor()
+    c.execute('SELECT stat, value, count FROM citizen_stats WHERE player_id = ? AND role = ? AND count > 0', (player_id, role))
+    histogram = {'health': [], 'attack': [], 'defense': []}
+    for stat, value, count in c.fetchall():
+        histogram[stat].append((value, count))
+    return histogram
+
+def get_stat_means(conn, player_id):
+    # {(role, stat): mean} over every role's histogram and the living
+    # citizens that have rows of their own, from two grouped queries
+    c = conn.cursor()
+    c.execute('''SELECT role, stat, SUM(value * count), SUM(count) FROM citizen_stats
+                 WHERE player_id = ? AND count > 0 GROUP BY role, stat''', (player_id,))
+    totals = {(role, stat): (total, count) for role, stat, total, count in c.fetchall()}
+    c.execute('''SELECT role, SUM(health), SUM(attack), SUM(defense), COUNT(*) FROM citizens
+                 WHERE player_id = ? AND status != 'dead' GROUP BY role''', (player_id,))
+    for role, health, attack, defense, count in c.fetchall():
+        for stat, total in (('health', health), ('attack', attack), ('defense', defense)):
+            cohort_total, cohort_count = totals.get((role, stat), (0, 0))
+            totals[(role, stat)] = (cohort_total + total, cohort_count + count)
+    return {key: total / count for key, (total, count) in totals.items()}
+
+def histogram_mean(buckets):
+    total = sum(count for _, count in buckets)
+    return sum(value * count for value, count in buckets) / total if total else 0
 
-def initialize_player_citizens(conn, player_id):
+def drop_stat_samples(conn, player_id, role, count):
+    # Takes `count` anonymous cohort members out of the role's histogram, each
+    # stat's values drawn without replacement in proportion to their counts
+    histogram = get_stat_histogram(conn, player_id, role)
+    rng = np.random.default_rng(random.getrandbits(64))
+    dropped = []
+    for stat, buckets in histogram.items():
+        if not buckets:
+            continue
+        values, counts = zip(*buckets)
+        taken = rng.multivariate_hypergeometric(list(counts), min(count, sum(counts)))
+        dropped += [(int(n), player_id, role, stat, value) for value, n in zip(values, taken) if n]
+    conn.cursor().executemany('UPDATE citizen_stats SET count = count - ? WHERE player_id = ? AND role = ? AND stat = ? AND value = ?',
+                              dropped)
+
+def move_citizens(conn, player_id, role, from_status, to_status, count, injured_until=None):
+    # Moves up to count citizens between statuses ('dead' removes them).
+    # Cohorts are drawn first so citizens listed on the market stay put.
+    c = conn.cursor()
+    c.execute('SELECT count FROM citizen_cohorts WHERE player_id = ? AND role = ? AND status = ?', (player_id, role, from_status))
+    row = c.fetchone()
+    from_cohort = min(count, row[0] if row else 0)
+    if from_cohort:
+        c.execute('UPDATE citizen_cohorts SET count = count - ? WHERE player_id = ? AND role = ? AND status = ?',
+                  (from_cohort, player_id, role, from_status))
+        if to_status != 'dead':
+            c.execute('''INSERT INTO citizen_cohorts (player_id, role, status, count) VALUES (?, ?, ?, ?)
+                         ON CONFLICT (player_id, role, status) DO UPDATE SET count = count + excluded.count''',
+                      (player_id, role, to_status, from_cohort))
+        else:
+            drop_stat_samples(conn, player_id, role, from_cohort)
+    moved = from_cohort
+    if moved < count:
+        c.execute('SELECT citizen_id FROM citizens WHERE player_id = ? AND role = ? AND status = ? LIMIT ?',
+                  (player_id, role, from_status, count - moved))
+        for (citizen_id,) in c.fetchall():
+            update_citizen(conn, citizen_id, to_status, injured_until)
+            moved += 1
+    return moved
+
+def materialize_citizen(conn, player_id, role):
+    # Turns one active cohort member into an addressable citizens row, drawing
+    # its stats from the role's histogram and taking them out of it, as the
+    # citizen is no longer part of the cohort. Returns the new citizen_id or None.
+    c = conn.cursor()
+    c.execute('UPDATE citizen_cohorts SET count = count - 1 WHERE player_id = ? AND role = ? AND status = "active" AND count > 0',
+              (player_id, role))
+    if c.rowcount == 0:
+        return None
+    histogram = get_stat_histogram(conn, player_id, role)
+    stats = []
+    for stat in ('health', 'attack', 'defense'):
+        values, weights = zip(*histogram[stat]) if histogram[stat] else ((0,), (1,))
+        stats.append(random.choices(values, weights=weights)[0])
+    c.executemany('UPDATE citizen_stats SET count = count - 1 WHERE player_id = ? AND role = ? AND stat = ? AND value = ? AND count > 0',
+                  [(player_id, role, stat, value) for stat, value in zip(('health', 'attack', 'defense'), stats)])
+    c.execute('INSERT INTO citizens (player_id, name, role, health, attack, defense, created_at, status) VALUES (?, ?, ?, ?, ?, ?, ?, "active")',
+              (player_id, f"{role}_{random.randint(1000, 9999)}", role, *stats, datetime.now().isoformat()))
+    logger.debug(f"Materialized {role} citizen {c.lastrowid} for player {player_id}")
+    return c.lastrowid
+
+def fighter_power(conn, player_id, fighter_count):
+    # Sum of attack * health / 100 over fighter_count active fighters:
+    # materialized fighters exactly, the rest from the cohort histogram.
+    c = conn.cursor()
+    c.execute('SELECT attack, health FROM citizens WHERE player_id = ? AND role = "fighter" AND status = "active" LIMIT ?',
+              (player_id, fighter_count))
+    rows = c.fetchall()
+    power = sum(attack * health / 100 for attack, health in rows)
+    histogram = get_stat_histogram(conn, player_id, 'fighter')
+    power += (fighter_count - len(rows)) * histogram_mean(histogram['attack']) * histogram_mean(histogram['health']) / 100
+    return power
+
+def initialize_player_citizens(conn, player_id, count=STARTING_CITIZENS):
+    # Bulk insert without committing; the caller's unit of work owns the transaction.
+    c = conn.cursor()
+    c.execute('SELECT 1 FROM citizen_cohorts WHERE player_id = ? UNION ALL SELECT 1 FROM citizens WHERE player_id = ? LIMIT 1',
+              (player_id, player_id))
+    if not c.fetchone():
+        roles = random.choices(CITIZEN_ROLES, k=count)
+        add_citizens(conn, player_id, ((role, *roll_citizen_stats(role)) for role in roles))
+        logger.debug(f"Initialized {count} citizens for player {player_id}")
+
+def provision_player(conn, player_id, username):
+    # Player row, starting population and team are written inside the caller's
+    # unit of work, so a first-time command pays for a single commit.
     try:
         c = conn.cursor()
-        c.execute('SELECT COUNT(*) FROM citizens WHERE player_id = ?', (player_id,))
-        if c.fetchone()[0] == 0:
-            for i in range(10000):
-                role = random.choice(['worker', 'miner', 'fighter', 'teacher', 'professor', 'healer', 'engineer', 'trader', 'scout', 'workless'])
-                health = random.randint(50, 80) + (10 if role == 'healer' else 0)
-                attack = random.randint(15, 25) if role == 'fighter' else random.randint(5, 15)
-                defense = random.randint(15, 25) if role == 'fighter' else random.randint(5, 15)
-                create_citizen(conn, player_id, f"citizen_{i+1}", role, health, attack, defense, datetime.now().isoformat())
-            logger.debug(f"Initialized 10,000 citizens for player {player_id}")
+        c.execute('INSERT OR IGNORE INTO players (player_id, username) VALUES (?, ?) RETURNING player_id, coins, war_wins',
+                  (player_id, username))
+        for row in c.fetchall():
+            rankings.stage(*row)
+        initialize_player_citizens(conn, player_id)
+        c.execute('SELECT 1 FROM teams WHERE player_id = ?', (player_id,))
+        if not c.fetchone():
+            c.execute('INSERT OR IGNORE INTO teams (player_id, name, power) VALUES (?, ?, 100)', (player_id, f"@{username}_team"))
+        logger.debug(f"Provisioned player {player_id}")
+        return get_player(conn, player_id)
     except Exception as e:
-        logger.error(f"Error initializing citizens for player {player_id}: {str(e)}")
+        logger.error(f"Error provisioning player {player_id}: {str(e)}")
+        raise
 
-def create_baby(conn, player_id, name, created_at):
+def create_baby(conn, player_id, name, created_at, count=1):
     try:
         c = conn.cursor()
-        c.execute('INSERT INTO babies (player_id, name, created_at) VALUES (?, ?, ?)', (player_id, name, created_at))
-        conn.commit()
-        logger.debug(f"Created baby for player {player_id}")
+        c.execute('INSERT INTO babies (player_id, name, created_at, count) VALUES (?, ?, ?, ?)', (player_id, name, created_at, count))
+        logger.debug(f"Created {count} babies for player {player_id}")
         return c.lastrowid
     except Exception as e:
         logger.error(f"Error creating baby for player {player_id}: {str(e)}")
@@ -209,7 +1528,6 @@ def update_baby(conn, baby_id, is_born, born_at):
     try:
         c = conn.cursor()
         c.execute('UPDATE babies SET is_born = ?, born_at = ? WHERE baby_id = ?', (is_born, born_at, baby_id))
-        conn.commit()
         logger.debug(f"Updated baby {baby_id}")
     except Exception as e:
         logger.error(f"Error updating baby {baby_id}: {str(e)}")
@@ -221,7 +1539,6 @@ def update_citizen(conn, citizen_id, status, injured_until=None):
             c.execute('UPDATE citizens SET status = ?, injured_until = ? WHERE citizen_id = ?', (status, injured_until, citizen_id))
         else:
             c.execute('UPDATE citizens SET status = ? WHERE citizen_id = ?', (status, citizen_id))
-        conn.commit()
         logger.debug(f"Updated citizen {citizen_id} status to {status}")
     except Exception as e:
         logger.error(f"Error updating citizen {citizen_id}: {str(e)}")
@@ -229,17 +1546,20 @@ def update_citizen(conn, citizen_id, status, injured_until=None):
 def create_trade(conn, seller_id, item, quantity, price, currency):
     try:
         c = conn.cursor()
-        c.execute('INSERT INTO trades (seller_id, item, quantity, price, currency) VALUES (?, ?, ?, ?, ?)',
-                  (seller_id, item, quantity, price, currency))
-        conn.commit()
+        c.execute('INSERT INTO trades (seller_id, item, quantity, price, currency, remaining) VALUES (?, ?, ?, ?, ?, ?)',
+                  (seller_id, item, quantity, price, currency, quantity))
         logger.debug(f"Created trade for player {seller_id}")
     except Exception as e:
         logger.error(f"Error creating trade for player {seller_id}: {str(e)}")
 
-def get_open_trades(conn):
+def get_open_trades(conn, limit):
+    # Citizen listings with their seller's name; resources are on the book
     try:
         c = conn.cursor()
-        c.execute('SELECT * FROM trades WHERE status = "open"')
+        c.execute('''SELECT trades.trade_id, players.username, trades.item, trades.quantity, trades.price, trades.currency
+                     FROM trades JOIN players ON players.player_id = trades.seller_id
+                     WHERE trades.status = 'open' AND trades.item LIKE 'citizen%'
+                     ORDER BY trades.trade_id LIMIT ?''', (limit,))
         return c.fetchall()
     except Exception as e:
         logger.error(f"Error fetching open trades: {str(e)}")
@@ -254,6 +1574,41 @@ def get_team(conn, team_id):
         logger.error(f"Error fetching team {team_id}: {str(e)}")
         return None
 
+def get_teams(conn, team_ids):
+    # One query for a whole field, in team_ids order; None for a missing team
+    try:
+        c = conn.cursor()
+        c.execute('''SELECT teams.* FROM json_each(?) AS ids LEFT JOIN teams ON teams.team_id = ids.value
+                     ORDER BY ids.key''', (json.dumps(list(team_ids)),))
+        return [row if row[0] is not None else None for row in c.fetchall()]
+    except Exception as e:
+        logger.error(f"Error fetching teams {team_ids}: {str(e)}")
+        return [None for team_id in team_ids]
+
+def create_ai_teams(conn, count):
+    # Once every base name is taken, AI teams are numbered: ThunderBolts2, ...
+    c = conn.cursor()
+    c.execute('SELECT COUNT(*) FROM teams WHERE player_id IS NULL')
+    existing = c.fetchone()[0]
+    names = [AI_TEAM_NAMES[i % len(AI_TEAM_NAMES)] + (str(i // len(AI_TEAM_NAMES) + 1) if i >= len(AI_TEAM_NAMES) else '')
+             for i in range(existing, existing + count)]
+    c.executemany('INSERT INTO teams (name, power) VALUES (?, 100)', [(name,) for name in names])
+    logger.debug(f"Created {count} AI teams")
+
+def fill_with_ai_teams(conn, team_ids, size):
+    # Tops a field up to size with AI teams; returns the team ids
+    missing = size - len(team_ids)
+    if missing <= 0:
+        return team_ids
+    c = conn.cursor()
+    available = 'FROM teams WHERE player_id IS NULL AND team_id NOT IN (SELECT value FROM json_each(?))'
+    c.execute(f'SELECT COUNT(*) {available}', (json.dumps(team_ids),))
+    shortfall = missing - c.fetchone()[0]
+    if shortfall > 0:
+        create_ai_teams(conn, shortfall)
+    c.execute(f'SELECT team_id {available} ORDER BY RANDOM() LIMIT ?', (json.dumps(team_ids), missing))
+    return team_ids + [row[0] for row in c.fetchall()]
+
 def get_player_team(conn, player_id):
     try:
         c = conn.cursor()
@@ -267,7 +1622,6 @@ def create_team(conn, player_id, name):
     try:
         c = conn.cursor()
         c.execute('INSERT INTO teams (player_id, name, power) VALUES (?, ?, 100)', (player_id, name))
-        conn.commit()
         logger.debug(f"Created team {name} for player {player_id}")
     except Exception as e:
         logger.error(f"Error creating team for player {player_id}: {str(e)}")
@@ -278,17 +1632,17 @@ def update_team(conn, team_id, wins, win_streak, power):
         c = conn.cursor()
         c.execute('UPDATE teams SET wins = ?, win_streak = ?, power = ? WHERE team_id = ?',
                   (wins, win_streak, power, team_id))
-        conn.commit()
+        odds_cache.invalidate(team_id)
         logger.debug(f"Updated team {team_id}")
     except Exception as e:
         logger.error(f"Error updating team {team_id}: {str(e)}")
 
-def create_match(conn, sport, creator_team_id, max_teams):
+def create_match(conn, sport, creator_team_id, max_teams, chat_id=None, group_name=None, starts_at=None):
+    # starts_at on an open match starts it then with whoever has joined
     try:
         c = conn.cursor()
-        c.execute('INSERT INTO matches (sport, team_ids, max_teams, status, start_time) VALUES (?, ?, ?, ?, ?)',
-                  (sport, json.dumps([creator_team_id]), max_teams, 'open', datetime.now().isoformat()))
-        conn.commit()
+        c.execute('INSERT INTO matches (sport, team_ids, max_teams, status, start_time, chat_id, group_name, starts_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                  (sport, json.dumps([creator_team_id]), max_teams, 'open', datetime.now().isoformat(), chat_id, group_name, starts_at))
         match_id = c.lastrowid
         logger.debug(f"Created match {match_id}: {sport} for {max_teams} teams")
         return match_id
@@ -310,17 +1664,31 @@ def update_match(conn, match_id, status, team_ids=None, last_update_message_id=N
                       (status, last_update_message_id, match_id))
         else:
             c.execute('UPDATE matches SET status = ? WHERE match_id = ?', (status, match_id))
-        conn.commit()
         logger.debug(f"Updated match {match_id} to status {status}")
     except Exception as e:
         logger.error(f"Error updating match {match_id}: {str(e)}")
 
-def create_wager(conn, player_id, match_id, team_id, amount):
+def get_match(conn, match_id):
     try:
         c = conn.cursor()
-        c.execute('INSERT INTO wagers (player_id, match_id, team_id, amount) VALUES (?, ?, ?, ?)',
-                  (player_id, match_id, team_id, amount))
-        conn.commit()
+        c.execute('SELECT * FROM matches WHERE match_id = ?', (match_id,))
+        return c.fetchone()
+    except Exception as e:
+        logger.error(f"Error fetching match {match_id}: {str(e)}")
+        return None
+
+def get_supervised_matches(conn):
+    # Matches the supervisor has to pick up after a restart
+    c = conn.cursor()
+    c.execute('''SELECT match_id FROM matches
+                 WHERE status IN ('scheduled', 'running') OR (status = 'open' AND starts_at IS NOT NULL)''')
+    return [row[0] for row in c.fetchall()]
+
+def create_wager(conn, player_id, match_id, team_id, amount, multiplier):
+    try:
+        c = conn.cursor()
+        c.execute('INSERT INTO wagers (player_id, match_id, team_id, amount, multiplier) VALUES (?, ?, ?, ?, ?)',
+                  (player_id, match_id, team_id, amount, multiplier))
         logger.debug(f"Created wager for player {player_id} on match {match_id}")
     except Exception as e:
         logger.error(f"Error creating wager for player {player_id}: {str(e)}")
@@ -355,51 +1723,81 @@ def can_trigger_event(player):
 def quality_modifier(quality):
     return {'high': 1.5, 'medium': 1.0, 'low': 0.5}[quality]
 
+def sample_binomial(n, p):
+    # Successes out of n trials; large batches use the normal approximation
+    if p >= 1:
+        return n
+    if p <= 0 or n <= 0:
+        return 0
+    if n <= 1000:
+        return sum(random.random() < p for _ in range(n))
+    return min(n, max(0, round(random.gauss(n * p, (n * p * (1 - p)) ** 0.5))))
+
 def grow_babies(conn, player_id):
+    # One pass over the player's baby batches: role counts and supplies are
+    # read once, each batch is advanced as a whole (a binomial draw decides how
+    # many of an unborn batch are born, splitting it if not all of them are)
+    # and the outcome is applied with a handful of batch statements.
     try:
         babies = get_babies(conn, player_id)
+        if not babies:
+            return
         player = get_player(conn, player_id)
         now = datetime.now()
-        population = len(babies) + len(get_citizens(conn, player_id))
-        overpopulation = population > (player[4] + player[5] + player[6] + player[7]) / 10
+        population = get_population(conn, player_id)
+        overpopulation = count_babies(babies) + count_citizens(population) > (player[4] + player[5] + player[6] + player[7]) / 10
+        growth_period = timedelta(hours=24 * max(0.5, 1.0 - count_citizens(population, 'teacher') * 0.1))
+        chance = 0.5 + sum(quality_modifier(player[i]) for i in [8, 9, 10, 11]) + count_citizens(population, 'professor') * 0.1
+        if overpopulation:
+            chance *= 0.8
+        # Every birth costs 5 of each supply
+        affordable = min(player[4], player[5], player[6], player[7]) // 5
+        grown = []
+        grown_count = 0
+        born = []
+        born_count = 0
         for baby in babies:
             if baby[5] == 1:
-                born_at = datetime.fromisoformat(baby[4])
-                teachers = sum(1 for c in get_citizens(conn, player_id) if c[3] == 'teacher')
-                growth_modifier = max(0.5, 1.0 - teachers * 0.1)
-                if now >= born_at + timedelta(hours=24 * growth_modifier):
-                    role = random.choice(['worker', 'miner', 'fighter', 'teacher', 'professor', 'healer', 'engineer', 'trader', 'scout', 'workless'])
-                    health = random.randint(50, 80) + (10 if role == 'healer' else 0)
-                    attack = random.randint(15, 25) if role == 'fighter' else random.randint(5, 15)
-                    defense = random.randint(15, 25) if role == 'fighter' else random.randint(5, 15)
-                    if role == 'fighter':
-                        attack *= quality_modifier(player[11])
-                        defense *= quality_modifier(player[11])
-                    create_citizen(conn, player_id, baby[2], role, health, attack, defense, now.isoformat())
-                    c = conn.cursor()
-                    c.execute('DELETE FROM babies WHERE baby_id = ?', (baby[0],))
-                    conn.commit()
-            elif now >= datetime.fromisoformat(baby[3]) + timedelta(hours=9):
-                base_chance = 0.5
-                professors = sum(1 for c in get_citizens(conn, player_id) if c[3] == 'professor')
-                chance = base_chance + sum(quality_modifier(player[i]) for i in [8, 9, 10, 11]) + professors * 0.1
-                if overpopulation:
-                    chance *= 0.8
-                if player[4] >= 5 and player[5] >= 5 and player[6] >= 5 and player[7] >= 5 and random.random() < chance:
-                    update_baby(conn, baby[0], 1, now.isoformat())
-                    update_player(conn, player_id, player[1], player[2], player[3], player[4] - 5, player[5] - 5, player[6] - 5, player[7] - 5,
-                                 player[8], player[9], player[10], player[11], player[12], player[13], player[14], player[15], player[16])
+                if now >= datetime.fromisoformat(baby[4]) + growth_period:
+                    grown.append(baby[0])
+                    grown_count += baby[6]
+            elif born_count < affordable and now >= datetime.fromisoformat(baby[3]) + timedelta(hours=9):
+                count = min(sample_binomial(baby[6], chance), affordable - born_count)
+                if count:
+                    born.append((baby, count))
+                    born_count += count
+        c = conn.cursor()
+        if grown:
+            fighter_modifier = quality_modifier(player[11])
+            citizens = []
+            for role in random.choices(CITIZEN_ROLES, k=grown_count):
+                health, attack, defense = roll_citizen_stats(role)
+                if role == 'fighter':
+                    attack *= fighter_modifier
+                    defense *= fighter_modifier
+                citizens.append((role, health, attack, defense))
+            add_citizens(conn, player_id, citizens)
+            c.executemany('DELETE FROM babies WHERE baby_id = ?', [(baby_id,) for baby_id in grown])
+        if born and adjust_resources(conn, player_id, water=-5 * born_count, food=-5 * born_count, medicine=-5 * born_count, ore=-5 * born_count):
+            c.executemany('UPDATE babies SET is_born = 1, born_at = ? WHERE baby_id = ?',
+                          [(now.isoformat(), baby[0]) for baby, count in born if count == baby[6]])
+            # Partly born batches keep their unborn remainder and split off the born part
+            partial = [(baby, count) for baby, count in born if count < baby[6]]
+            c.executemany('UPDATE babies SET count = count - ? WHERE baby_id = ?', [(count, baby[0]) for baby, count in partial])
+            c.executemany('INSERT INTO babies (player_id, name, created_at, born_at, is_born, count) VALUES (?, ?, ?, ?, 1, ?)',
+                          [(player_id, baby[2], baby[3], now.isoformat(), count) for baby, count in partial])
+        logger.debug(f"Player {player_id}: {grown_count} babies grew up, {born_count} were born")
     except Exception as e:
         logger.error(f"Error in grow_babies for player {player_id}: {str(e)}")
 
 def produce_supplies(conn, player_id):
     try:
         player = get_player(conn, player_id)
-        citizens = get_citizens(conn, player_id)
-        workers = [c for c in citizens if c[3] == 'worker' and c[8] == 'active']
-        miners = [c for c in citizens if c[3] == 'miner' and c[8] == 'active']
+        population = get_population(conn, player_id)
+        workers = count_citizens(population, 'worker', 'active')
+        miners = count_citizens(population, 'miner', 'active')
         water, food, medicine, ore = 0, 0, 0, 0
-        for _ in workers:
+        for _ in range(workers):
             supply_type = random.choice(['water', 'food', 'medicine'])
             amount = int(random.randint(1, 3) * quality_modifier(player[8 if supply_type == 'water' else 9 if supply_type == 'food' else 10]))
             if supply_type == 'water':
@@ -408,11 +1806,9 @@ def produce_supplies(conn, player_id):
                 food += amount
             else:
                 medicine += amount
-        for _ in miners:
+        for _ in range(miners):
             ore += int(random.randint(1, 3) * quality_modifier(player[11]))
-        if water or food or medicine or ore:
-            update_player(conn, player_id, player[1], player[2], player[3], player[4] + water, player[5] + food, player[6] + medicine, player[7] + ore,
-                         player[8], player[9], player[10], player[11], player[12], player[13], player[14], player[15], player[16])
+        adjust_resources(conn, player_id, water=water, food=food, medicine=medicine, ore=ore)
         return water, food, medicine, ore
     except Exception as e:
         logger.error(f"Error in produce_supplies for player {player_id}: {str(e)}")
@@ -423,7 +1819,6 @@ def random_event(conn, chat_id):
         c = conn.cursor()
         c.execute('SELECT player_id FROM players')
         players = c.fetchall()
-        now = datetime.now()
         event = random.choice(['boom', 'plague'])
         response = f"Random event in group {chat_id}: "
         for player_id in players:
@@ -435,463 +1830,1324 @@ def random_event(conn, chat_id):
                 food = random.randint(10, 20)
                 medicine = random.randint(10, 20)
                 ore = random.randint(10, 20)
-                update_player(conn, player_id[0], player[1], player[2], player[3], player[4] + water, player[5] + food, player[6] + medicine, player[7] + ore,
-                             player[8], player[9], player[10], player[11], player[12], player[13], player[14], player[15], now.isoformat())
+                if not claim_collection(conn, player_id[0], 'last_event', timedelta(hours=24), water=water, food=food, medicine=medicine, ore=ore):
+                    continue
                 response += f"Resource boom! @{player[1]} gained {water} water, {food} food, {medicine} medicine, {ore} ore.\n"
             else:
-                citizens = get_citizens(conn, player_id[0])
+                share = random.uniform(0.1, 0.3)
+                lost = 0
+                for (role, status), count in get_population(conn, player_id[0]).items():
+                    lost += move_citizens(conn, player_id[0], role, status, 'dead', int(count * share))
                 babies = get_babies(conn, player_id[0])
-                affected = random.sample(citizens + babies, k=int(len(citizens + babies) * random.uniform(0.1, 0.3)))
-                for unit in affected:
-                    if unit in babies:
-                        c.execute('DELETE FROM babies WHERE baby_id = ?', (unit[0],))
-                    else:
-                        update_citizen(conn, unit[0], 'dead')
-                conn.commit()
-                response += f"Plague! @{player[1]} lost {len(affected)} population.\n"
+                losses = [(int(baby[6] * share), baby[0]) for baby in babies if int(baby[6] * share)]
+                c.executemany('UPDATE babies SET count = count - ? WHERE baby_id = ?', losses)
+                c.execute('DELETE FROM babies WHERE player_id = ? AND count <= 0', (player_id[0],))
+                lost += sum(loss for loss, baby_id in losses)
+                response += f"Plague! @{player[1]} lost {lost} population.\n"
         logger.debug(f"Random event triggered: {event}")
         return response
     except Exception as e:
         logger.error(f"Error in random_event: {str(e)}")
         return ""
 
-def calculate_currency_value(player, citizens, babies):
-    try:
-        total_supplies = player[4] + player[5] + player[6] + player[7] * 2
-        population = len(babies) + len(citizens)
-        return total_supplies / max(population, 1)
-    except Exception as e:
-        logger.error(f"Error calculating currency value for player {player[1]}: {str(e)}")
-        return 1.0
+# Match engine
+# Sports are simulated by pure functions of the entrants and a seeded RNG: no
+# sleeps, no Telegram and no database, so a match takes microseconds and the
+# same seed always replays the same match. simulate_match then presents the
+# event stream to the chat at human pace (see present_match).
+#
+# Events carry the match clock in seconds and the points they award to their
+# team (a racing tick names the leader and its distance instead).
+MatchEvent = namedtuple('MatchEvent', ['clock', 'kind', 'team', 'text', 'points'], defaults=(0,))
+MatchResult = namedtuple('MatchResult', ['winner', 'scores', 'sets', 'distances'])
 
-async def simulate_match(update, context, match_id, sport, team_ids):
-    try:
-        conn = sqlite3.connect('battle_forge.db')
-        teams = [get_team(conn, team_id) for team_id in team_ids]
-        group_name = update.effective_chat.title or "group"
-        chat_id = update.effective_chat.id
-        is_racing = sport in ['f1_racing', 'horse_racing']
-        timeline = [] if not is_racing else None
-        scores = {team[2]: 0 for team in teams}
-        sets = {team[2]: 0 for team in teams} if sport == 'volleyball' else None
-        hits = {team[2]: 0 for team in teams} if sport == 'boxing' else None
-        distances = {team[2]: 0 for team in teams} if is_racing else None
-        message = await update.message.reply_text(f"{sport} match started: {', '.join([team[2] for team in teams])}!")
-        update_match(conn, match_id, 'open', team_ids=team_ids, last_update_message_id=message.message_id)
-
-        if is_racing:
-            race_distance = 1000
-            update_interval = 5
-            intervals = 60 // update_interval
-            for i in range(intervals):
-                await asyncio.sleep(update_interval)
-                for team in teams:
-                    advance = random.randint(10, 50) * (1 + (team[5] - 100) / 200)
-                    distances[team[2]] += advance
-                leaderboard = f"{sport}: " + ", ".join(f"{team}: {distances[team]:.0f}m" for team in distances)
-                new_message = await context.bot.send_message(chat_id=chat_id, text=leaderboard)
-                if message.message_id:
-                    await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
-                message = new_message
-                update_match(conn, match_id, 'open', team_ids=team_ids, last_update_message_id=message.message_id)
-            sorted_teams = sorted(distances.items(), key=lambda x: x[1], reverse=True)
-            winner_name = sorted_teams[0][0]
-            winner_id = next(team[0] for team in teams if team[2] == winner_name)
-        else:
-            if sport == 'volleyball':
-                set_number = 1
-                match_time = 0
-                while match_time < 60 and max(sets.values(), default=0) < 3:
-                    team1, team2 = random.sample(teams, 2)
-                    team1_set_score = 0
-                    team2_set_score = 0
-                    while match_time < 60 and (team1_set_score < 25 and team2_set_score < 25 or abs(team1_set_score - team2_set_score) < 2):
-                        await asyncio.sleep(random.uniform(1, 3))
-                        match_time += random.uniform(1, 3)
-                        team1_chance = 0.5 + (team1[5] - team2[5]) / 200
-                        if random.random() < 0.1:
-                            fouling_team = team1 if random.random() < 0.5 else team2
-                            other_team = team2 if fouling_team == team1 else team1
-                            event_text = f"{sport} set {set_number}: {fouling_team[2]} {team1_set_score} - {other_team[2]} {team2_set_score}, {fouling_team[2]} service fault!"
-                            scores[other_team[2]] += 1
-                            if other_team == team1:
-                                team1_set_score += 1
-                            else:
-                                team2_set_score += 1
-                        else:
-                            scoring_team = team1 if random.random() < team1_chance else team2
-                            event_text = f"{sport} set {set_number}: {scoring_team[2]} {team1_set_score} - {other_team[2]} {team2_set_score}, {scoring_team[2]} scores on a serve!"
-                            scores[scoring_team[2]] += 1
-                            if scoring_team == team1:
-                                team1_set_score += 1
-                            else:
-                                team2_set_score += 1
-                        timeline.append(event_text)
-                        new_message = await context.bot.send_message(chat_id=chat_id, text=event_text)
-                        if message.message_id:
-                            await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
-                        message = new_message
-                        update_match(conn, match_id, 'open', team_ids=team_ids, last_update_message_id=message.message_id)
-                    if team1_set_score > team2_set_score:
-                        sets[team1[2]] += 1
-                    else:
-                        sets[team2[2]] += 1
-                    set_number += 1
-                winner_id = next(team[0] for team in teams if sets[team[2]] >= 3) if max(sets.values(), default=0) >= 3 else None
-            elif sport == 'basketball':
-                for quarter in range(1, 5):
-                    quarter_time = 0
-                    while quarter_time < 15:
-                        await asyncio.sleep(random.uniform(1, 3))
-                        quarter_time += random.uniform(1, 3)
-                        team1, team2 = random.sample(teams, 2)
-                        team1_chance = 0.5 + (team1[5] - team2[5]) / 200
-                        if random.random() < 0.15:
-                            fouling_team = team1 if random.random() < 0.5 else team2
-                            other_team = team2 if fouling_team == team1 else team1
-                            free_throws = random.randint(1, 2)
-                            event_text = f"{sport} quarter {quarter} (0:{15-quarter_time:.0f}): {other_team[2]} {scores[other_team[2]]} - {fouling_team[2]} {scores[fouling_team[2]]}, {fouling_team[2]} commits a foul!"
-                            timeline.append(event_text)
-                            new_message = await context.bot.send_message(chat_id=chat_id, text=event_text)
-                            if message.message_id:
-                                await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
-                            message = new_message
-                            update_match(conn, match_id, 'open', team_ids=team_ids, last_update_message_id=message.message_id)
-                            for _ in range(free_throws):
-                                if random.random() < 0.7:
-                                    scores[other_team[2]] += 1
-                                    event_text = f"{sport} quarter {quarter} (0:{15-quarter_time:.0f}): {other_team[2]} {scores[other_team[2]]} - {fouling_team[2]} {scores[fouling_team[2]]}, {other_team[2]} scores a free throw!"
-                                    timeline.append(event_text)
-                                    new_message = await context.bot.send_message(chat_id=chat_id, text=event_text)
-                                    if message.message_id:
-                                        await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
-                                    message = new_message
-                                    update_match(conn, match_id, 'open', team_ids=team_ids, last_update_message_id=message.message_id)
-                        elif random.random() < 0.2:
-                            shooting_team = team1 if random.random() < team1_chance else team2
-                            other_team = team2 if shooting_team == team1 else team1
-                            event_text = f"{sport} quarter {quarter} (0:{15-quarter_time:.0f}): {shooting_team[2]} {scores[shooting_team[2]]} - {other_team[2]} {scores[other_team[2]]}, {shooting_team[2]} airball!"
-                            timeline.append(event_text)
-                            new_message = await context.bot.send_message(chat_id=chat_id, text=event_text)
-                            if message.message_id:
-                                await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
-                            message = new_message
-                            update_match(conn, match_id, 'open', team_ids=team_ids, last_update_message_id=message.message_id)
-                        else:
-                            scoring_team = team1 if random.random() < team1_chance else team2
-                            other_team = team2 if scoring_team == team1 else team1
-                            points = random.choice([2, 3])
-                            scores[scoring_team[2]] += points
-                            event_text = f"{sport} quarter {quarter} (0:{15-quarter_time:.0f}): {scoring_team[2]} {scores[scoring_team[2]]} - {other_team[2]} {scores[other_team[2]]}, {scoring_team[2]} scores {points} points!"
-                            timeline.append(event_text)
-                            new_message = await context.bot.send_message(chat_id=chat_id, text=event_text)
-                            if message.message_id:
-                                await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
-                            message = new_message
-                            update_match(conn, match_id, 'open', team_ids=team_ids, last_update_message_id=message.message_id)
-                    event_text = f"{sport} quarter {quarter} ends: " + ", ".join(f"{team[2]} {scores[team[2]]}" for team in teams)
-                    timeline.append(event_text)
-                    new_message = await context.bot.send_message(chat_id=chat_id, text=event_text)
-                    if message.message_id:
-                        await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
-                    message = new_message
-                    update_match(conn, match_id, 'open', team_ids=team_ids, last_update_message_id=message.message_id)
-                winner_id = max(scores.items(), key=lambda x: x[1])[1] if len(set(scores.values())) > 1 else None
-                winner_id = next(team[0] for team in teams if team[2] == winner_id) if winner_id else None
-            elif sport == 'soccer':
-                match_time = 0
-                while match_time < 60:
-                    await asyncio.sleep(random.uniform(1, 3))
-                    match_time += random.uniform(1, 3)
-                    team1, team2 = random.sample(teams, 2)
-                    team1_chance = 0.5 + (team1[5] - team2[5]) / 200
-                    if random.random() < 0.1:
-                        fouling_team = team1 if random.random() < 0.5 else team2
-                        other_team = team2 if fouling_team == team1 else team1
-                        event_text = f"{sport} (0:{60-match_time:.0f}): {other_team[2]} {scores[other_team[2]]} - {fouling_team[2]} {scores[fouling_team[2]]}, {fouling_team[2]} commits a foul!"
-                        timeline.append(event_text)
-                        new_message = await context.bot.send_message(chat_id=chat_id, text=event_text)
-                        if message.message_id:
-                            await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
-                        message = new_message
-                        update_match(conn, match_id, 'open', team_ids=team_ids, last_update_message_id=message.message_id)
-                        if random.random() < 0.2:
-                            scores[other_team[2]] += 1
-                            event_text = f"{sport} (0:{60-match_time:.0f}): {other_team[2]} {scores[other_team[2]]} - {fouling_team[2]} {scores[fouling_team[2]]}, {other_team[2]} scores a penalty goal!"
-                            timeline.append(event_text)
-                            new_message = await context.bot.send_message(chat_id=chat_id, text=event_text)
-                            if message.message_id:
-                                await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
-                            message = new_message
-                            update_match(conn, match_id, 'open', team_ids=team_ids, last_update_message_id=message.message_id)
-                    elif random.random() < 0.2:
-                        shooting_team = team1 if random.random() < team1_chance else team2
-                        other_team = team2 if shooting_team == team1 else team1
-                        event_text = f"{sport} (0:{60-match_time:.0f}): {shooting_team[2]} {scores[shooting_team[2]]} - {other_team[2]} {scores[other_team[2]]}, {shooting_team[2]} shot missed!"
-                        timeline.append(event_text)
-                        new_message = await context.bot.send_message(chat_id=chat_id, text=event_text)
-                        if message.message_id:
-                            await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
-                        message = new_message
-                        update_match(conn, match_id, 'open', team_ids=team_ids, last_update_message_id=message.message_id)
-                    elif random.random() < team1_chance * 0.02:
-                        scores[team1[2]] += 1
-                        event_text = f"{sport} (0:{60-match_time:.0f}): {team1[2]} {scores[team1[2]]} - {team2[2]} {scores[team2[2]]}, {team1[2]} scores a goal!"
-                        timeline.append(event_text)
-                        new_message = await context.bot.send_message(chat_id=chat_id, text=event_text)
-                        if message.message_id:
-                            await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
-                        message = new_message
-                        update_match(conn, match_id, 'open', team_ids=team_ids, last_update_message_id=message.message_id)
-                    elif random.random() < (1 - team1_chance) * 0.02:
-                        scores[team2[2]] += 1
-                        event_text = f"{sport} (0:{60-match_time:.0f}): {team1[2]} {scores[team1[2]]} - {team2[2]} {scores[team2[2]]}, {team2[2]} scores a goal!"
-                        timeline.append(event_text)
-                        new_message = await context.bot.send_message(chat_id=chat_id, text=event_text)
-                        if message.message_id:
-                            await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
-                        message = new_message
-                        update_match(conn, match_id, 'open', team_ids=team_ids, last_update_message_id=message.message_id)
-                winner_id = max(scores.items(), key=lambda x: x[1])[1] if len(set(scores.values())) > 1 else None
-                winner_id = next(team[0] for team in teams if team[2] == winner_id) if winner_id else None
-            elif sport == 'boxing':
-                match_time = 0
-                while match_time < 60:
-                    await asyncio.sleep(random.uniform(1, 3))
-                    match_time += random.uniform(1, 3)
-                    team1, team2 = random.sample(teams, 2)
-                    team1_chance = 0.5 + (team1[5] - team2[5]) / 200
-                    if random.random() < 0.1:
-                        fouling_team = team1 if random.random() < 0.5 else team2
-                        other_team = team2 if fouling_team == team1 else team1
-                        scores[other_team[2]] += 1
-                        event_text = f"{sport} (0:{60-match_time:.0f}): {other_team[2]} {scores[other_team[2]]} - {fouling_team[2]} {scores[fouling_team[2]]}, {fouling_team[2]} illegal move!"
-                        timeline.append(event_text)
-                        new_message = await context.bot.send_message(chat_id=chat_id, text=event_text)
-                        if message.message_id:
-                            await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
-                        message = new_message
-                        update_match(conn, match_id, 'open', team_ids=team_ids, last_update_message_id=message.message_id)
-                    else:
-                        hitting_team = team1 if random.random() < team1_chance else team2
-                        other_team = team2 if hitting_team == team1 else team1
-                        hits[hitting_team[2]] += random.randint(0, 3)
-                        event_text = f"{sport} (0:{60-match_time:.0f}): {hitting_team[2]} {scores[hitting_team[2]]} - {other_team[2]} {scores[other_team[2]]}, {hitting_team[2]} lands a {'jab' if random.random() < 0.5 else 'hook'}!"
-                        timeline.append(event_text)
-                        new_message = await context.bot.send_message(chat_id=chat_id, text=event_text)
-                        if message.message_id:
-                            await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
-                        message = new_message
-                        update_match(conn, match_id, 'open', team_ids=team_ids, last_update_message_id=message.message_id)
-                        if hits[hitting_team[2]] >= 3 and random.random() < 0.5:
-                            scores[hitting_team[2]] += 10
-                            event_text = f"{sport} (0:{60-match_time:.0f}): {hitting_team[2]} {scores[hitting_team[2]]} - {other_team[2]} {scores[other_team[2]]}, {hitting_team[2]} scores a knockout (10 points)!"
-                            timeline.append(event_text)
-                            new_message = await context.bot.send_message(chat_id=chat_id, text=event_text)
-                            if message.message_id:
-                                await context.bot.delete_message(chat_id=chat_id, message_id=message.message_id)
-                            message = new_message
-                            update_match(conn, match_id, 'open', team_ids=team_ids, last_update_message_id=message.message_id)
-                            break
-                winner_id = max(scores.items(), key=lambda x: x[1])[1] if len(set(scores.values())) > 1 else None
-                winner_id = next(team[0] for team in teams if team[2] == winner_id) if winner_id else None
-
-        for team in teams:
-            wins = team[3]
-            win_streak = team[4]
-            power = team[5]
-            if team[0] == winner_id:
-                wins += 1
-                win_streak += 1
-                power += 10
-            elif winner_id is None:
-                win_streak = 0
+SPORTS = ['basketball', 'soccer', 'volleyball', 'f1_racing', 'horse_racing', 'boxing']
+RACING_SPORTS = ['f1_racing', 'horse_racing']
+MATCH_PACE = float(os.getenv('BATTLE_FORGE_MATCH_PACE', '1'))
+RACING_TICKS = 12
+RACING_MAX_TEAMS = int(os.getenv('BATTLE_FORGE_RACING_MAX_TEAMS', '64'))
+RACING_TOP_N = int(os.getenv('BATTLE_FORGE_RACING_TOP_N', '5'))
+RACING_MOVERS = int(os.getenv('BATTLE_FORGE_RACING_MOVERS', '3'))
+
+def ordinal(n):
+    suffix = 'th' if 10 <= n % 100 <= 20 else {1: 'st', 2: 'nd', 3: 'rd'}.get(n % 10, 'th')
+    return f"{n}{suffix}"
+
+def sole_leader(scores):
+    # The team with the top score, or None on a tie
+    top = max(scores.values(), default=0)
+    leaders = [team for team, score in scores.items() if score == top]
+    return leaders[0] if len(leaders) == 1 else None
+
+def _chance(team1, team2):
+    return 0.5 + (team1[1] - team2[1]) / 200
+
+def _simulate_racing(sport, teams, rng, events):
+    # The whole field moves as arrays: every stride of the race is drawn at
+    # once and each tick's places come from one sort. A tick shows the top
+    # of the field and the biggest movers behind it, so its text stays the
+    # same size however many teams race.
+    names = [name for name, power in teams]
+    factors = 1 + (np.array([power for name, power in teams], dtype=float) - 100) / 200
+    strides = np.random.default_rng(rng.getrandbits(64)).integers(10, 51, (RACING_TICKS, len(teams)))
+    distances = np.cumsum(strides * factors, axis=0)
+    places = np.empty(len(teams), dtype=np.int64)
+    previous = None
+    for tick in range(RACING_TICKS):
+        order = np.argsort(-distances[tick], kind='stable')
+        places[order] = np.arange(len(teams))
+        lines = [f"{sport} lap {tick + 1}/{RACING_TICKS}:"]
+        lines += [f"{place + 1}. {names[i]} {distances[tick, i]:.0f}m" for place, i in enumerate(order[:RACING_TOP_N])]
+        if previous is not None:
+            gains = np.where(places >= RACING_TOP_N, previous - places, 0)
+            movers = [i for i in np.argsort(-np.abs(gains), kind='stable')[:RACING_MOVERS] if gains[i]]
+            if movers:
+                lines.append("Movers: " + ", ".join(f"{names[i]} {'up' if gains[i] > 0 else 'down'} {abs(gains[i])} to {ordinal(places[i] + 1)}"
+                                                    for i in movers))
+        previous = places.copy()
+        leader = order[0]
+        events.append(MatchEvent((tick + 1) * 5, 'tick', names[leader], "\n".join(lines), int(distances[tick, leader])))
+    final = distances[-1]
+    return MatchResult(names[int(final.argmax())], None, None, {name: float(final[i]) for i, name in enumerate(names)})
+
+def _simulate_volleyball(sport, teams, rng, events):
+    scores = {name: 0 for name, power in teams}
+    sets = {name: 0 for name, power in teams}
+    set_number = 1
+    match_time = 0
+    while match_time < 60 and max(sets.values()) < 3:
+        team1, team2 = rng.sample(teams, 2)
+        set_scores = {team1[0]: 0, team2[0]: 0}
+        while match_time < 60 and (max(set_scores.values()) < 25 or abs(set_scores[team1[0]] - set_scores[team2[0]]) < 2):
+            match_time += rng.uniform(1, 3)
+            if rng.random() < 0.1:
+                fouling_team = team1 if rng.random() < 0.5 else team2
+                scoring_team = team2 if fouling_team == team1 else team1
+                kind, action = 'foul', f"{fouling_team[0]} service fault!"
             else:
-                win_streak = 0
-            update_team(conn, team[0], wins, win_streak, power)
-
-        for team in teams:
-            if team[1]:
-                player = get_player(conn, team[1])
-                coins_change = 5 if team[0] == winner_id else 1 if winner_id is None else -2
-                new_coins = max(player[12] + coins_change, 0)
-                update_player(conn, team[1], player[1], player[2], player[3], player[4], player[5], player[6], player[7],
-                             player[8], player[9], player[10], player[11], new_coins, player[13], player[14], player[15], player[16])
-
-        wagers = get_wagers(conn, match_id)
-        for wager in wagers:
-            player = get_player(conn, wager[1])
-            if wager[3] == winner_id:
-                new_coins = player[12] + wager[4] * 2
-                update_player(conn, wager[1], player[1], player[2], player[3], player[4], player[5], player[6], player[7],
-                             player[8], player[9], player[10], player[11], new_coins, player[13], player[14], player[15], player[16])
-                await context.bot.send_message(chat_id=chat_id, text=f"@{player[1]} won {wager[4]*2} {group_name} coins from wager!")
+                scoring_team = team1 if rng.random() < _chance(team1, team2) else team2
+                kind, action = 'score', f"{scoring_team[0]} scores on a serve!"
+            scores[scoring_team[0]] += 1
+            set_scores[scoring_team[0]] += 1
+            events.append(MatchEvent(match_time, kind, scoring_team[0],
+                                     f"{sport} set {set_number}: {team1[0]} {set_scores[team1[0]]} - {team2[0]} {set_scores[team2[0]]}, {action}", 1))
+        sets[team1[0] if set_scores[team1[0]] > set_scores[team2[0]] else team2[0]] += 1
+        set_number += 1
+    winner = next((name for name, won in sets.items() if won >= 3), None)
+    return MatchResult(winner, scores, sets, None)
+
+def _simulate_basketball(sport, teams, rng, events):
+    scores = {name: 0 for name, power in teams}
+    for quarter in range(1, 5):
+        quarter_time = 0
+        while quarter_time < 15:
+            quarter_time += rng.uniform(1, 3)
+            clock = (quarter - 1) * 15 + quarter_time
+            team1, team2 = rng.sample(teams, 2)
+            prefix = f"{sport} quarter {quarter} (0:{max(15 - quarter_time, 0):.0f}):"
+            if rng.random() < 0.15:
+                fouling_team = team1 if rng.random() < 0.5 else team2
+                other_team = team2 if fouling_team == team1 else team1
+                free_throws = rng.randint(1, 2)
+                events.append(MatchEvent(clock, 'foul', fouling_team[0],
+                                         f"{prefix} {other_team[0]} {scores[other_team[0]]} - {fouling_team[0]} {scores[fouling_team[0]]}, {fouling_team[0]} commits a foul!"))
+                for _ in range(free_throws):
+                    if rng.random() < 0.7:
+                        scores[other_team[0]] += 1
+                        events.append(MatchEvent(clock, 'score', other_team[0],
+                                                 f"{prefix} {other_team[0]} {scores[other_team[0]]} - {fouling_team[0]} {scores[fouling_team[0]]}, {other_team[0]} scores a free throw!", 1))
+            elif rng.random() < 0.2:
+                shooting_team = team1 if rng.random() < _chance(team1, team2) else team2
+                other_team = team2 if shooting_team == team1 else team1
+                events.append(MatchEvent(clock, 'miss', shooting_team[0],
+                                         f"{prefix} {shooting_team[0]} {scores[shooting_team[0]]} - {other_team[0]} {scores[other_team[0]]}, {shooting_team[0]} airball!"))
             else:
-                await context.bot.send_message(chat_id=chat_id, text=f"@{player[1]} lost {wager[4]} {group_name} coins from wager.")
+                scoring_team = team1 if rng.random() < _chance(team1, team2) else team2
+                other_team = team2 if scoring_team == team1 else team1
+                points = rng.choice([2, 3])
+                scores[scoring_team[0]] += points
+                events.append(MatchEvent(clock, 'score', scoring_team[0],
+                                         f"{prefix} {scoring_team[0]} {scores[scoring_team[0]]} - {other_team[0]} {scores[other_team[0]]}, {scoring_team[0]} scores {points} points!", points))
+        events.append(MatchEvent(quarter * 15, 'period', None,
+                                 f"{sport} quarter {quarter} ends: " + ", ".join(f"{name} {score}" for name, score in scores.items())))
+    return MatchResult(sole_leader(scores), scores, None, None)
 
-        final_text = f"{sport} final result:\n"
-        if is_racing:
-            sorted_teams = sorted(distances.items(), key=lambda x: x[1], reverse=True)
-            for i, (team, distance) in enumerate(sorted_teams, 1):
-                final_text += f"{i}st: {team} ({distance:.0f}m)\n"
+def _simulate_soccer(sport, teams, rng, events):
+    scores = {name: 0 for name, power in teams}
+    match_time = 0
+    while match_time < 60:
+        match_time += rng.uniform(1, 3)
+        team1, team2 = rng.sample(teams, 2)
+        team1_chance = _chance(team1, team2)
+        prefix = f"{sport} (0:{max(60 - match_time, 0):.0f}):"
+        if rng.random() < 0.1:
+            fouling_team = team1 if rng.random() < 0.5 else team2
+            other_team = team2 if fouling_team == team1 else team1
+            events.append(MatchEvent(match_time, 'foul', fouling_team[0],
+                                     f"{prefix} {other_team[0]} {scores[other_team[0]]} - {fouling_team[0]} {scores[fouling_team[0]]}, {fouling_team[0]} commits a foul!"))
+            if rng.random() < 0.2:
+                scores[other_team[0]] += 1
+                events.append(MatchEvent(match_time, 'score', other_team[0],
+                                         f"{prefix} {other_team[0]} {scores[other_team[0]]} - {fouling_team[0]} {scores[fouling_team[0]]}, {other_team[0]} scores a penalty goal!", 1))
+        elif rng.random() < 0.2:
+            shooting_team = team1 if rng.random() < team1_chance else team2
+            other_team = team2 if shooting_team == team1 else team1
+            events.append(MatchEvent(match_time, 'miss', shooting_team[0],
+                                     f"{prefix} {shooting_team[0]} {scores[shooting_team[0]]} - {other_team[0]} {scores[other_team[0]]}, {shooting_team[0]} shot missed!"))
         else:
-            final_text += ", ".join(f"{team[2]}: {scores[team[2]]}" for team in teams) + "\n"
-            if sport == 'volleyball':
-                final_text += "Sets: " + ", ".join(f"{team[2]} {sets[team[2]]}" for team in teams) + "\n"
-            final_text += f"Winner: {next(team[2] for team in teams if team[0] == winner_id) if winner_id else 'tie'}!\n"
-            if timeline:
-                final_text += "\nMatch timeline:\n" + "\n".join(timeline)
-        await context.bot.send_message(chat_id=chat_id, text=final_text)
-        update_match(conn, match_id, 'closed')
-        conn.close()
-    except Exception as e:
-        logger.error(f"Error in simulate_match for match {match_id}: {str(e)}")
-        await update.message.reply_text("Error during match simulation.")
+            for scoring_team, chance in ((team1, team1_chance), (team2, 1 - team1_chance)):
+                if rng.random() < chance * 0.02:
+                    scores[scoring_team[0]] += 1
+                    events.append(MatchEvent(match_time, 'score', scoring_team[0],
+                                             f"{prefix} {team1[0]} {scores[team1[0]]} - {team2[0]} {scores[team2[0]]}, {scoring_team[0]} scores a goal!", 1))
+                    break
+    return MatchResult(sole_leader(scores), scores, None, None)
 
-async def random_match_event(context: ContextTypes.DEFAULT_TYPE):
-    try:
-        conn = sqlite3.connect('battle_forge.db')
-        c = conn.cursor()
-        c.execute('SELECT team_id, name FROM teams')
-        teams = c.fetchall()
-        if len(teams) < 2:
-            conn.close()
-            return
-        sport = random.choice(['basketball', 'soccer', 'volleyball', 'f1_racing', 'horse_racing', 'boxing'])
-        num_teams = random.randint(2, 4) if sport in ['f1_racing', 'horse_racing'] else 2
-        selected_teams = random.sample(teams, num_teams)
-        team_ids = [team[0] for team in selected_teams]
-        match_id = create_match(conn, sport, team_ids[0], num_teams)
-        team_ids = team_ids[:1]
-        update_match(conn, match_id, 'open', team_ids=team_ids)
-        await context.bot.send_message(
-            chat_id=context.job.chat_id,
-            text=f"Random {sport} match for {num_teams} teams! {selected_teams[0][1]} has joined. Use /acceptsport {match_id} to join! Use /gamble {match_id} <team_name> <amount> to bet!"
-        )
-        conn.close()
-        await asyncio.sleep(30)
-        conn = sqlite3.connect('battle_forge.db')
-        c = conn.cursor()
-        c.execute('SELECT team_ids FROM matches WHERE match_id = ?', (match_id,))
-        team_ids = json.loads(c.fetchone()[0])
-        if len(team_ids) < 2:
-            await context.bot.send_message(chat_id=context.job.chat_id, text=f"Match {match_id} cancelled: not enough teams joined.")
-            update_match(conn, match_id, 'closed')
-            conn.close()
-            return
-        conn.close()
-        await simulate_match(context.job.context, context, match_id, sport, team_ids)
-    except Exception as e:
-        logger.error(f"Error in random_match_event: {str(e)}")
+def _simulate_boxing(sport, teams, rng, events):
+    scores = {name: 0 for name, power in teams}
+    hits = {name: 0 for name, power in teams}
+    match_time = 0
+    while match_time < 60:
+        match_time += rng.uniform(1, 3)
+        team1, team2 = rng.sample(teams, 2)
+        prefix = f"{sport} (0:{max(60 - match_time, 0):.0f}):"
+        if rng.random() < 0.1:
+            fouling_team = team1 if rng.random() < 0.5 else team2
+            other_team = team2 if fouling_team == team1 else team1
+            scores[other_team[0]] += 1
+            events.append(MatchEvent(match_time, 'foul', other_team[0],
+                                     f"{prefix} {other_team[0]} {scores[other_team[0]]} - {fouling_team[0]} {scores[fouling_team[0]]}, {fouling_team[0]} illegal move!", 1))
+        else:
+            hitting_team = team1 if rng.random() < _chance(team1, team2) else team2
+            other_team = team2 if hitting_team == team1 else team1
+            hits[hitting_team[0]] += rng.randint(0, 3)
+            punch = 'jab' if rng.random() < 0.5 else 'hook'
+            events.append(MatchEvent(match_time, 'hit', hitting_team[0],
+                                     f"{prefix} {hitting_team[0]} {scores[hitting_team[0]]} - {other_team[0]} {scores[other_team[0]]}, {hitting_team[0]} lands a {punch}!"))
+            if hits[hitting_team[0]] >= 3 and rng.random() < 0.5:
+                scores[hitting_team[0]] += 10
+                events.append(MatchEvent(match_time, 'knockout', hitting_team[0],
+                                         f"{prefix} {hitting_team[0]} {scores[hitting_team[0]]} - {other_team[0]} {scores[other_team[0]]}, {hitting_team[0]} scores a knockout (10 points)!", 10))
+                break
+    return MatchResult(sole_leader(scores), scores, None, None)
 
-# Command handlers
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        group_name = update.effective_chat.title or "group"
-        player_id = update.effective_user.id
-        username = update.effective_user.username or f"user_{player_id}"
-        conn = sqlite3.connect('battle_forge.db')
+SPORT_SIMULATORS = {
+    'basketball': _simulate_basketball,
+    'soccer': _simulate_soccer,
+    'volleyball': _simulate_volleyball,
+    'f1_racing': _simulate_racing,
+    'horse_racing': _simulate_racing,
+    'boxing': _simulate_boxing,
+}
+
+def play_match(sport, teams, seed=None):
+    # teams: [(name, power), ...] -> ([MatchEvent, ...], MatchResult)
+    if sport not in SPORT_SIMULATORS:
+        raise ValueError(f"Unknown sport: {sport}")
+    events = []
+    result = SPORT_SIMULATORS[sport](sport, teams, random.Random(seed), events)
+    return events, result
+
+def final_result_text(sport, result, match_id):
+    # The timeline isn't included (a long match would not fit one message);
+    # /matchlog pages through it instead
+    final_text = f"{sport} final result:\n"
+    if result.distances is not None:
+        for i, (team, distance) in enumerate(sorted(result.distances.items(), key=lambda x: x[1], reverse=True), 1):
+            final_text += f"{ordinal(i)}: {team} ({distance:.0f}m)\n"
+    else:
+        final_text += ", ".join(f"{team}: {score}" for team, score in result.scores.items()) + "\n"
+        if result.sets is not None:
+            final_text += "Sets: " + ", ".join(f"{team} {won}" for team, won in result.sets.items()) + "\n"
+        final_text += f"Winner: {result.winner or 'tie'}!\n"
+    final_text += f"Match timeline: /matchlog {match_id}"
+    return final_text
+
+async def present_match(live, events, pace=MATCH_PACE, offset=0, log=None):
+    # Replays events on the live message, waiting out the match clock scaled
+    # by pace (0 replays instantly); events up to offset on the match clock
+    # have been shown already. Every event also goes to the log, if given.
+    clock = offset
+    for seq, event in enumerate(events):
+        if log is not None and log.add(seq, event):
+            await log.flush()
+        if event.clock <= offset:
+            continue
+        if event.clock > clock and pace:
+            await asyncio.sleep((event.clock - clock) * pace)
+        clock = max(clock, event.clock)
+        live.update(event.text)
+    if log is not None:
+        await log.flush()
+
+# Match event log
+# Events are stored in match_events as they are shown, in a compact encoding
+# of (seq, clock in tenths of a second, kind code, team index, points) rather
+# than text, and written in batches. /matchlog renders pages of it on demand.
+# A resumed match logs its events again from the start; rows already stored
+# are skipped.
+MATCH_EVENT_KINDS = ['score', 'foul', 'miss', 'period', 'tick', 'hit', 'knockout']
+MATCH_LOG_BATCH = int(os.getenv('BATTLE_FORGE_MATCH_LOG_BATCH', '20'))
+MATCH_LOG_PAGE_SIZE = int(os.getenv('BATTLE_FORGE_MATCH_LOG_PAGE_SIZE', '25'))
+
+def record_match_events(conn, match_id, rows):
+    c = conn.cursor()
+    c.executemany('INSERT OR IGNORE INTO match_events (match_id, seq, clock, kind, team, points) VALUES (?, ?, ?, ?, ?, ?)',
+                  [(match_id,) + row for row in rows])
+
+class MatchLog:
+    def __init__(self, match_id, team_names, batch=MATCH_LOG_BATCH):
+        self.match_id = match_id
+        self.batch = batch
+        self.pending = []
+        self._team_index = {name: index for index, name in enumerate(team_names)}
+
+    def add(self, seq, event):
+        # Returns True once a batch is ready to flush
+        self.pending.append((seq, round(event.clock * 10), MATCH_EVENT_KINDS.index(event.kind),
+                             self._team_index.get(event.team), event.points))
+        return len(self.pending) >= self.batch
+
+    async def flush(self):
+        rows, self.pending = self.pending, []
+        if not rows:
+            return
         try:
-            player = get_player(conn, player_id)
-            if not player:
-                initialize_player_citizens(conn, player_id)
-                create_team(conn, player_id, f"@{username}_team")
-                update_player(conn, player_id, username, 0, 0, 100, 100, 100, 100, 'medium', 'medium', 'medium', 'medium', 10, 0, None, None, None)
-            logger.debug(f"Start command by player {player_id} in chat {update.effective_chat.id}")
-            await update.message.reply_text(
-                f"Welcome to BattleForgeBot in {group_name}! ⚔️\n"
-                f"Currency: {group_name} coin\n"
-                "Commands:\n"
-                "/collectresources - Collect sperms and eggs every 24h\n"
-                "/collectsupplies - Collect water, food, medicine, ore every 12h\n"
-                "/merge <sperms> <eggs> - Create babies\n"
-                "/upgradequality <resource> - Upgrade resource quality\n"
-                "/mystats - View resources, population, coins\n"
-                "/currencies - View all players' coin values\n"
-                "/sellable - View items available for trading\n"
-                "/trade <item> <quantity> <price> - Offer a trade\n"
-                "/accepttrade <trade_id> - Accept a trade\n"
-                "/war <opponent_player_id> <fighter_count> - Start a war\n"
-                "/sportevent <sport> <num_teams> - Create a sport match\n"
-                "/acceptsport <match_id> - Join a sport match\n"
-                "/teamstats - View your team stats\n"
-                "/gamble <match_id> <team_name> <amount> - Bet on a match\n"
-                "/leaderboard - Top players by coins and wins"
-            )
-            if update.effective_chat.id not in context.job_queue.get_jobs_by_name(f"random_match_{update.effective_chat.id}"):
-                context.job_queue.run_repeating(
-                    random_match_event,
-                    interval=random.randint(5*3600, 6*3600),
-                    first=0,
-                    context=update,
-                    name=f"random_match_{update.effective_chat.id}",
-                    job_kwargs={"chat_id": update.effective_chat.id}
-                )
-        finally:
-            conn.close()
-    except Exception as e:
-        logger.error(f"Error in start command: {str(e)}")
-        await update.message.reply_text("An error occurred. Please try again.")
+            await db.write(record_match_events, self.match_id, rows)
+        except Exception as e:
+            logger.error(f"Error logging {len(rows)} events for match {self.match_id}: {str(e)}")
 
-async def collectresources(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    player_id = update.effective_user.id
-    username = update.effective_user.username or f"user_{player_id}"
-    conn = sqlite3.connect('battle_forge.db')
+def get_match_events(conn, match_id, offset, limit):
+    # -> (total, [(clock, kind, team, points, team 0 score, team 1 score)]),
+    # with both running scores as of each event
+    c = conn.cursor()
+    c.execute('SELECT COUNT(*) FROM match_events WHERE match_id = ?', (match_id,))
+    total = c.fetchone()[0]
+    tick = MATCH_EVENT_KINDS.index('tick')
+    c.execute('''SELECT clock, kind, team, points,
+                        SUM(CASE WHEN team = 0 AND kind != ? THEN points ELSE 0 END) OVER running,
+                        SUM(CASE WHEN team = 1 AND kind != ? THEN points ELSE 0 END) OVER running
+                 FROM match_events WHERE match_id = ?
+                 WINDOW running AS (ORDER BY seq)
+                 ORDER BY seq LIMIT ? OFFSET ?''', (tick, tick, match_id, limit, offset))
+    return total, c.fetchall()
+
+def match_log_line(names, clock, kind, team, points, scores):
+    name = names[team] if team is not None and team < len(names) else "?"
+    kind = MATCH_EVENT_KINDS[kind]
+    if kind == 'tick':
+        text = f"{name} leads at {points}m"
+    elif kind == 'score':
+        text = f"{name} scores {points}"
+    elif kind == 'knockout':
+        text = f"{name} knockout! (+{points})"
+    elif kind == 'foul':
+        text = f"foul, point to {name}" if points else f"{name} commits a foul"
+    elif kind == 'miss':
+        text = f"{name} misses"
+    elif kind == 'hit':
+        text = f"{name} lands a punch"
+    else:
+        text = "end of period"
+    if kind in ('score', 'knockout', 'period') or (kind == 'foul' and points):
+        text += f" ({names[0]} {scores[0]} - {names[1]} {scores[1]})"
+    return f"{clock // 600}:{clock // 10 % 60:02d} {text}"
+
+# Match odds
+# Win probabilities come from Monte Carlo trials of the match engine's rules,
+# vectorized over trials with NumPy instead of replaying play_match. Every
+# step of a match draws its outcome independently given the teams, so the
+# step-based sports reduce to one multinomial draw over per-step outcomes;
+# only boxing, where a knockout ends the match, walks its steps (still across
+# all trials at once). Odds are cached per match line-up and dropped when a
+# team's power changes.
+#
+# Bets pay (1 - house edge) / p. The flat 2x bets used to pay returned, on an
+# even head-to-head, 97% of the stake in basketball, 55% in soccer and all of
+# it in racing and boxing: about 90% across the sports, so the edge is 10%.
+ODDS_TRIALS = int(os.getenv('BATTLE_FORGE_ODDS_TRIALS', '10000'))
+ODDS_CACHE_SIZE = int(os.getenv('BATTLE_FORGE_ODDS_CACHE_SIZE', '4096'))
+ODDS_MAX_MULTIPLIER = float(os.getenv('BATTLE_FORGE_ODDS_MAX_MULTIPLIER', '50'))
+ODDS_HOUSE_EDGE = float(os.getenv('BATTLE_FORGE_ODDS_HOUSE_EDGE', '0.1'))
+
+MatchOdds = namedtuple('MatchOdds', ['team_ids', 'probabilities', 'tie', 'multipliers'])
+
+_step_count_tables = {}
+
+def _step_counts(rng, duration, trials):
+    # The engine adds uniform(1, 3) seconds per step until the clock reaches
+    # duration. How many steps that takes doesn't depend on the teams, so
+    # it's sampled from a table built once per duration.
+    table = _step_count_tables.get(duration)
+    if table is None:
+        clocks = np.cumsum(np.random.default_rng(duration).uniform(1, 3, (20000, duration)), axis=1)
+        table = _step_count_tables[duration] = 1 + (clocks < duration).sum(axis=1)
+    return rng.choice(table, trials)
+
+def _clip(probability):
+    return min(max(probability, 0.0), 1.0)
+
+def _leaders(scores):
+    # Index of the sole top score per trial, -1 on a tie
+    winners = scores.argmax(axis=1)
+    tied = (scores == scores.max(axis=1, keepdims=True)).sum(axis=1) > 1
+    return np.where(tied, -1, winners)
+
+_race_total_table = None
+
+def _race_totals(rng, shape):
+    # A team's unscaled race distance, the sum of RACING_TICKS strides of
+    # 10-50m, drawn once from its exact distribution rather than stride by
+    # stride, so big fields stay cheap
+    global _race_total_table
+    if _race_total_table is None:
+        pmf = np.ones(1)
+        for tick in range(RACING_TICKS):
+            pmf = np.convolve(pmf, np.full(41, 1 / 41))
+        counts = np.diff(np.round(np.cumsum(pmf) * (1 << 20)).astype(np.int64), prepend=0)
+        _race_total_table = np.repeat(np.arange(len(pmf), dtype=np.int16) + 10 * RACING_TICKS, counts)
+    return _race_total_table[rng.integers(0, len(_race_total_table), shape)]
+
+def _trials_racing(rng, powers, trials):
+    factors = 1 + (np.asarray(powers, dtype=float) - 100) / 200
+    return (_race_totals(rng, (trials, len(powers))) * factors).argmax(axis=1)
+
+def _trials_soccer(rng, powers, trials):
+    a_first = 0.5 + (powers[0] - powers[1]) / 200  # team1's chance with A as team1
+    b_first = 1 - a_first
+    # Open play (no foul, no miss): team1 scores at chance * 0.02, else team2 at (1 - chance) * 0.02
+    a_goal = 0.5 * (_clip(a_first * 0.02) + (1 - _clip(b_first * 0.02)) * _clip(a_first * 0.02))
+    b_goal = 0.5 * (_clip(b_first * 0.02) + (1 - _clip(a_first * 0.02)) * _clip(b_first * 0.02))
+    p_a = 0.1 * 0.2 * 0.5 + 0.9 * 0.8 * a_goal
+    p_b = 0.1 * 0.2 * 0.5 + 0.9 * 0.8 * b_goal
+    goals = rng.multinomial(_step_counts(rng, 60, trials), [p_a, p_b, 1 - p_a - p_b])
+    return _leaders(goals[:, :2])
+
+def _step_table(probabilities, values, resolution=1 << 16):
+    # Lookup table turning a uniform integer in [0, resolution) into the value
+    # of the outcome it falls in (probabilities in order, then "nothing", 0)
+    bounds = np.round(np.cumsum(probabilities) * resolution).astype(np.int64)
+    table = np.zeros(resolution, dtype=np.int8)
+    start = 0
+    for bound, value in zip(bounds, values):
+        table[start:bound] = value
+        start = bound
+    return table
+
+def _active_steps(steps):
+    return np.arange(steps.max()) < steps[:, None]
+
+def _trials_basketball(rng, powers, trials):
+    p_a = _clip(0.5 + (powers[0] - powers[1]) / 200)
+    # A foul gives the other side one or two free throws at 70%: 0, 1 or 2 points
+    free_throws = [0.5 * 0.3 + 0.5 * 0.09, 0.5 * 0.7 + 0.5 * 0.42, 0.5 * 0.49]
+    foul = 0.15 * 0.5
+    shot = 0.85 * 0.8 * 0.5
+    # Only the point difference decides the winner: +points for A, -points for B
+    table = _step_table([foul * free_throws[1], foul * free_throws[2] + shot * p_a, shot * p_a,
+                         foul * free_throws[1], foul * free_throws[2] + shot * (1 - p_a), shot * (1 - p_a)],
+                        [1, 2, 3, -1, -2, -3])
+    steps = sum(_step_counts(rng, 15, trials) for quarter in range(4))
+    draws = rng.integers(0, len(table), (trials, steps.max()), dtype=np.uint16)
+    margin = (table.take(draws) * _active_steps(steps)).sum(axis=1)
+    return np.where(margin > 0, 0, np.where(margin < 0, 1, -1))
+
+def _trials_boxing(rng, powers, trials):
+    p_a = _clip(0.5 + (powers[0] - powers[1]) / 200)
+    # Each step is one 16-bit draw: the top 13 bits pick B's foul (a point for
+    # A), A's foul, A's punch or B's punch; the low 2 bits are the punch's
+    # hits and bit 2 the knockout roll, which lands at 50% once the puncher
+    # has 3 hits. A knockout ends the match, and most matches end that way
+    # within a few steps, so each step only draws for the trials still going.
+    table = _step_table([0.05, 0.05, 0.9 * p_a, 0.9 * (1 - p_a)], [0, 1, 2, 3], resolution=1 << 13)
+    steps = _step_counts(rng, 60, trials)
+    scores = np.zeros((trials, 2), dtype=np.int64)
+    hits = np.zeros((trials, 2), dtype=np.int64)
+    standing = np.arange(trials)
+    for step in range(steps.max()):
+        standing = standing[steps[standing] > step]
+        if not len(standing):
+            break
+        draws = rng.integers(0, 1 << 16, len(standing), dtype=np.uint16)
+        kind = table.take(draws >> 3)
+        fouls = kind < 2
+        np.add.at(scores, (standing[fouls], kind[fouls]), 1)
+        punches = ~fouls
+        side = kind[punches] - 2
+        punchers = standing[punches]
+        hits[punchers, side] += draws[punches] & 3
+        knockout = (hits[punchers, side] >= 3) & (draws[punches] & 4).astype(bool)
+        scores[punchers[knockout], side[knockout]] += 10
+        standing = np.setdiff1d(standing, punchers[knockout], assume_unique=True)
+    return _leaders(scores)
+
+def _trials_volleyball(rng, powers, trials):
+    # Three sets take at least 75 points at one point per second or slower,
+    # more than the 60 second match, so every volleyball match is a tie
+    return np.full(trials, -1)
+
+SPORT_TRIALS = {
+    'basketball': _trials_basketball,
+    'soccer': _trials_soccer,
+    'volleyball': _trials_volleyball,
+    'f1_racing': _trials_racing,
+    'horse_racing': _trials_racing,
+    'boxing': _trials_boxing,
+}
+
+def estimate_odds(sport, powers, trials=ODDS_TRIALS, seed=None):
+    # -> (win probability per team, tie probability)
+    winners = SPORT_TRIALS[sport](np.random.default_rng(seed), powers, trials)
+    wins = np.bincount(winners[winners >= 0], minlength=len(powers))
+    return wins / trials, float((winners < 0).mean())
+
+def payout_multiplier(probability):
+    # None when the team practically can't win; never less than the stake back
+    if probability <= 0:
+        return None
+    return round(min(max((1 - ODDS_HOUSE_EDGE) / probability, 1), ODDS_MAX_MULTIPLIER), 2)
+
+class OddsCache:
+    def __init__(self, capacity, trials):
+        self.capacity = capacity
+        self.trials = trials
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._by_team = {}
+        self._lock = threading.Lock()
+
+    def get(self, sport, teams):
+        # teams: team rows in match order
+        key = (sport, tuple(team[0] for team in teams))
+        powers = tuple(team[5] for team in teams)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == powers:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        probabilities, tie = estimate_odds(sport, powers, self.trials)
+        odds = MatchOdds(key[1], tuple(float(p) for p in probabilities), tie,
+                         tuple(payout_multiplier(p) for p in probabilities))
+        with self._lock:
+            self._entries[key] = (powers, odds)
+            self._entries.move_to_end(key)
+            for team_id in key[1]:
+                self._by_team.setdefault(team_id, set()).add(key)
+            while len(self._entries) > self.capacity:
+                self._forget(next(iter(self._entries)))
+        return odds
+
+    def _forget(self, key):
+        self._entries.pop(key, None)
+        for team_id in key[1]:
+            keys = self._by_team.get(team_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_team[team_id]
+
+    def invalidate(self, team_id):
+        with self._lock:
+            for key in list(self._by_team.get(team_id, ())):
+                self._forget(key)
+
+odds_cache = OddsCache(ODDS_CACHE_SIZE, ODDS_TRIALS)
+
+def calculate_currency_value(player, population):
     try:
-        player = get_player(conn, player_id)
-        if not can_collect_resources(player):
-            logger.debug(f"Player {player_id} tried to collect resources too soon")
-            await update.message.reply_text("You've already collected resources in the last 24 hours!")
+        total_supplies = player[4] + player[5] + player[6] + player[7] * 2
+        return total_supplies / max(population, 1)
+    except Exception as e:
+        logger.error(f"Error calculating currency value for player {player[1]}: {str(e)}")
+        return 1.0
+
+SETTLEMENT_SUMMARY_WINNERS = int(os.getenv('BATTLE_FORGE_SETTLEMENT_SUMMARY_WINNERS', '50'))
+
+def credit_wagers(conn, match_id, team_id=None):
+    # Credits a match's wagers in bulk: the payout (amount * multiplier) of
+    # every wager on team_id, or every stake back when team_id is None.
+    # Returns [(player_id, username, credited, wagers)], biggest first.
+    # Players with a cached row are credited through the cache, so a later
+    # flush doesn't overwrite the payout; everyone else gets one UPDATE.
+    credited = 'CAST(amount * multiplier AS INTEGER)' if team_id is not None else 'amount'
+    on_team = 'AND team_id = ?' if team_id is not None else ''
+    params = (match_id, team_id) if team_id is not None else (match_id,)
+    totals = f'''SELECT player_id, SUM({credited}) AS credited, COUNT(*) AS wagers FROM wagers
+                 WHERE match_id = ? {on_team} GROUP BY player_id'''
+    c = conn.cursor()
+    c.execute(f'''SELECT totals.player_id, players.username, totals.credited, totals.wagers
+                  FROM ({totals}) AS totals JOIN players ON players.player_id = totals.player_id
+                  ORDER BY totals.credited DESC''', params)
+    rows = c.fetchall()
+    cached = player_cache.cached([row[0] for row in rows])
+    for player_id, username, amount, wagers in rows:
+        if player_id in cached:
+            add_coins(conn, player_id, amount)
+    c.execute(f'''UPDATE players SET coins = coins + totals.credited FROM ({totals}) AS totals
+                  WHERE players.player_id = totals.player_id
+                  AND players.player_id NOT IN (SELECT value FROM json_each(?))
+                  RETURNING players.player_id, players.coins, players.war_wins''', params + (json.dumps(list(cached)),))
+    for row in c.fetchall():
+        rankings.stage(*row)
+    return rows
+
+def refund_wagers(conn, match_id):
+    return sum(row[3] for row in credit_wagers(conn, match_id))
+
+def settlement_summary(match_id, teams, winner_id, winners, lost, group_name):
+    # One announcement for all wagers, split to fit Telegram's message limit
+    lines = []
+    if winner_id is None:
+        lines.append(f"Match {match_id} ended in a tie: all {lost[0]} wagers ({lost[1]} {group_name} coins) are lost.")
+    else:
+        winner = next(team[2] for team in teams if team[0] == winner_id)
+        paid = sum(row[2] for row in winners)
+        if winners:
+            lines.append(f"Wagers on match {match_id}: {len(winners)} players backed {winner} and won {paid} {group_name} coins.")
+        else:
+            lines.append(f"Wagers on match {match_id}: nobody backed {winner}.")
+        for player_id, username, amount, wagers in winners[:SETTLEMENT_SUMMARY_WINNERS]:
+            lines.append(f"@{username} won {amount} {group_name} coins")
+        if len(winners) > SETTLEMENT_SUMMARY_WINNERS:
+            lines.append(f"...and {len(winners) - SETTLEMENT_SUMMARY_WINNERS} more winners")
+        if lost[0]:
+            lines.append(f"{lost[0]} wagers on other teams lost {lost[1]} {group_name} coins.")
+    return chunk_lines(lines)
+
+def record_team_results(conn, teams, winner_id):
+    for team in teams:
+        wins = team[3]
+        win_streak = team[4]
+        power = team[5]
+        if team[0] == winner_id:
+            wins += 1
+            win_streak += 1
+            power += 10
+        elif winner_id is None:
+            win_streak = 0
+        else:
+            win_streak = 0
+        update_team(conn, team[0], wins, win_streak, power)
+
+def settle_match_tx(conn, match_id, teams, winner_id, group_name, scores=None):
+    # Returns the settlement announcement so it can be sent once committed,
+    # or None if the match isn't running (already settled or cancelled).
+    # scores are kept with the match, in team order.
+    c = conn.cursor()
+    c.execute("UPDATE matches SET status = 'settled', winner_team_id = ?, scores = ? WHERE match_id = ? AND status = 'running'",
+              (winner_id, json.dumps(scores) if scores is not None else None, match_id))
+    if c.rowcount == 0:
+        return None
+    record_team_results(conn, teams, winner_id)
+
+    for team in teams:
+        if team[1]:
+            coins_change = 5 if team[0] == winner_id else 1 if winner_id is None else -2
+            add_coins(conn, team[1], coins_change, clamp=True)
+
+    c.execute('SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM wagers WHERE match_id = ? AND team_id IS NOT ?',
+              (match_id, winner_id))
+    lost = c.fetchone()
+    winners = credit_wagers(conn, match_id, winner_id) if winner_id is not None else []
+    if not winners and not lost[0]:
+        return []
+    logger.debug(f"Settled match {match_id}: {len(winners)} winning players, {lost[0]} losing wagers")
+    return settlement_summary(match_id, teams, winner_id, winners, lost, group_name)
+
+def start_match_tx(conn, match_id):
+    # scheduled (or due open) -> running, with the seed its events come from.
+    # Empty places in a race go to AI teams. Returns (match, understaffed): a
+    # due open match with fewer than two teams is cancelled instead.
+    match = get_match(conn, match_id)
+    if not match or match[4] not in ('open', 'scheduled'):
+        return match, False
+    if match[1] in RACING_SPORTS:
+        update_match(conn, match_id, match[4], team_ids=fill_with_ai_teams(conn, json.loads(match[2]), match[3]))
+        match = get_match(conn, match_id)
+    if len(json.loads(match[2])) < 2:
+        update_match(conn, match_id, 'cancelled')
+        refund_wagers(conn, match_id)
+        return get_match(conn, match_id), True
+    c = conn.cursor()
+    c.execute("UPDATE matches SET status = 'running', seed = ?, started_at = ? WHERE match_id = ?",
+              (random.getrandbits(32), datetime.now().isoformat(), match_id))
+    return get_match(conn, match_id), False
+
+def set_live_message_tx(conn, match_id, message_id):
+    c = conn.cursor()
+    c.execute('UPDATE matches SET last_update_message_id = ? WHERE match_id = ?', (message_id, match_id))
+
+def cancel_match_tx(conn, match_id):
+    # Cancels a match that hasn't been settled and refunds its wagers
+    c = conn.cursor()
+    c.execute("UPDATE matches SET status = 'cancelled' WHERE match_id = ? AND status IN ('open', 'scheduled', 'running')", (match_id,))
+    if c.rowcount == 0:
+        return None
+    return refund_wagers(conn, match_id)
+
+async def run_match(bot, match):
+    # Presents a running match and settles it. A match resumed after a
+    # restart replays the same events from its seed and picks up where the
+    # live message was.
+    match_id, sport, chat_id, group_name, seed = match[0], match[1], match[7], match[8] or "group", match[9]
+    teams = await db.read(get_teams, json.loads(match[2]))
+    events, result = play_match(sport, [(team[2], team[5]) for team in teams], seed)
+    logger.debug(f"Match {match_id} ({sport}) seed {seed}: {len(events)} events, winner {result.winner}")
+    if match[6]:
+        live = LiveMessage(outbox, bot, chat_id, match[6], None)
+        elapsed = (datetime.now() - datetime.fromisoformat(match[11])).total_seconds()
+        offset = elapsed / MATCH_PACE if MATCH_PACE else float('inf')
+    else:
+        # One live message per match, edited as the match goes on
+        names = [team[2] for team in teams]
+        field = ', '.join(names[:RACING_TOP_N * 2]) + (f" and {len(names) - RACING_TOP_N * 2} more" if len(names) > RACING_TOP_N * 2 else "")
+        live = await outbox.open_live(bot, chat_id, f"{sport} match started: {field}!")
+        await db.write(set_live_message_tx, match_id, live.message_id)
+        offset = 0
+    await present_match(live, events, offset=offset, log=MatchLog(match_id, [team[2] for team in teams]))
+    await live.close()
+    winner_id = next((team[0] for team in teams if team[2] == result.winner), None)
+    scores = result.scores if result.scores is not None else result.distances
+    messages = await db.write(settle_match_tx, match_id, teams, winner_id, group_name,
+                              [round(scores[team[2]]) for team in teams])
+    if messages is None:
+        return
+    for text in messages + chunk_lines(final_result_text(sport, result, match_id).split('\n')):
+        await outbox.send(bot, chat_id, text)
+
+# Match supervisor
+# Matches run as background tasks owned by the supervisor rather than inside
+# the handler that filled them. A match goes open -> scheduled -> running ->
+# settled (or cancelled), and each step is written to the matches table
+# before it happens, so after a restart resume() picks every unfinished match
+# up again: scheduled ones wait out their start, running ones replay from
+# their seed. At most max_running matches are presented at once; the rest
+# wait for a slot.
+MATCH_START_DELAY = float(os.getenv('BATTLE_FORGE_MATCH_START_DELAY', '30'))
+MAX_RUNNING_MATCHES = int(os.getenv('BATTLE_FORGE_MAX_RUNNING_MATCHES', '20'))
+
+class MatchSupervisor:
+    def __init__(self, max_running, start_delay):
+        self.max_running = max_running
+        self.start_delay = start_delay
+        self._slots = asyncio.Semaphore(max_running)
+        self._tasks = {}
+        self._running = set()
+
+    def schedule(self, bot, match_id):
+        if match_id not in self._tasks:
+            task = asyncio.create_task(self._supervise(bot, match_id), name=f"match-{match_id}")
+            self._tasks[match_id] = task
+            task.add_done_callback(lambda task: self._tasks.pop(match_id, None))
+
+    async def _supervise(self, bot, match_id):
+        match = None
+        try:
+            match = await db.read(get_match, match_id)
+            if match[4] in ('open', 'scheduled'):
+                starts_at = datetime.fromisoformat(match[10])
+                await asyncio.sleep(max((starts_at - datetime.now()).total_seconds(), 0))
+            async with self._slots:
+                understaffed = False
+                if match[4] != 'running':
+                    match, understaffed = await db.write(start_match_tx, match_id)
+                if understaffed:
+                    await outbox.send(bot, match[7], f"Match {match_id} cancelled: not enough teams joined.")
+                if not match or match[4] != 'running':
+                    return
+                self._running.add(match_id)
+                try:
+                    await run_match(bot, match)
+                finally:
+                    self._running.discard(match_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Cancel rather than resume a match that fails on every attempt
+            logger.error(f"Error supervising match {match_id}: {str(e)}")
+            await db.write(cancel_match_tx, match_id)
+            if match and match[7]:
+                await outbox.send(bot, match[7], "Error during match simulation.")
+
+    async def wait(self, match_id):
+        # Until the match's task is done, however it ends
+        task = self._tasks.get(match_id)
+        if task is not None:
+            await asyncio.wait([task])
+
+    def cancel(self, match_id):
+        # Stops the match task; the caller records the cancellation
+        task = self._tasks.get(match_id)
+        if task is not None:
+            task.cancel()
+
+    def status(self, match_id):
+        if match_id in self._running:
+            return 'running'
+        return 'waiting' if match_id in self._tasks else None
+
+    def stats(self):
+        return {'supervised': len(self._tasks), 'running': len(self._running), 'max_running': self.max_running}
+
+    async def resume(self, bot):
+        match_ids = await db.read(get_supervised_matches)
+        for match_id in match_ids:
+            self.schedule(bot, match_id)
+        if match_ids:
+            logger.info(f"Resumed {len(match_ids)} matches")
+
+    async def shutdown(self):
+        # Leaves the matches table alone so resume() carries on after a restart
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+supervisor = MatchSupervisor(MAX_RUNNING_MATCHES, MATCH_START_DELAY)
+
+def open_random_match_tx(conn, chat_id, group_name):
+    c = conn.cursor()
+    c.execute('SELECT team_id, name FROM teams')
+    teams = c.fetchall()
+    if len(teams) < 2:
+        return None
+    sport = random.choice(SPORTS)
+    num_teams = random.randint(2, 4) if sport in RACING_SPORTS else 2
+    selected_teams = random.sample(teams, num_teams)
+    # Random matches start after the join window with whoever has joined
+    starts_at = (datetime.now() + timedelta(seconds=supervisor.start_delay)).isoformat()
+    match_id = create_match(conn, sport, selected_teams[0][0], num_teams, chat_id, group_name, starts_at)
+    return match_id, sport, num_teams, selected_teams[0][1]
+
+async def random_match_event(bot, chat_id, group_name):
+    try:
+        opened = await db.write(open_random_match_tx, chat_id, group_name)
+        if not opened:
             return
-        sperms_gained = random.randint(100000, 200000)
-        eggs_gained = random.randint(50, 150)
-        new_sperms = sperms_gained if not player else player[2] + sperms_gained
-        new_eggs = eggs_gained if not player else player[3] + eggs_gained
-        if not player:
-            initialize_player_citizens(conn, player_id)
-            create_team(conn, player_id, f"@{username}_team")
-            update_player(conn, player_id, username, new_sperms, new_eggs, 100, 100, 100, 100, 'medium', 'medium', 'medium', 'medium', 10, 0, datetime.now().isoformat(), None, None)
+        match_id, sport, num_teams, first_team_name = opened
+        await outbox.send(
+            bot, chat_id,
+            f"Random {sport} match for {num_teams} teams! {first_team_name} has joined. Use /acceptsport {match_id} to join! Use /gamble {match_id} <team_name> <amount> to bet!"
+        )
+        supervisor.schedule(bot, match_id)
+    except Exception as e:
+        logger.error(f"Error in random_match_event: {str(e)}")
+
+# Chat jobs
+# Recurring per-chat jobs live in the chat_jobs table, one row per chat and
+# job, so /start in a chat that already has its job changes nothing and the
+# schedule survives restarts. One scheduler task runs every chat's jobs: it
+# claims the due rows (moving their next run on by the job's interval plus
+# random jitter, so chats drift apart instead of firing together), runs
+# them, and sleeps until the next one is due. Jobs missed while the bot was
+# down are spread over resume_spread seconds rather than all run at startup.
+RANDOM_MATCH_INTERVAL = float(os.getenv('BATTLE_FORGE_RANDOM_MATCH_INTERVAL', str(5.5 * 3600)))
+RANDOM_MATCH_JITTER = float(os.getenv('BATTLE_FORGE_RANDOM_MATCH_JITTER', str(0.5 * 3600)))
+CHAT_JOB_BATCH = int(os.getenv('BATTLE_FORGE_CHAT_JOB_BATCH', '50'))
+CHAT_JOB_RESUME_SPREAD = float(os.getenv('BATTLE_FORGE_CHAT_JOB_RESUME_SPREAD', '600'))
+
+# job -> (callback(bot, chat_id, group_name), interval seconds, jitter seconds)
+CHAT_JOBS = {
+    'random_match': (random_match_event, RANDOM_MATCH_INTERVAL, RANDOM_MATCH_JITTER),
+}
+
+def next_job_run(job, now):
+    callback, interval, jitter = CHAT_JOBS[job]
+    return (now + timedelta(seconds=interval + random.uniform(-jitter, jitter))).isoformat()
+
+def register_chat_job_tx(conn, chat_id, job, group_name, now):
+    # Returns True if the chat didn't have the job yet; it runs right away
+    c = conn.cursor()
+    c.execute('UPDATE chat_jobs SET group_name = ? WHERE chat_id = ? AND job = ?', (group_name, chat_id, job))
+    if c.rowcount:
+        return False
+    c.execute('INSERT INTO chat_jobs (chat_id, job, group_name, next_run_at) VALUES (?, ?, ?, ?)',
+              (chat_id, job, group_name, now.isoformat()))
+    return True
+
+def claim_due_jobs_tx(conn, now, limit):
+    # Moves up to limit due jobs on to their next run and returns them with
+    # when the earliest job is due afterwards: ([(chat_id, job, group_name)], next_run_at)
+    c = conn.cursor()
+    c.execute('SELECT chat_id, job, group_name FROM chat_jobs WHERE next_run_at <= ? ORDER BY next_run_at LIMIT ?',
+              (now.isoformat(), limit))
+    due = [row for row in c.fetchall() if row[1] in CHAT_JOBS]
+    c.executemany('UPDATE chat_jobs SET next_run_at = ?, last_run_at = ? WHERE chat_id = ? AND job = ?',
+                  [(next_job_run(job, now), now.isoformat(), chat_id, job) for chat_id, job, group_name in due])
+    c.execute('SELECT MIN(next_run_at) FROM chat_jobs')
+    next_run_at = c.fetchone()[0]
+    return due, datetime.fromisoformat(next_run_at) if next_run_at else None
+
+def spread_overdue_jobs_tx(conn, now, spread):
+    c = conn.cursor()
+    c.execute('SELECT chat_id, job FROM chat_jobs WHERE next_run_at < ?', (now.isoformat(),))
+    overdue = c.fetchall()
+    c.executemany('UPDATE chat_jobs SET next_run_at = ? WHERE chat_id = ? AND job = ?',
+                  [((now + timedelta(seconds=random.uniform(0, spread))).isoformat(), chat_id, job) for chat_id, job in overdue])
+    return len(overdue)
+
+class ChatJobScheduler:
+    def __init__(self, batch, resume_spread):
+        self.batch = batch
+        self.resume_spread = resume_spread
+        self.runs = 0
+        self._task = None
+        self._wake = asyncio.Event()
+
+    async def register(self, chat_id, job, group_name):
+        added = await db.write(register_chat_job_tx, chat_id, job, group_name, datetime.now())
+        if added:
+            logger.debug(f"Registered {job} job for chat {chat_id}")
+            self._wake.set()
+        return added
+
+    async def start(self, bot):
+        overdue = await db.write(spread_overdue_jobs_tx, datetime.now(), self.resume_spread)
+        if overdue:
+            logger.info(f"Spreading {overdue} overdue chat jobs over {self.resume_spread:.0f} seconds")
+        self._task = asyncio.create_task(self._run(bot), name='chat-jobs')
+
+    async def _run(self, bot):
+        while True:
+            try:
+                self._wake.clear()
+                due, next_run_at = await db.write(claim_due_jobs_tx, datetime.now(), self.batch)
+                for chat_id, job, group_name in due:
+                    await CHAT_JOBS[job][0](bot, chat_id, group_name)
+                self.runs += len(due)
+                if len(due) == self.batch:
+                    continue
+                timeout = max((next_run_at - datetime.now()).total_seconds(), 0) if next_run_at else None
+            except Exception as e:
+                logger.error(f"Error running chat jobs: {str(e)}")
+                timeout = self.resume_spread
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+chat_jobs = ChatJobScheduler(CHAT_JOB_BATCH, CHAT_JOB_RESUME_SPREAD)
+
+# Tournaments
+# A tournament seeds its field by power, tops it up with AI teams and plays
+# a round robin or a knockout bracket round by round; all its state is in
+# the tournaments, tournament_teams and tournament_fixtures tables. AI vs AI
+# fixtures are simulated straight from their seed, one at a time between
+# other work on the event loop; a fixture with a player's team is a normal
+# supervised match (announced, open to bets, presented live), and at most
+# chat_matches of those run at once per chat. Each round's results go out
+# as one digest. After a restart resume() replays the current round.
+TOURNAMENT_FORMATS = ['round_robin', 'knockout']
+# Volleyball is left out while its 60 second cap ends every match level (see
+# _trials_volleyball): each fixture would be settled by the shoot-out
+TOURNAMENT_SPORTS = [sport for sport in SPORTS if sport not in RACING_SPORTS and sport != 'volleyball']
+TOURNAMENT_MAX_TEAMS = int(os.getenv('BATTLE_FORGE_TOURNAMENT_MAX_TEAMS', '64'))
+TOURNAMENT_JOIN_SECONDS = float(os.getenv('BATTLE_FORGE_TOURNAMENT_JOIN_SECONDS', '60'))
+TOURNAMENT_ROUND_DELAY = float(os.getenv('BATTLE_FORGE_TOURNAMENT_ROUND_DELAY', '10'))
+TOURNAMENT_CHAT_MATCHES = int(os.getenv('BATTLE_FORGE_TOURNAMENT_CHAT_MATCHES', '2'))
+TOURNAMENT_STANDINGS = int(os.getenv('BATTLE_FORGE_TOURNAMENT_STANDINGS', '10'))
+
+def round_robin_rounds(team_ids):
+    # Circle method: every team meets every other once; None is a bye
+    ids = list(team_ids) + ([None] if len(team_ids) % 2 else [])
+    rounds = []
+    for number in range(len(ids) - 1):
+        pairs = [(ids[i], ids[-1 - i]) for i in range(len(ids) // 2)]
+        if number % 2:
+            pairs[0] = pairs[0][::-1]
+        rounds.append([pair if pair[0] is not None else pair[::-1] for pair in pairs])
+        ids = [ids[0], ids[-1]] + ids[1:-1]
+    return rounds
+
+def knockout_rounds(size):
+    return (size - 1).bit_length()
+
+def knockout_first_round(team_ids):
+    # team_ids in seed order. Seeds meet as in a standard bracket (1 v 8,
+    # 4 v 5, 2 v 7, 3 v 6) so the top seeds can only meet late; places past
+    # the field are byes, which go to the top seeds.
+    order = [1]
+    while len(order) < 1 << knockout_rounds(len(team_ids)):
+        order = [seed for top in order for seed in (top, 2 * len(order) + 1 - top)]
+    seeded = lambda seed: team_ids[seed - 1] if seed <= len(team_ids) else None
+    return [(seeded(order[i]), seeded(order[i + 1])) for i in range(0, len(order), 2)]
+
+def tiebreak(home, away, seed):
+    # A drawn knockout fixture goes to a shoot-out, weighted by power
+    rng = random.Random(seed)
+    return home if rng.random() < home[5] / (home[5] + away[5]) else away
+
+def get_tournament(conn, tournament_id):
+    c = conn.cursor()
+    c.execute('SELECT * FROM tournaments WHERE tournament_id = ?', (tournament_id,))
+    return c.fetchone()
+
+def get_fixtures(conn, tournament_id, round):
+    c = conn.cursor()
+    c.execute('SELECT * FROM tournament_fixtures WHERE tournament_id = ? AND round = ? ORDER BY slot', (tournament_id, round))
+    return c.fetchall()
+
+def get_tournament_team_names(conn, tournament_id):
+    c = conn.cursor()
+    c.execute('''SELECT teams.team_id, teams.name FROM tournament_teams JOIN teams ON teams.team_id = tournament_teams.team_id
+                 WHERE tournament_teams.tournament_id = ?''', (tournament_id,))
+    return dict(c.fetchall())
+
+def get_standings(conn, tournament_id, limit):
+    c = conn.cursor()
+    c.execute('''SELECT teams.name, tournament_teams.points, tournament_teams.score_diff
+                 FROM tournament_teams JOIN teams ON teams.team_id = tournament_teams.team_id
+                 WHERE tournament_teams.tournament_id = ?
+                 ORDER BY tournament_teams.points DESC, tournament_teams.score_diff DESC, tournament_teams.seed
+                 LIMIT ?''', (tournament_id, limit))
+    return c.fetchall()
+
+def get_resumable_tournaments(conn):
+    c = conn.cursor()
+    c.execute("SELECT tournament_id FROM tournaments WHERE status IN ('open', 'running')")
+    return [row[0] for row in c.fetchall()]
+
+def insert_fixtures(conn, tournament_id, round, pairs, byes_advance):
+    # A bye is done as soon as it's drawn; in a knockout its team goes through
+    c = conn.cursor()
+    c.executemany('''INSERT INTO tournament_fixtures (tournament_id, round, slot, home_team_id, away_team_id, status, seed, winner_team_id)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                  [(tournament_id, round, slot, home, away, 'pending' if away is not None else 'done',
+                    random.getrandbits(32), home if away is None and byes_advance else None)
+                   for slot, (home, away) in enumerate(pairs)])
+
+def start_tournament_tx(conn, tournament_id):
+    # open -> running: fills the field with AI teams, seeds it and draws the
+    # fixtures (every round of a round robin, the first of a knockout).
+    # Returns (tournament, announcement lines).
+    tournament = get_tournament(conn, tournament_id)
+    if not tournament or tournament[4] != 'open':
+        return tournament, []
+    c = conn.cursor()
+    c.execute('SELECT team_id FROM tournament_teams WHERE tournament_id = ?', (tournament_id,))
+    teams = get_teams(conn, fill_with_ai_teams(conn, [row[0] for row in c.fetchall()], tournament[3]))
+    random.shuffle(teams)
+    teams.sort(key=lambda team: team[5], reverse=True)
+    team_ids = [team[0] for team in teams]
+    c.executemany('''INSERT INTO tournament_teams (tournament_id, team_id, seed) VALUES (?, ?, ?)
+                     ON CONFLICT (tournament_id, team_id) DO UPDATE SET seed = excluded.seed''',
+                  [(tournament_id, team_id, seed) for seed, team_id in enumerate(team_ids, 1)])
+    if tournament[2] == 'round_robin':
+        rounds = round_robin_rounds(team_ids)
+        for number, pairs in enumerate(rounds, 1):
+            insert_fixtures(conn, tournament_id, number, pairs, False)
+        rounds = len(rounds)
+    else:
+        insert_fixtures(conn, tournament_id, 1, knockout_first_round(team_ids), True)
+        rounds = knockout_rounds(len(team_ids))
+    c.execute("UPDATE tournaments SET status = 'running', round = 1, rounds = ? WHERE tournament_id = ?", (rounds, tournament_id))
+    logger.debug(f"Started tournament {tournament_id}: {len(team_ids)} teams, {rounds} rounds")
+    lines = [f"Tournament {tournament_id} ({tournament[1]} {tournament[2].replace('_', ' ')}) begins: "
+             f"{len(team_ids)} teams, {rounds} rounds.",
+             "Top seeds: " + ", ".join(f"{seed}. {team[2]}" for seed, team in enumerate(teams[:TOURNAMENT_STANDINGS], 1))]
+    return get_tournament(conn, tournament_id), lines
+
+def create_fixture_match_tx(conn, fixture_id, chat_id, group_name):
+    # A fixture with a player's team is played as a scheduled match; returns
+    # its match id (the existing one if it was already created)
+    c = conn.cursor()
+    c.execute('SELECT * FROM tournament_fixtures WHERE fixture_id = ?', (fixture_id,))
+    fixture = c.fetchone()
+    if fixture[8]:
+        return fixture[8]
+    starts_at = (datetime.now() + timedelta(seconds=supervisor.start_delay)).isoformat()
+    c.execute('''INSERT INTO matches (sport, team_ids, max_teams, status, start_time, chat_id, group_name, starts_at)
+                 SELECT sport, ?, 2, 'scheduled', ?, ?, ?, ? FROM tournaments WHERE tournament_id = ?''',
+              (json.dumps([fixture[4], fixture[5]]), datetime.now().isoformat(), chat_id, group_name, starts_at, fixture[1]))
+    match_id = c.lastrowid
+    c.execute("UPDATE tournament_fixtures SET status = 'running', match_id = ? WHERE fixture_id = ?", (match_id, fixture_id))
+    return match_id
+
+def record_round_tx(conn, tournament_id, round, results):
+    # results: [(fixture_id, home_score, away_score, winner_team_id, simulated)]
+    # for the round's fixtures that weren't done yet. Team records are
+    # updated here for simulated fixtures (played matches settled their
+    # own), then standings, and the next knockout round is drawn or the
+    # tournament finished. Returns the round's digest lines, or None if the
+    # round was already recorded.
+    tournament = get_tournament(conn, tournament_id)
+    if not tournament or tournament[4] != 'running' or tournament[5] != round:
+        return None
+    knockout = tournament[2] == 'knockout'
+    fixtures = {fixture[0]: fixture for fixture in get_fixtures(conn, tournament_id, round)}
+    teams = {team[0]: team for team in get_teams(conn, list(get_tournament_team_names(conn, tournament_id)))}
+    c = conn.cursor()
+    shootouts = set()
+    updates = []
+    standings = []
+    for fixture_id, home_score, away_score, winner_id, simulated in results:
+        fixture = fixtures[fixture_id]
+        home, away = teams[fixture[4]], teams[fixture[5]]
+        if simulated:
+            record_team_results(conn, [home, away], winner_id)
+        advancing = winner_id
+        if knockout and winner_id is None:
+            advancing = tiebreak(home, away, fixture[7])[0]
+            shootouts.add(fixture_id)
+        updates.append((home_score, away_score, advancing, fixture_id))
+        if knockout:
+            standings.append((0, 0, 1, tournament_id, away[0] if advancing == home[0] else home[0]))
         else:
-            update_player(conn, player_id, username, new_sperms, new_eggs, player[4], player[5], player[6], player[7], player[8], player[9], player[10], player[11], player[12], player[13], datetime.now().isoformat(), player[15], player[16])
-        logger.debug(f"Player {player_id} collected {sperms_gained} sperms, {eggs_gained} eggs")
-        await update.message.reply_text(f"You collected {sperms_gained} sperms and {eggs_gained} eggs! Totals: {new_sperms} sperms, {new_eggs} eggs")
+            for team, scored, conceded in ((home, home_score, away_score), (away, away_score, home_score)):
+                points = 3 if winner_id == team[0] else 1 if winner_id is None else 0
+                standings.append((points, scored - conceded, 0, tournament_id, team[0]))
+    c.executemany('''UPDATE tournament_fixtures SET status = 'done', home_score = ?, away_score = ?, winner_team_id = ?
+                     WHERE fixture_id = ?''', updates)
+    c.executemany('''UPDATE tournament_teams SET points = points + ?, score_diff = score_diff + ?, eliminated = eliminated + ?
+                     WHERE tournament_id = ? AND team_id = ?''', standings)
+
+    fixtures = get_fixtures(conn, tournament_id, round)
+    names = {team_id: team[2] for team_id, team in teams.items()}
+    lines = [f"Tournament {tournament_id} ({tournament[1]}), round {round}/{tournament[6]} results:"]
+    for fixture in fixtures:
+        if fixture[5] is None:
+            lines.append(f"{names[fixture[4]]} has a bye")
+            continue
+        line = f"{names[fixture[4]]} {fixture[9]} - {fixture[10]} {names[fixture[5]]}"
+        if fixture[0] in shootouts:
+            line += f" ({names[fixture[11]]} wins the shoot-out)"
+        lines.append(line)
+    if knockout and round < tournament[6]:
+        winners = [fixture[11] for fixture in fixtures]
+        insert_fixtures(conn, tournament_id, round + 1, list(zip(winners[::2], winners[1::2])), True)
+        c.execute('UPDATE tournaments SET round = round + 1 WHERE tournament_id = ?', (tournament_id,))
+        lines.append(f"{len(winners)} teams go through to round {round + 1}.")
+        return lines
+    if not knockout:
+        table = get_standings(conn, tournament_id, TOURNAMENT_STANDINGS)
+        lines.append("Standings:")
+        lines += [f"{place}. {name}: {points} pts ({diff:+})" for place, (name, points, diff) in enumerate(table, 1)]
+        if round < tournament[6]:
+            c.execute('UPDATE tournaments SET round = round + 1 WHERE tournament_id = ?', (tournament_id,))
+            return lines
+        c.execute('''SELECT team_id FROM tournament_teams WHERE tournament_id = ?
+                     ORDER BY points DESC, score_diff DESC, seed LIMIT 1''', (tournament_id,))
+        champion = c.fetchone()[0]
+    else:
+        champion = fixtures[0][11]
+    c.execute("UPDATE tournaments SET status = 'finished', winner_team_id = ? WHERE tournament_id = ?", (champion, tournament_id))
+    logger.debug(f"Tournament {tournament_id} won by team {champion}")
+    lines.append(f"🏆 {names[champion]} wins tournament {tournament_id}!")
+    return lines
+
+def cancel_tournament_tx(conn, tournament_id):
+    c = conn.cursor()
+    c.execute("UPDATE tournaments SET status = 'cancelled' WHERE tournament_id = ? AND status IN ('open', 'running')", (tournament_id,))
+    return c.rowcount > 0
+
+class TournamentScheduler:
+    def __init__(self, chat_matches, round_delay):
+        self.chat_matches = chat_matches
+        self.round_delay = round_delay
+        self._tasks = {}
+        self._chat_slots = {}
+
+    def schedule(self, bot, tournament_id):
+        if tournament_id not in self._tasks:
+            task = asyncio.create_task(self._run(bot, tournament_id), name=f"tournament-{tournament_id}")
+            self._tasks[tournament_id] = task
+            task.add_done_callback(lambda task: self._tasks.pop(tournament_id, None))
+
+    async def _run(self, bot, tournament_id):
+        tournament = None
+        try:
+            tournament = await db.read(get_tournament, tournament_id)
+            if tournament[4] == 'open':
+                starts_at = datetime.fromisoformat(tournament[10])
+                await asyncio.sleep(max((starts_at - datetime.now()).total_seconds(), 0))
+                tournament, lines = await db.write(start_tournament_tx, tournament_id)
+                for text in chunk_lines(lines):
+                    await outbox.send(bot, tournament[7], text)
+            while tournament[4] == 'running':
+                fixtures = [fixture for fixture in await db.read(get_fixtures, tournament_id, tournament[5])
+                            if fixture[6] != 'done']
+                team_ids = {team_id for fixture in fixtures for team_id in fixture[4:6]}
+                teams = {team[0]: team for team in await db.read(get_teams, list(team_ids))}
+                simulated = [fixture for fixture in fixtures if teams[fixture[4]][1] is None and teams[fixture[5]][1] is None]
+                played = [fixture for fixture in fixtures if fixture not in simulated]
+                results = await asyncio.gather(self._simulate(tournament, simulated, teams),
+                                               *(self._play(bot, tournament, fixture, teams) for fixture in played))
+                results = results[0] + results[1:]
+                lines = await db.write(record_round_tx, tournament_id, tournament[5], results)
+                for text in chunk_lines(lines or []):
+                    await outbox.send(bot, tournament[7], text)
+                tournament = await db.read(get_tournament, tournament_id)
+                if tournament[4] == 'running':
+                    await asyncio.sleep(self.round_delay)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error running tournament {tournament_id}: {str(e)}")
+            await db.write(cancel_tournament_tx, tournament_id)
+            if tournament and tournament[7]:
+                await outbox.send(bot, tournament[7], f"Tournament {tournament_id} cancelled after an error.")
+
+    async def _simulate(self, tournament, fixtures, teams):
+        # AI vs AI fixtures, one after another, letting everything else
+        # waiting on the loop run between them.
+        # -> [(fixture_id, home_score, away_score, winner_team_id, simulated)]
+        results = []
+        for fixture in fixtures:
+            await asyncio.sleep(0)
+            home, away = teams[fixture[4]], teams[fixture[5]]
+            events, result = play_match(tournament[1], [(home[2], home[5]), (away[2], away[5])], fixture[7])
+            winner_id = home[0] if result.winner == home[2] else away[0] if result.winner == away[2] else None
+            results.append((fixture[0], result.scores[home[2]], result.scores[away[2]], winner_id, True))
+        return results
+
+    async def _play(self, bot, tournament, fixture, teams):
+        # A fixture with a player's team, as a supervised match
+        home, away = teams[fixture[4]], teams[fixture[5]]
+        chat_id, group_name = tournament[7], tournament[8] or "group"
+        async with self._chat_slots.setdefault(chat_id, asyncio.Semaphore(self.chat_matches)):
+            match_id = await db.write(create_fixture_match_tx, fixture[0], chat_id, group_name)
+            if not fixture[8]:
+                await outbox.send(bot, chat_id, f"Tournament {tournament[0]} round {fixture[2]}: {home[2]} vs {away[2]} "
+                                                f"starts in {supervisor.start_delay:.0f} seconds (match id: {match_id}). "
+                                                f"Use /gamble {match_id} <team_name> <amount> to bet!")
+            supervisor.schedule(bot, match_id)
+            await supervisor.wait(match_id)
+        match = await db.read(get_match, match_id)
+        if match[4] != 'settled':
+            # A match that couldn't be played counts as a scoreless draw
+            return fixture[0], 0, 0, None, False
+        scores = json.loads(match[13])
+        return fixture[0], scores[0], scores[1], match[12], False
+
+    async def resume(self, bot):
+        tournament_ids = await db.read(get_resumable_tournaments)
+        for tournament_id in tournament_ids:
+            self.schedule(bot, tournament_id)
+        if tournament_ids:
+            logger.info(f"Resumed {len(tournament_ids)} tournaments")
+
+    async def shutdown(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+tournament_scheduler = TournamentScheduler(TOURNAMENT_CHAT_MATCHES, TOURNAMENT_ROUND_DELAY)
+
+# Command handlers
+# Each handler keeps Telegram I/O on the event loop and hands its database
+# work, written as a plain function of a connection, to the db executor.
+def start_tx(conn, player_id, username):
+    if not get_player(conn, player_id):
+        provision_player(conn, player_id, username)
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        group_name = update.effective_chat.title or "group"
+        player_id = update.effective_user.id
+        username = update.effective_user.username or f"user_{player_id}"
+        await db.write(start_tx, player_id, username)
+        logger.debug(f"Start command by player {player_id} in chat {update.effective_chat.id}")
+        await update.message.reply_text(
+            f"Welcome to BattleForgeBot in {group_name}! ⚔️\n"
+            f"Currency: {group_name} coin\n"
+            "Commands:\n"
+            "/collectresources - Collect sperms and eggs every 24h\n"
+            "/collectsupplies - Collect water, food, medicine, ore every 12h\n"
+            "/merge <sperms> <eggs> - Create babies\n"
+            "/upgradequality <resource> - Upgrade resource quality\n"
+            "/mystats - View resources, population, coins\n"
+            "/citizens [role] [cursor] - Browse your citizens with ids\n"
+            "/currencies [page] - View all players' coin values\n"
+            "/sellable - View items available for trading\n"
+            "/trade <item> <quantity> <price> - Sell (price per unit for resources)\n"
+            "/buy <resource> <quantity> <price> - Bid for a resource at a price per unit\n"
+            "/book <resource> - Best bids and asks for a resource\n"
+            "/myorders - Your open orders\n"
+            "/cancelorder <order_id> - Withdraw an open order\n"
+            "/accepttrade <trade_id> - Accept a trade\n"
+            "/war <opponent_player_id> <fighter_count> - Start a war\n"
+            "/sportevent <sport> <num_teams> - Create a sport match\n"
+            "/acceptsport <match_id> - Join a sport match\n"
+            "/matchstatus <match_id> - Check on a sport match\n"
+            "/matchlog <match_id> [page] - Page through a match's events\n"
+            "/cancelmatch <match_id> - Cancel a sport match you created before it starts\n"
+            "/teamstats - View your team stats\n"
+            "/odds <match_id> - Win chances and payouts for a match\n"
+            "/gamble <match_id> <team_name> <amount> - Bet on a match at the quoted odds\n"
+            "/tournament <sport> <round_robin|knockout> <num_teams> - Start a tournament\n"
+            "/jointournament <tournament_id> - Enter your team in a tournament\n"
+            "/tournamentstatus <tournament_id> - Round, fixtures and standings of a tournament\n"
+            "/leaderboard - Top players by coins and wins\n"
+            "/myrank - Your place on the leaderboard"
+        )
+        await chat_jobs.register(update.effective_chat.id, 'random_match', group_name)
+    except Exception as e:
+        logger.error(f"Error in start command: {str(e)}")
+        await update.message.reply_text("An error occurred. Please try again.")
+
+def collectresources_tx(conn, player_id, username):
+    if not get_player(conn, player_id):
+        provision_player(conn, player_id, username)
+    sperms_gained = random.randint(100000, 200000)
+    eggs_gained = random.randint(50, 150)
+    if not claim_collection(conn, player_id, 'last_resource_collect', timedelta(hours=24), sperms=sperms_gained, eggs=eggs_gained):
+        logger.debug(f"Player {player_id} tried to collect resources too soon")
+        return "You've already collected resources in the last 24 hours!"
+    player = get_player(conn, player_id)
+    logger.debug(f"Player {player_id} collected {sperms_gained} sperms, {eggs_gained} eggs")
+    return f"You collected {sperms_gained} sperms and {eggs_gained} eggs! Totals: {player[2]} sperms, {player[3]} eggs"
+
+async def collectresources(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    player_id = update.effective_user.id
+    username = update.effective_user.username or f"user_{player_id}"
+    try:
+        await update.message.reply_text(await db.write(collectresources_tx, player_id, username))
     except Exception as e:
         logger.error(f"Error in collectresources for player {player_id}: {str(e)}")
         await update.message.reply_text("An error occurred while collecting resources.")
-    finally:
-        conn.close()
+
+def collectsupplies_tx(conn, player_id, username):
+    if not get_player(conn, player_id):
+        provision_player(conn, player_id, username)
+    water_gained = random.randint(10, 20)
+    food_gained = random.randint(10, 20)
+    medicine_gained = random.randint(10, 20)
+    ore_gained = random.randint(10, 20)
+    if not claim_collection(conn, player_id, 'last_supplies_collect', timedelta(hours=12),
+                            water=water_gained, food=food_gained, medicine=medicine_gained, ore=ore_gained):
+        logger.debug(f"Player {player_id} tried to collect supplies too soon")
+        return "You've already collected supplies in the last 12 hours!"
+    logger.debug(f"Player {player_id} collected {water_gained} water, {food_gained} food, {medicine_gained} medicine, {ore_gained} ore")
+    return f"You collected {water_gained} water, {food_gained} food, {medicine_gained} medicine, {ore_gained} ore!"
 
 async def collectsupplies(update: Update, context: ContextTypes.DEFAULT_TYPE):
     player_id = update.effective_user.id
     username = update.effective_user.username or f"user_{player_id}"
-    conn = sqlite3.connect('battle_forge.db')
     try:
-        player = get_player(conn, player_id)
-        if not can_collect_supplies(player):
-            logger.debug(f"Player {player_id} tried to collect supplies too soon")
-            await update.message.reply_text("You've already collected supplies in the last 12 hours!")
-            return
-        water_gained = random.randint(10, 20)
-        food_gained = random.randint(10, 20)
-        medicine_gained = random.randint(10, 20)
-        ore_gained = random.randint(10, 20)
-        new_water = water_gained if not player else player[4] + water_gained
-        new_food = food_gained if not player else player[5] + food_gained
-        new_medicine = medicine_gained if not player else player[6] + medicine_gained
-        new_ore = ore_gained if not player else player[7] + ore_gained
-        if not player:
-            initialize_player_citizens(conn, player_id)
-            create_team(conn, player_id, f"@{username}_team")
-            update_player(conn, player_id, username, 0, 0, new_water, new_food, new_medicine, new_ore, 'medium', 'medium', 'medium', 'medium', 10, 0, None, datetime.now().isoformat(), None)
-        else:
-            update_player(conn, player_id, username, player[2], player[3], new_water, new_food, new_medicine, new_ore, player[8], player[9], player[10], player[11], player[12], player[13], player[14], datetime.now().isoformat(), player[16])
-        logger.debug(f"Player {player_id} collected {water_gained} water, {food_gained} food, {medicine_gained} medicine, {ore_gained} ore")
-        await update.message.reply_text(f"You collected {water_gained} water, {food_gained} food, {medicine_gained} medicine, {ore_gained} ore!")
+        await update.message.reply_text(await db.write(collectsupplies_tx, player_id, username))
     except Exception as e:
         logger.error(f"Error in collectsupplies for player {player_id}: {str(e)}")
         await update.message.reply_text("An error occurred while collecting supplies.")
-    finally:
-        conn.close()
+
+def merge_tx(conn, player_id, username, sperm_count, egg_count):
+    if not get_player(conn, player_id):
+        provision_player(conn, player_id, username)
+    if not adjust_resources(conn, player_id, sperms=-sperm_count, eggs=-egg_count):
+        logger.debug(f"Player {player_id} has insufficient sperms or eggs")
+        return "Not enough sperms or eggs!"
+    # One batch row however many babies the merge makes
+    create_baby(conn, player_id, f"baby_{random.randint(1000, 9999)}", datetime.now().isoformat(), min(sperm_count, egg_count))
+    logger.debug(f"Player {player_id} merged {min(sperm_count, egg_count)} sperms and eggs")
+    return f"Merged {min(sperm_count, egg_count)} sperms and eggs to create babies!"
 
 async def merge(update: Update, context: ContextTypes.DEFAULT_TYPE):
     player_id = update.effective_user.id
@@ -905,25 +3161,7 @@ async def merge(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if sperm_count <= 0 or egg_count <= 0:
             await update.message.reply_text("Sperm and egg counts must be positive!")
             return
-        conn = sqlite3.connect('battle_forge.db')
-        try:
-            player = get_player(conn, player_id)
-            if not player:
-                initialize_player_citizens(conn, player_id)
-                create_team(conn, player_id, f"@{username}_team")
-                player = get_player(conn, player_id)
-            if player[2] < sperm_count or player[3] < egg_count:
-                logger.debug(f"Player {player_id} has insufficient sperms or eggs")
-                await update.message.reply_text("Not enough sperms or eggs!")
-                return
-            for i in range(min(sperm_count, egg_count)):
-                create_baby(conn, player_id, f"baby_{random.randint(1000, 9999)}", datetime.now().isoformat())
-            update_player(conn, player_id, username, player[2] - sperm_count, player[3] - egg_count, player[4], player[5], player[6], player[7],
-                         player[8], player[9], player[10], player[11], player[12], player[13], player[14], player[15], player[16])
-            logger.debug(f"Player {player_id} merged {min(sperm_count, egg_count)} sperms and eggs")
-            await update.message.reply_text(f"Merged {min(sperm_count, egg_count)} sperms and eggs to create babies!")
-        finally:
-            conn.close()
+        await update.message.reply_text(await db.write(merge_tx, player_id, username, sperm_count, egg_count))
     except ValueError:
         logger.debug(f"Player {player_id} used invalid numbers for merge")
         await update.message.reply_text("Sperm and egg counts must be numbers!")
@@ -931,6 +3169,24 @@ async def merge(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in merge for player {player_id}: {str(e)}")
         await update.message.reply_text("An error occurred while merging.")
 
+def upgradequality_tx(conn, player_id, username, resource, group_name):
+    player = get_player(conn, player_id)
+    if not player:
+        player = provision_player(conn, player_id, username)
+    if player[12] < 10:
+        logger.debug(f"Player {player_id} has insufficient coins")
+        return f"You need 10 {group_name} coins to upgrade!"
+    current_quality = player[{'water': 8, 'food': 9, 'medicine': 10, 'ore': 11}[resource]]
+    if current_quality == 'high':
+        logger.debug(f"Player {player_id} tried to upgrade {resource} already at high")
+        return f"{resource} quality is already high!"
+    new_quality = 'medium' if current_quality == 'low' else 'high'
+    if not set_quality(conn, player_id, resource, current_quality, new_quality, 10):
+        logger.debug(f"Player {player_id} could not upgrade {resource}: balance or quality changed")
+        return f"You need 10 {group_name} coins to upgrade!"
+    logger.debug(f"Player {player_id} upgraded {resource} to {new_quality}")
+    return f"Upgraded {resource} quality to {new_quality}!"
+
 async def upgradequality(update: Update, context: ContextTypes.DEFAULT_TYPE):
     player_id = update.effective_user.id
     if not context.args:
@@ -942,139 +3198,361 @@ async def upgradequality(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.debug(f"Player {player_id} specified invalid resource: {resource}")
         await update.message.reply_text("Invalid resource! Use water, food, medicine, or ore.")
         return
-    conn = sqlite3.connect('battle_forge.db')
     try:
-        player = get_player(conn, player_id)
-        if not player:
-            username = update.effective_user.username or f"user_{player_id}"
-            initialize_player_citizens(conn, player_id)
-            create_team(conn, player_id, f"@{username}_team")
-            player = get_player(conn, player_id)
-        if player[12] < 10:
-            logger.debug(f"Player {player_id} has insufficient coins")
-            await update.message.reply_text(f"You need 10 {update.effective_chat.title or 'group'} coins to upgrade!")
-            return
-        quality_index = {'water': 8, 'food': 9, 'medicine': 10, 'ore': 11}[resource]
-        current_quality = player[quality_index]
-        if current_quality == 'high':
-            logger.debug(f"Player {player_id} tried to upgrade {resource} already at high")
-            await update.message.reply_text(f"{resource} quality is already high!")
-            return
-        new_quality = 'medium' if current_quality == 'low' else 'high'
-        new_player_data = list(player)
-        new_player_data[quality_index] = new_quality
-        new_player_data[12] -= 10
-        update_player(conn, player_id, player[1], *new_player_data[2:])
-        logger.debug(f"Player {player_id} upgraded {resource} to {new_quality}")
-        await update.message.reply_text(f"Upgraded {resource} quality to {new_quality}!")
+        username = update.effective_user.username or f"user_{player_id}"
+        group_name = update.effective_chat.title or 'group'
+        await update.message.reply_text(await db.write(upgradequality_tx, player_id, username, resource, group_name))
     except Exception as e:
         logger.error(f"Error in upgradequality for player {player_id}: {str(e)}")
         await update.message.reply_text("An error occurred while upgrading quality.")
-    finally:
-        conn.close()
+
+CURRENCIES_PAGE_SIZE = int(os.getenv('BATTLE_FORGE_CURRENCIES_PAGE_SIZE', '50'))
+
+def currencies_tx(conn, group_name, page):
+    # One query for the page, most valuable currency first. Values on disk
+    # may lag the player cache by a flush; players shown are read from the
+    # cache where they're in it.
+    c = conn.cursor()
+    c.execute(f'''SELECT players.*, COALESCE(population.citizens + population.babies, 0), COUNT(*) OVER ()
+                  FROM players LEFT JOIN player_population AS population ON population.player_id = players.player_id
+                  ORDER BY (players.water + players.food + players.medicine + players.ore * 2) * 1.0
+                           / MAX(COALESCE(population.citizens + population.babies, 0), 1) DESC, players.player_id
+                  LIMIT ? OFFSET ?''', (CURRENCIES_PAGE_SIZE, (page - 1) * CURRENCIES_PAGE_SIZE))
+    rows = c.fetchall()
+    if not rows:
+        return [f"No currencies on page {page}!" if page > 1 else "No players have currencies yet!"]
+    pages = -(-rows[0][-1] // CURRENCIES_PAGE_SIZE)
+    cached = player_cache.cached([row[0] for row in rows])
+    lines = [f"Currency values in {group_name} (page {page}/{pages}):"]
+    for row in rows:
+        player = get_player(conn, row[0]) if row[0] in cached else row[:len(PLAYER_COLUMNS)]
+        currency_value = calculate_currency_value(player, row[-2])
+        lines.append(f"@{player[1]} coin: {currency_value:.2f} {group_name} coins")
+    if page < pages:
+        lines.append(f"Use /currencies {page + 1} for more")
+    return lines
 
 async def currencies(update: Update, context: ContextTypes.DEFAULT_TYPE):
     player_id = update.effective_user.id
     group_name = update.effective_chat.title or "group"
-    conn = sqlite3.connect('battle_forge.db')
     try:
-        c = conn.cursor()
-        c.execute('SELECT player_id, username FROM players')
-        players = c.fetchall()
-        response = f"Currency values in {group_name}:\n"
-        for player in players:
-            player_data = get_player(conn, player[0])
-            citizens = get_citizens(conn, player[0])
-            babies = get_babies(conn, player[0])
-            currency_value = calculate_currency_value(player_data, citizens, babies)
-            response += f"@{player[1]} coin: {currency_value:.2f} {group_name} coins\n"
-        logger.debug(f"Player {player_id} viewed currencies")
-        await update.message.reply_text(response or "No players have currencies yet!")
+        page = int(context.args[0]) if context.args else 1
+        if page < 1:
+            await update.message.reply_text("Page must be positive!")
+            return
+        lines = await db.read(currencies_tx, group_name, page)
+        logger.debug(f"Player {player_id} viewed currencies page {page}")
+        for text in chunk_lines(lines):
+            await update.message.reply_text(text)
+    except ValueError:
+        logger.debug(f"Player {player_id} used invalid currencies page")
+        await update.message.reply_text("Page must be a number!")
     except Exception as e:
         logger.error(f"Error in currencies for player {player_id}: {str(e)}")
         await update.message.reply_text("An error occurred while viewing currencies.")
-    finally:
-        conn.close()
+
+def sellable_tx(conn, player_id, username):
+    player = get_player(conn, player_id)
+    if not player:
+        player = provision_player(conn, player_id, username)
+    population = get_population(conn, player_id)
+    citizens = get_citizens(conn, player_id)
+    response = "Items you can sell:\n"
+    response += f"`sperms`: {player[2]}\n"
+    response += f"`eggs`: {player[3]}\n"
+    response += f"`water`: {player[4]}\n"
+    response += f"`food`: {player[5]}\n"
+    response += f"`medicine`: {player[6]}\n"
+    response += f"`ore`: {player[7]}\n"
+    response += "\nActive citizens by role:\n"
+    active_roles = [(role, count_citizens(population, role, 'active')) for role in CITIZEN_ROLES]
+    active_roles = [(role, count) for role, count in active_roles if count]
+    if active_roles:
+        for role, count in active_roles:
+            response += f"`citizen_{role}`: {count}\n"
+    else:
+        response += "No active citizens available.\n"
+    active_citizens = [c for c in citizens if c[8] == 'active']
+    if active_citizens:
+        response += "\nNamed citizens:\n"
+        for citizen in active_citizens:
+            response += f"id: citizen_{citizen[0]}, name: {citizen[2]}, role: {citizen[3]}\n"
+    response += f"\nUse /trade <item> <quantity> <price> to sell, resources at a price per unit (e.g., /trade water 100 5)"
+    return response
 
 async def sellable(update: Update, context: ContextTypes.DEFAULT_TYPE):
     player_id = update.effective_user.id
-    conn = sqlite3.connect('battle_forge.db')
+    username = update.effective_user.username or f"user_{player_id}"
     try:
-        player = get_player(conn, player_id)
-        if not player:
-            username = update.effective_user.username or f"user_{player_id}"
-            initialize_player_citizens(conn, player_id)
-            create_team(conn, player_id, f"@{username}_team")
-            player = get_player(conn, player_id)
-        citizens = get_citizens(conn, player_id)
-        response = "Items you can sell:\n"
-        response += f"`sperms`: {player[2]}\n"
-        response += f"`eggs`: {player[3]}\n"
-        response += f"`water`: {player[4]}\n"
-        response += f"`food`: {player[5]}\n"
-        response += f"`medicine`: {player[6]}\n"
-        response += f"`ore`: {player[7]}\n"
-        response += "\nActive citizens:\n"
-        active_citizens = [c for c in citizens if c[8] == 'active']
-        if active_citizens:
-            for citizen in active_citizens:
-                response += f"id: citizen_{citizen[0]}, name: {citizen[2]}, role: {citizen[3]}\n"
-        else:
-            response += "No active citizens available.\n"
-        response += f"\nUse /trade <item> <quantity> <price> to sell (e.g., /trade sperms 1000 5)"
+        response = await db.write(sellable_tx, player_id, username)
         formatted_response = f"```\n{response}\n```"
         logger.debug(f"Player {player_id} viewed sellable items")
         await update.message.reply_text(formatted_response, parse_mode='Markdown')
     except Exception as e:
         logger.error(f"Error in sellable for player {player_id}: {str(e)}")
         await update.message.reply_text("An error occurred while viewing sellable items.")
-    finally:
-        conn.close()
+
+def mystats_tx(conn, player_id, username, group_name):
+    player = get_player(conn, player_id)
+    if not player:
+        player = provision_player(conn, player_id, username)
+    grow_babies(conn, player_id)
+    water, food, medicine, ore = produce_supplies(conn, player_id)
+    # A summary from grouped queries, the same size however big the
+    # population; individual citizens are paged through with /citizens
+    player = get_player(conn, player_id)
+    population = get_population(conn, player_id)
+    means = get_stat_means(conn, player_id)
+    c = conn.cursor()
+    c.execute('SELECT is_born, SUM(count) FROM babies WHERE player_id = ? GROUP BY is_born', (player_id,))
+    babies = dict(c.fetchall())
+    c.execute('SELECT COUNT(*) FROM citizens WHERE player_id = ? AND status != "dead"', (player_id,))
+    named = c.fetchone()[0]
+    currency_value = calculate_currency_value(player, count_population(conn, player_id))
+    response = f"Your stats:\nSperms: {player[2]}\nEggs: {player[3]}\n"
+    response += f"Water: {player[4]} ({player[8]})\nFood: {player[5]} ({player[9]})\nMedicine: {player[6]} ({player[10]})\nOre: {player[7]} ({player[11]})\n"
+    response += f"{group_name} coins: {player[12]}\nWar wins: {player[13]}\n"
+    response += f"@{player[1]} coin value: {currency_value:.2f} {group_name} coins\n"
+    response += f"New supplies: +{water} water, +{food} food, +{medicine} medicine, +{ore} ore\n"
+    response += "\nBabies:\n"
+    if babies:
+        response += f"{babies.get(0, 0)} pending birth, {babies.get(1, 0)} growing up\n"
+    else:
+        response += "No babies\n"
+    response += f"\nCitizens ({count_citizens(population)}):\n"
+    if not population:
+        response += "No citizens\n"
+    for role in sorted({role for role, status in population}):
+        statuses = ', '.join(f"{population[(role, status)]} {status}" for status in sorted(status for r, status in population if r == role))
+        averages = ', '.join(f"{stat} {means[(role, stat)]:.0f}" for stat in ('health', 'attack', 'defense') if (role, stat) in means)
+        response += f"{role}: {statuses}" + (f" (avg {averages})" if averages else "") + "\n"
+    if named:
+        response += f"\n{named} citizens have ids (e.g. listed on the market): /citizens [role] to browse them\n"
+    return response
 
 async def mystats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     player_id = update.effective_user.id
-    conn = sqlite3.connect('battle_forge.db')
+    username = update.effective_user.username or f"user_{player_id}"
     try:
-        player = get_player(conn, player_id)
-        if not player:
-            username = update.effective_user.username or f"user_{player_id}"
-            initialize_player_citizens(conn, player_id)
-            create_team(conn, player_id, f"@{username}_team")
-            player = get_player(conn, player_id)
-        grow_babies(conn, player_id)
-        water, food, medicine, ore = produce_supplies(conn, player_id)
-        player = get_player(conn, player_id)
-        babies = get_babies(conn, player_id)
-        citizens = get_citizens(conn, player_id)
-        currency_value = calculate_currency_value(player, citizens, babies)
         group_name = update.effective_chat.title or "group"
-        response = f"Your stats:\nSperms: {player[2]}\nEggs: {player[3]}\n"
-        response += f"Water: {player[4]} ({player[8]})\nFood: {player[5]} ({player[9]})\nMedicine: {player[6]} ({player[10]})\nOre: {player[7]} ({player[11]})\n"
-        response += f"{group_name} coins: {player[12]}\nWar wins: {player[13]}\n"
-        response += f"@{player[1]} coin value: {currency_value:.2f} {group_name} coins\n"
-        response += f"New supplies: +{water} water, +{food} food, +{medicine} medicine, +{ore} ore\n"
-        response += "\nBabies:\n" + (f"{len(babies)} pending birth\n" if babies else "No babies\n")
-        response += "\nCitizens:\n"
-        if not citizens:
-            response += "No citizens\n"
-        else:
-            for citizen in citizens:
-                status = f" ({citizen[8]}{', until ' + datetime.fromisoformat(citizen[9]).strftime('%Y-%m-%d %H:%M') if citizen[8] == 'injured' else ''})"
-                response += f"id: {citizen[0]}, name: {citizen[2]}, role: {citizen[3]}, health: {citizen[4]}, attack: {citizen[5]}, defense: {citizen[6]}{status}\n"
+        response = await db.write(mystats_tx, player_id, username, group_name)
         logger.debug(f"Player {player_id} viewed stats")
         await update.message.reply_text(response)
     except Exception as e:
         logger.error(f"Error in mystats for player {player_id}: {str(e)}")
         await update.message.reply_text("An error occurred while viewing stats.")
-    finally:
-        conn.close()
+
+CITIZENS_PAGE_SIZE = int(os.getenv('BATTLE_FORGE_CITIZENS_PAGE_SIZE', '20'))
+
+def citizens_page_tx(conn, player_id, role, after=None, before=None):
+    # One keyset page of a player's citizens (one role or all) in id order,
+    # starting after `after` or ending before `before`.
+    # Returns (lines, first_id, last_id, has_previous, has_next).
+    c = conn.cursor()
+    where = 'player_id = ? AND status != "dead"' + (' AND role = ?' if role else '')
+    params = (player_id, role) if role else (player_id,)
+    if before is not None:
+        c.execute(f'SELECT * FROM citizens WHERE {where} AND citizen_id < ? ORDER BY citizen_id DESC LIMIT ?',
+                  params + (before, CITIZENS_PAGE_SIZE + 1))
+        rows = c.fetchall()
+        has_previous, has_next = len(rows) > CITIZENS_PAGE_SIZE, True
+        rows = rows[:CITIZENS_PAGE_SIZE][::-1]
+    else:
+        c.execute(f'SELECT * FROM citizens WHERE {where} AND citizen_id > ? ORDER BY citizen_id LIMIT ?',
+                  params + (after or 0, CITIZENS_PAGE_SIZE + 1))
+        rows = c.fetchall()
+        has_previous, has_next = bool(after), len(rows) > CITIZENS_PAGE_SIZE
+        rows = rows[:CITIZENS_PAGE_SIZE]
+    if not rows:
+        return [f"No {role + ' ' if role else ''}citizens with ids here."], None, None, False, False
+    if has_previous and after:
+        c.execute(f'SELECT 1 FROM citizens WHERE {where} AND citizen_id <= ? LIMIT 1', params + (after,))
+        has_previous = c.fetchone() is not None
+    lines = [f"Your {role + ' ' if role else ''}citizens:"]
+    for citizen in rows:
+        status = f" ({citizen[8]}{', until ' + datetime.fromisoformat(citizen[9]).strftime('%Y-%m-%d %H:%M') if citizen[8] == 'injured' else ''})"
+        lines.append(f"id: {citizen[0]}, name: {citizen[2]}, role: {citizen[3]}, health: {citizen[4]}, attack: {citizen[5]}, defense: {citizen[6]}{status}")
+    return lines, rows[0][0], rows[-1][0], has_previous, has_next
+
+def citizens_keyboard(player_id, role, first_id, last_id, has_previous, has_next):
+    # callback data: citizens:<player_id>:<role or ->:<prev|next>:<citizen_id>
+    buttons = []
+    if has_previous:
+        buttons.append(InlineKeyboardButton("◀ Prev", callback_data=f"citizens:{player_id}:{role or '-'}:prev:{first_id}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next ▶", callback_data=f"citizens:{player_id}:{role or '-'}:next:{last_id}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def citizens(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    player_id = update.effective_user.id
+    args = list(context.args)
+    role = args.pop(0) if args and not args[0].isdigit() else None
+    if role and role not in CITIZEN_ROLES or len(args) > 1:
+        await update.message.reply_text(f"Usage: /citizens [role] [cursor] (roles: {', '.join(CITIZEN_ROLES)})")
+        return
+    try:
+        after = int(args[0]) if args else None
+        lines, first_id, last_id, has_previous, has_next = await db.read(citizens_page_tx, player_id, role, after=after)
+        await update.message.reply_text("\n".join(lines),
+                                        reply_markup=citizens_keyboard(player_id, role, first_id, last_id, has_previous, has_next))
+    except ValueError:
+        logger.debug(f"Player {player_id} used invalid citizens cursor")
+        await update.message.reply_text("Cursor must be a citizen id!")
+    except Exception as e:
+        logger.error(f"Error in citizens for player {player_id}: {str(e)}")
+        await update.message.reply_text("An error occurred while listing citizens.")
+
+async def citizens_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Prev/next buttons under a /citizens page; only its owner can turn it
+    query = update.callback_query
+    try:
+        _, owner_id, role, direction, citizen_id = query.data.split(':')
+        if int(owner_id) != update.effective_user.id:
+            await query.answer("These aren't your citizens!", show_alert=True)
+            return
+        role = None if role == '-' else role
+        cursor = {'after': int(citizen_id)} if direction == 'next' else {'before': int(citizen_id)}
+        lines, first_id, last_id, has_previous, has_next = await db.read(citizens_page_tx, int(owner_id), role, **cursor)
+        await query.answer()
+        await query.edit_message_text("\n".join(lines),
+                                      reply_markup=citizens_keyboard(int(owner_id), role, first_id, last_id, has_previous, has_next))
+    except Exception as e:
+        logger.error(f"Error in citizens page for player {update.effective_user.id}: {str(e)}")
+        await query.answer("An error occurred while listing citizens.")
+
+# Market
+# Resources trade on a price-time priority order book: /trade places a sell
+# order and /buy a buy order, both priced per unit. An incoming order fills
+# against the best resting orders on the other side, oldest first within a
+# price and at the resting order's price, and whatever is left rests on the
+# book. Orders hold what they trade while they rest (the seller's goods, the
+# buyer's coins at the limit price), so a fill never has to check either
+# player again. Citizens are unique and stay fixed-price listings taken
+# whole with /accepttrade.
+BOOK_DEPTH = int(os.getenv('BATTLE_FORGE_BOOK_DEPTH', '10'))
+OPEN_TRADES_LIMIT = int(os.getenv('BATTLE_FORGE_OPEN_TRADES_LIMIT', '50'))
+
+def market_accepts(conn, player_id):
+    # One order in ten is turned away, less with active traders: each of the
+    # first 100 takes a tenth of a point off. (This used to subtract ten
+    # points per trader, which refused every order from a starting population.)
+    traders = count_citizens(get_population(conn, player_id), 'trader', 'active')
+    return random.random() < 0.9 + min(traders, 100) * 0.001
+
+def fill_order(conn, order, taker_id, quantity):
+    # Trades `quantity` of a resting order with the taker at the order's
+    # price: the buyer gets the goods, the seller the coins. The taker's side
+    # must already be held by the caller. -> False if the order no longer
+    # has that much open
+    trade_id, owner_id, currency, item, side, price, remaining = order
+    c = conn.cursor()
+    c.execute('''UPDATE trades SET remaining = remaining - ?, status = CASE WHEN remaining = ? THEN 'closed' ELSE status END
+                 WHERE trade_id = ? AND status = 'open' AND remaining >= ?''', (quantity, quantity, trade_id, quantity))
+    if c.rowcount != 1:
+        return False
+    order_book.stage(order[:6] + (remaining - quantity,))
+    buyer_id, seller_id = (owner_id, taker_id) if side == 'buy' else (taker_id, owner_id)
+    adjust_resources(conn, buyer_id, **{item: quantity})
+    add_coins(conn, seller_id, quantity * price)
+    logger.debug(f"Filled {quantity} {item} at {price} on order {trade_id} for player {taker_id}")
+    return True
+
+def place_order(conn, player_id, side, item, quantity, price, group_name):
+    currency = f"{group_name} coin"
+    if side == 'sell':
+        if not adjust_resources(conn, player_id, **{item: -quantity}):
+            logger.debug(f"Player {player_id} has insufficient {item}")
+            return f"Not enough {item}!"
+    elif not add_coins(conn, player_id, -quantity * price):
+        logger.debug(f"Player {player_id} has insufficient coins for a buy order")
+        return f"Not enough {group_name} coins!"
+    remaining = quantity
+    fills = []
+    for order in order_book.resting(currency, item, 'buy' if side == 'sell' else 'sell'):
+        if not remaining or (order[5] > price if side == 'buy' else order[5] < price):
+            break
+        if order[1] == player_id:
+            # Never trade with yourself; your own orders keep their place
+            continue
+        filled = min(remaining, order[6])
+        if not fill_order(conn, order, player_id, filled):
+            continue
+        if side == 'buy':
+            # Held at the limit price, filled at the resting order's
+            add_coins(conn, player_id, filled * (price - order[5]))
+        remaining -= filled
+        fills.append((filled, order[5]))
+    c = conn.cursor()
+    c.execute('''INSERT INTO trades (seller_id, item, quantity, price, currency, status, side, remaining)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+              (player_id, item, quantity, price, currency, 'open' if remaining else 'closed', side, remaining))
+    trade_id = c.lastrowid
+    if remaining:
+        order_book.stage((trade_id, player_id, currency, item, side, price, remaining))
+    logger.debug(f"Player {player_id} placed {side} order {trade_id}: {quantity} {item} at {price}, {quantity - remaining} filled")
+    response = f"{side.capitalize()} order #{trade_id}: {quantity} {item} at {price} {currency} each\n"
+    for filled, fill_price in fills:
+        response += f"Filled {filled} at {fill_price}\n"
+    if remaining:
+        response += f"{remaining} resting on the book (/cancelorder {trade_id} to withdraw)"
+    else:
+        response += "Completely filled!"
+    return response
+
+def trade_tx(conn, player_id, username, item, quantity, price, group_name):
+    player = get_player(conn, player_id)
+    if not player:
+        player = provision_player(conn, player_id, username)
+    if item in PLAYER_RESOURCES:
+        if player[PLAYER_COLUMNS.index(item)] < quantity:
+            logger.debug(f"Player {player_id} has insufficient {item}")
+            return f"Not enough {item}!"
+    elif item.startswith('citizen_') and item[len('citizen_'):] in CITIZEN_ROLES:
+        # A role listing takes a citizen from the cohort; citizens that
+        # already have ids are listed by id
+        c = conn.cursor()
+        c.execute('SELECT count FROM citizen_cohorts WHERE player_id = ? AND role = ? AND status = "active" AND count > 0',
+                  (player_id, item[len('citizen_'):]))
+        if not c.fetchone():
+            logger.debug(f"Player {player_id} has no active cohort citizens for {item}")
+            return f"No active {item[len('citizen_'):]} citizens available! List named ones with citizen_<id> (see /citizens)"
+    elif item.startswith('citizen_') and item[len('citizen_'):].isdigit():
+        citizen_id = int(item[len('citizen_'):])
+        item = f"citizen_{citizen_id}"
+        c = conn.cursor()
+        c.execute('''SELECT EXISTS (SELECT 1 FROM trades WHERE status = 'open' AND item = ?)
+                     FROM citizens WHERE citizen_id = ? AND player_id = ? AND status = 'active' ''', (item, citizen_id, player_id))
+        listed = c.fetchone()
+        if not listed:
+            logger.debug(f"Player {player_id} specified invalid or unavailable citizen id: {citizen_id}")
+            return "Invalid or unavailable citizen id!"
+        if listed[0]:
+            logger.debug(f"Player {player_id} tried to list citizen {citizen_id} twice")
+            return "That citizen is already listed!"
+    else:
+        logger.debug(f"Player {player_id} specified invalid item: {item}")
+        return "Invalid item! Use sperms, eggs, water, food, medicine, ore, citizen_<role> or citizen_<id>"
+    if item.startswith('citizen_') and quantity != 1:
+        logger.debug(f"Player {player_id} tried to list {quantity} of {item}")
+        return "Citizens are listed one at a time: use a quantity of 1!"
+    if not market_accepts(conn, player_id):
+        logger.debug(f"Player {player_id} trade failed due to market fluctuations")
+        return "Trade failed due to market fluctuations!"
+    if item in PLAYER_RESOURCES:
+        return place_order(conn, player_id, 'sell', item, quantity, price, group_name)
+    if item.startswith('citizen_') and item[len('citizen_'):] in CITIZEN_ROLES:
+        # Only now does the listed citizen need an id of its own
+        item = f"citizen_{materialize_citizen(conn, player_id, item[len('citizen_'):])}"
+    create_trade(conn, player_id, item, quantity, price, f"{group_name} coin")
+    logger.debug(f"Player {player_id} created trade: {quantity} {item} for {price} {group_name} coin")
+    return f"Trade created: {quantity} {item} for {price} {group_name} coin"
 
 async def trade(update: Update, context: ContextTypes.DEFAULT_TYPE):
     player_id = update.effective_user.id
     group_name = update.effective_chat.title or "group"
     if len(context.args) != 3:
         logger.debug(f"Player {player_id} used invalid trade syntax")
-        await update.message.reply_text(f"Usage: /trade <item> <quantity> <price> (price in {group_name} coin)")
+        await update.message.reply_text(f"Usage: /trade <item> <quantity> <price> (price in {group_name} coin, per unit for resources)")
         return
     item, quantity, price = context.args
     try:
@@ -1084,40 +3562,8 @@ async def trade(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.debug(f"Player {player_id} specified invalid quantity or price")
             await update.message.reply_text("Quantity and price must be positive!")
             return
-        conn = sqlite3.connect('battle_forge.db')
-        try:
-            player = get_player(conn, player_id)
-            if not player:
-                username = update.effective_user.username or f"user_{player_id}"
-                initialize_player_citizens(conn, player_id)
-                create_team(conn, player_id, f"@{username}_team")
-                player = get_player(conn, player_id)
-            if item in ['sperms', 'eggs', 'water', 'food', 'medicine', 'ore']:
-                index = {'sperms': 2, 'eggs': 3, 'water': 4, 'food': 5, 'medicine': 6, 'ore': 7}[item]
-                if player[index] < quantity:
-                    logger.debug(f"Player {player_id} has insufficient {item}")
-                    await update.message.reply_text(f"Not enough {item}!")
-                    return
-            elif item.startswith('citizen_'):
-                citizen_id = int(item.split('_')[1])
-                if not any(c[0] == citizen_id and c[1] == player_id and c[8] == 'active' for c in get_citizens(conn, player_id)):
-                    logger.debug(f"Player {player_id} specified invalid or unavailable citizen id: {citizen_id}")
-                    await update.message.reply_text("Invalid or unavailable citizen id!")
-                    return
-            else:
-                logger.debug(f"Player {player_id} specified invalid item: {item}")
-                await update.message.reply_text("Invalid item! Use sperms, eggs, water, food, medicine, ore, or citizen_<id>")
-                return
-            traders = sum(1 for c in get_citizens(conn, player_id) if c[3] == 'trader' and c[8] == 'active')
-            if random.random() < 0.9 - traders * 0.1:
-                create_trade(conn, player_id, item, quantity, price, f"{group_name} coin")
-                logger.debug(f"Player {player_id} created trade: {quantity} {item} for {price} {group_name} coin")
-                await update.message.reply_text(f"Trade created: {quantity} {item} for {price} {group_name} coin")
-            else:
-                logger.debug(f"Player {player_id} trade failed due to market fluctuations")
-                await update.message.reply_text("Trade failed due to market fluctuations!")
-        finally:
-            conn.close()
+        username = update.effective_user.username or f"user_{player_id}"
+        await update.message.reply_text(await db.write(trade_tx, player_id, username, item, quantity, price, group_name))
     except ValueError:
         logger.debug(f"Player {player_id} used invalid numbers for trade")
         await update.message.reply_text("Quantity and price must be numbers!")
@@ -1125,97 +3571,242 @@ async def trade(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in trade for player {player_id}: {str(e)}")
         await update.message.reply_text("An error occurred while creating trade.")
 
+def buy_tx(conn, player_id, username, item, quantity, price, group_name):
+    if not get_player(conn, player_id):
+        provision_player(conn, player_id, username)
+    if not market_accepts(conn, player_id):
+        logger.debug(f"Player {player_id} buy order failed due to market fluctuations")
+        return "Trade failed due to market fluctuations!"
+    return place_order(conn, player_id, 'buy', item, quantity, price, group_name)
+
+async def buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    player_id = update.effective_user.id
+    group_name = update.effective_chat.title or "group"
+    if len(context.args) != 3 or context.args[0] not in PLAYER_RESOURCES:
+        logger.debug(f"Player {player_id} used invalid buy syntax")
+        await update.message.reply_text(f"Usage: /buy <{'|'.join(PLAYER_RESOURCES)}> <quantity> <price> (price per unit in {group_name} coin)")
+        return
+    item, quantity, price = context.args
+    try:
+        quantity = int(quantity)
+        price = int(price)
+        if quantity <= 0 or price <= 0:
+            logger.debug(f"Player {player_id} specified invalid quantity or price")
+            await update.message.reply_text("Quantity and price must be positive!")
+            return
+        username = update.effective_user.username or f"user_{player_id}"
+        await update.message.reply_text(await db.write(buy_tx, player_id, username, item, quantity, price, group_name))
+    except ValueError:
+        logger.debug(f"Player {player_id} used invalid numbers for buy")
+        await update.message.reply_text("Quantity and price must be numbers!")
+    except Exception as e:
+        logger.error(f"Error in buy for player {player_id}: {str(e)}")
+        await update.message.reply_text("An error occurred while placing the order.")
+
+def book_text(item, group_name):
+    asks, bids = order_book.depth(f"{group_name} coin", item, BOOK_DEPTH)
+    if not asks and not bids:
+        return f"No open orders for {item}! Place one with /trade or /buy."
+    response = f"{item} order book ({group_name} coin each):\n"
+    response += "Asks (sell):\n"
+    for price, quantity, orders in reversed(asks):
+        response += f"  {price}: {quantity} ({orders} order{'s' if orders != 1 else ''})\n"
+    if asks and bids:
+        response += f"Spread: {asks[0][0] - bids[0][0]}\n"
+    response += "Bids (buy):\n"
+    for price, quantity, orders in bids:
+        response += f"  {price}: {quantity} ({orders} order{'s' if orders != 1 else ''})\n"
+    return response
+
+async def book(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    player_id = update.effective_user.id
+    group_name = update.effective_chat.title or "group"
+    if len(context.args) != 1 or context.args[0] not in PLAYER_RESOURCES:
+        logger.debug(f"Player {player_id} used invalid book syntax")
+        await update.message.reply_text(f"Usage: /book <{'|'.join(PLAYER_RESOURCES)}>")
+        return
+    try:
+        # Served from memory, no database round trip
+        await update.message.reply_text(book_text(context.args[0], group_name))
+    except Exception as e:
+        logger.error(f"Error in book for player {player_id}: {str(e)}")
+        await update.message.reply_text("An error occurred while reading the order book.")
+
+def myorders_tx(conn, player_id):
+    c = conn.cursor()
+    c.execute('''SELECT trade_id, side, item, remaining, quantity, price, currency FROM trades
+                 WHERE seller_id = ? AND status = 'open' ORDER BY trade_id''', (player_id,))
+    orders = c.fetchall()
+    if not orders:
+        return "You have no open orders!"
+    response = "Your open orders:\n"
+    for trade_id, side, item, remaining, quantity, price, currency in orders:
+        response += f"#{trade_id} {side} {remaining}/{quantity} {item} at {price} {currency}\n"
+    return response + "Use /cancelorder <id> to withdraw one."
+
+async def myorders(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    player_id = update.effective_user.id
+    try:
+        await update.message.reply_text(await db.read(myorders_tx, player_id))
+    except Exception as e:
+        logger.error(f"Error in myorders for player {player_id}: {str(e)}")
+        await update.message.reply_text("An error occurred while listing your orders.")
+
+def cancelorder_tx(conn, player_id, trade_id):
+    c = conn.cursor()
+    # A closed order keeps its remaining quantity: what was withdrawn unfilled
+    c.execute('''UPDATE trades SET status = 'closed' WHERE trade_id = ? AND seller_id = ? AND status = 'open'
+                 RETURNING currency, item, side, price, remaining''', (trade_id, player_id))
+    row = c.fetchone()
+    if not row:
+        logger.debug(f"Player {player_id} tried to cancel unknown or closed order {trade_id}")
+        return "No open order of yours with that id!"
+    currency, item, side, price, remaining = row
+    if item in PLAYER_RESOURCES:
+        order_book.stage((trade_id, player_id, currency, item, side, price, 0))
+        if side == 'sell':
+            adjust_resources(conn, player_id, **{item: remaining})
+        else:
+            add_coins(conn, player_id, remaining * price)
+    logger.debug(f"Player {player_id} cancelled order {trade_id}")
+    return f"Order #{trade_id} cancelled, {remaining} {item} withdrawn."
+
+async def cancelorder(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    player_id = update.effective_user.id
+    try:
+        if len(context.args) != 1:
+            await update.message.reply_text("Usage: /cancelorder <order_id>")
+            return
+        await update.message.reply_text(await db.write(cancelorder_tx, player_id, int(context.args[0])))
+    except ValueError:
+        logger.debug(f"Player {player_id} used invalid order id")
+        await update.message.reply_text("Order id must be a number!")
+    except Exception as e:
+        logger.error(f"Error in cancelorder for player {player_id}: {str(e)}")
+        await update.message.reply_text("An error occurred while cancelling the order.")
+
+def open_trades_tx(conn):
+    trades = get_open_trades(conn, OPEN_TRADES_LIMIT)
+    response = "Resources trade on the order book: /book <item>, /buy, /trade\n"
+    if trades:
+        response += "Open citizen listings:\n"
+    for trade in trades:
+        response += f"id: {trade[0]}, seller: @{trade[1]}, item: {trade[2]}, quantity: {trade[3]}, price: {trade[4]} {trade[5]}\n"
+    return response
+
+def accepttrade_tx(conn, player_id, username, trade_id, group_name):
+    # One keyed read, then only check-and-set writes: the buyer pays only if
+    # they can, the trade closes only while it is still open and the citizen
+    # moves only while its seller still has it. When a step fails the ones
+    # before it are undone, so a trade is taken whole and once, or not at all.
+    c = conn.cursor()
+    c.execute("SELECT seller_id, item, quantity, price, currency, side, remaining FROM trades WHERE trade_id = ? AND status = 'open'",
+              (trade_id,))
+    trade = c.fetchone()
+    if not trade:
+        logger.debug(f"Player {player_id} specified invalid or closed trade id: {trade_id}")
+        return "Invalid or closed trade id!"
+    seller_id, item, quantity, price, currency, side, remaining = trade
+    if currency != f"{group_name} coin":
+        logger.debug(f"Player {player_id} attempted to accept trade with invalid currency: {currency}")
+        return f"Trade uses invalid currency: {currency}!"
+    if seller_id == player_id:
+        logger.debug(f"Player {player_id} tried to accept their own trade")
+        return "You can't accept your own trade!"
+    if not get_player(conn, player_id):
+        provision_player(conn, player_id, username)
+    if item in PLAYER_RESOURCES:
+        # Takes the whole of a resting order at its price
+        if side == 'sell' and not add_coins(conn, player_id, -remaining * price):
+            logger.debug(f"Player {player_id} has insufficient coins for trade {trade_id}")
+            return f"Not enough {group_name} coins!"
+        if side == 'buy' and not adjust_resources(conn, player_id, **{item: -remaining}):
+            logger.debug(f"Player {player_id} has insufficient {item} for trade {trade_id}")
+            return f"Not enough {item}!"
+        if not fill_order(conn, (trade_id, seller_id, currency, item, side, price, remaining), player_id, remaining):
+            if side == 'sell':
+                add_coins(conn, player_id, remaining * price)
+            else:
+                adjust_resources(conn, player_id, **{item: remaining})
+            logger.debug(f"Player {player_id} lost the race for order {trade_id}")
+            return "Someone else just took that trade!"
+        logger.debug(f"Player {player_id} accepted order {trade_id}: {remaining} {item} at {price}")
+        return f"Trade accepted: {remaining} {item} for {remaining * price} {group_name} coins!"
+    if not add_coins(conn, player_id, -price):
+        logger.debug(f"Player {player_id} has insufficient coins for trade {trade_id}")
+        return f"Not enough {group_name} coins!"
+    c.execute("UPDATE trades SET status = 'closed', remaining = 0 WHERE trade_id = ? AND status = 'open'", (trade_id,))
+    if c.rowcount != 1:
+        add_coins(conn, player_id, price)
+        logger.debug(f"Player {player_id} lost the race for trade {trade_id}")
+        return "Someone else just took that trade!"
+    citizen_id = int(item.split('_')[1])
+    c.execute("UPDATE citizens SET player_id = ? WHERE citizen_id = ? AND player_id = ? AND status = 'active'",
+              (player_id, citizen_id, seller_id))
+    if c.rowcount != 1:
+        # The listing stays closed, unfilled: its citizen is gone or no longer active
+        add_coins(conn, player_id, price)
+        c.execute('UPDATE trades SET remaining = quantity WHERE trade_id = ?', (trade_id,))
+        logger.debug(f"Player {player_id} specified invalid or unavailable citizen id: {citizen_id}")
+        return "Citizen is no longer available!"
+    add_coins(conn, seller_id, price)
+    logger.debug(f"Player {player_id} accepted trade {trade_id}: {quantity} {item} for {price} {group_name} coins")
+    return f"Trade accepted: {quantity} {item} for {price} {group_name} coins!"
+
 async def accepttrade(update: Update, context: ContextTypes.DEFAULT_TYPE):
     player_id = update.effective_user.id
     group_name = update.effective_chat.title or "group"
-    conn = sqlite3.connect('battle_forge.db')
     try:
         if not context.args:
-            trades = get_open_trades(conn)
-            response = "Open trades:\n"
-            for trade in trades:
-                seller = get_player(conn, trade[1])
-                response += f"id: {trade[0]}, seller: @{seller[1]}, item: {trade[2]}, quantity: {trade[3]}, price: {trade[4]} {trade[5]}\n"
+            response = await db.read(open_trades_tx)
             logger.debug(f"Player {player_id} viewed open trades")
             await update.message.reply_text(response or "No open trades!")
             return
         trade_id = int(context.args[0])
-        c = conn.cursor()
-        c.execute('SELECT * FROM trades WHERE trade_id = ? AND status = "open"', (trade_id,))
-        trade = c.fetchone()
-        if not trade:
-            logger.debug(f"Player {player_id} specified invalid or closed trade id: {trade_id}")
-            await update.message.reply_text("Invalid or closed trade id!")
-            return
-        if trade[5] != f"{group_name} coin":
-            logger.debug(f"Player {player_id} attempted to accept trade with invalid currency: {trade[5]}")
-            await update.message.reply_text(f"Trade uses invalid currency: {trade[5]}!")
-            return
-        if trade[1] == player_id:
-            logger.debug(f"Player {player_id} tried to accept their own trade")
-            await update.message.reply_text("You can't accept your own trade!")
-            return
-        buyer = get_player(conn, player_id)
-        if not buyer:
-            username = update.effective_user.username or f"user_{player_id}"
-            initialize_player_citizens(conn, player_id)
-            create_team(conn, player_id, f"@{username}_team")
-            buyer = get_player(conn, player_id)
-        if buyer[12] < trade[4]:
-            logger.debug(f"Player {player_id} has insufficient coins for trade {trade_id}")
-            await update.message.reply_text(f"Not enough {group_name} coins!")
-            return
-        seller = get_player(conn, trade[1])
-        resource_map = {'sperms': 2, 'eggs': 3, 'water': 4, 'food': 5, 'medicine': 6, 'ore': 7}
-        if trade[2] in resource_map:
-            index = resource_map[trade[2]]
-            if seller[index] < trade[3]:
-                logger.debug(f"Seller {trade[1]} has insufficient {trade[2]} for trade {trade_id}")
-                await update.message.reply_text(f"Seller no longer has enough {trade[2]}!")
-                c.execute('UPDATE trades SET status = "closed" WHERE trade_id = ?', (trade_id,))
-                conn.commit()
-                return
-            buyer_data = list(buyer)
-            seller_data = list(seller)
-            buyer_data[index] += trade[3]
-            seller_data[index] -= trade[3]
-            buyer_data[12] -= trade[4]
-            seller_data[12] += trade[4]
-            update_player(conn, buyer[0], buyer[1], *buyer_data[2:])
-            update_player(conn, seller[0], seller[1], *seller_data[2:])
-        elif trade[2].startswith('citizen_'):
-            citizen_id = int(trade[2].split('_')[1])
-            citizen = next((c for c in get_citizens(conn, trade[1]) if c[0] == citizen_id and c[8] == 'active'), None)
-            if not citizen:
-                logger.debug(f"Player {player_id} specified invalid or unavailable citizen id: {citizen_id}")
-                await update.message.reply_text("Citizen is no longer available!")
-                c.execute('UPDATE trades SET status = "closed" WHERE trade_id = ?', (trade_id,))
-                conn.commit()
-                return
-            c.execute('UPDATE citizens SET player_id = ? WHERE citizen_id = ?', (player_id, citizen_id))
-            buyer_data = list(buyer)
-            seller_data = list(seller)
-            buyer_data[12] -= trade[4]
-            seller_data[12] += trade[4]
-            update_player(conn, buyer[0], buyer[1], *buyer_data[2:])
-            update_player(conn, seller[0], seller[1], *seller_data[2:])
-        c.execute('UPDATE trades SET status = "closed" WHERE trade_id = ?', (trade_id,))
-        conn.commit()
-        logger.debug(f"Player {player_id} accepted trade {trade_id}: {trade[3]} {trade[2]} for {trade[4]} {group_name} coins")
-        await update.message.reply_text(f"Trade accepted: {trade[3]} {trade[2]} for {trade[4]} {group_name} coins!")
+        username = update.effective_user.username or f"user_{player_id}"
+        await update.message.reply_text(await db.write(accepttrade_tx, player_id, username, trade_id, group_name))
     except ValueError:
         logger.debug(f"Player {player_id} used invalid trade id")
         await update.message.reply_text("Trade id must be a number!")
     except Exception as e:
         logger.error(f"Error in accepttrade for player {player_id}: {str(e)}")
         await update.message.reply_text("An error occurred while accepting trade.")
-    finally:
-        conn.close()
+
+def ensure_player_team(conn, player_id, username):
+    player = get_player(conn, player_id)
+    if not player:
+        player = provision_player(conn, player_id, username)
+    team = get_player_team(conn, player_id)
+    if not team:
+        create_team(conn, player_id, f"@{username}_team")
+        team = get_player_team(conn, player_id)
+        if not team:
+            logger.error(f"Failed to create team for player {player_id}")
+    return team
+
+def sportevent_tx(conn, player_id, username, sport, num_teams, chat_id, group_name):
+    # Returns (reply, match_id to schedule). A race starts after the join
+    # window whether or not it filled up, with AI teams in the empty places.
+    team = ensure_player_team(conn, player_id, username)
+    if not team:
+        return "Failed to create your team!", None
+    starts_at = (datetime.now() + timedelta(seconds=supervisor.start_delay)).isoformat() if sport in RACING_SPORTS else None
+    match_id = create_match(conn, sport, team[0], num_teams, chat_id, group_name, starts_at)
+    if not match_id:
+        logger.error(f"Failed to create match for player {player_id}, team {team[0]}")
+        return "Failed to create sport event!", None
+    logger.debug(f"Player {player_id} created match {match_id}: {sport} for {num_teams} teams")
+    response = (f"{sport} event created for {num_teams} teams! {team[2]} has joined (match id: {match_id}). "
+                f"use /acceptsport {match_id} to join! use /gamble {match_id} <team_name> <amount> to bet!")
+    if starts_at:
+        response += f" The race starts in {supervisor.start_delay:.0f} seconds; AI teams take any empty places."
+        return response, match_id
+    return response, None
 
 async def sportevent(update: Update, context: ContextTypes.DEFAULT_TYPE):
     player_id = update.effective_user.id
     group_name = update.effective_chat.title or "group"
-    valid_sports = ['basketball', 'soccer', 'volleyball', 'f1_racing', 'horse_racing', 'boxing']
+    valid_sports = SPORTS
     if len(context.args) != 2:
         logger.debug(f"Player {player_id} used invalid sportevent syntax")
         await update.message.reply_text(f"Usage: /sportevent <sport> <num_teams> (sports: {', '.join(valid_sports)})")
@@ -1227,10 +3818,10 @@ async def sportevent(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.debug(f"Player {player_id} specified invalid sport: {sport}")
             await update.message.reply_text(f"Invalid sport! Choose from: {', '.join(valid_sports)}")
             return
-        if sport in ['f1_racing', 'horse_racing']:
-            if not 2 <= num_teams <= 4:
+        if sport in RACING_SPORTS:
+            if not 2 <= num_teams <= RACING_MAX_TEAMS:
                 logger.debug(f"Player {player_id} specified invalid number of teams for {sport}: {num_teams}")
-                await update.message.reply_text(f"Racing sports require 2–4 teams, got {num_teams}")
+                await update.message.reply_text(f"Racing sports require 2–{RACING_MAX_TEAMS} teams, got {num_teams}")
                 return
         else:
             if num_teams != 2:
@@ -1241,38 +3832,12 @@ async def sportevent(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.debug(f"Player {player_id} specified invalid number of teams: {num_teams}")
             await update.message.reply_text("Number of teams must be at least 2!")
             return
-        conn = sqlite3.connect('battle_forge.db')
-        try:
-            player = get_player(conn, player_id)
-            if not player:
-                username = update.effective_user.username or f"user_{player_id}"
-                initialize_player_citizens(conn, player_id)
-                create_team(conn, player_id, f"@{username}_team")
-                player = get_player(conn, player_id)
-            team = get_player_team(conn, player_id)
-            if not team:
-                team_name = f"@{update.effective_user.username or f'user_{player_id}'}_team"
-                create_team(conn, player_id, team_name)
-                team = get_player_team(conn, player_id)
-                if not team:
-                    logger.error(f"Failed to create team for player {player_id}")
-                    await update.message.reply_text("Failed to create your team!")
-                    return
-            match_id = create_match(conn, sport, team[0], num_teams)
-            if not match_id:
-                logger.error(f"Failed to create match for player {player_id}, team {team[0]}")
-                await update.message.reply_text("Failed to create sport event!")
-                return
-            logger.debug(f"Player {player_id} created match {match_id}: {sport} for {num_teams} teams")
-            await update.message.reply_text(
-                f"{sport} event created for {num_teams} teams! {team[2]} has joined (match id: {match_id}). "
-                f"use /acceptsport {match_id} to join! use /gamble {match_id} <team_name> <amount> to bet!"
-            )
-        except Exception as e:
-            logger.error(f"Error in sportevent for player {player_id}: {str(e)}")
-            await update.message.reply_text("An error occurred while creating sport event.")
-        finally:
-            conn.close()
+        username = update.effective_user.username or f"user_{player_id}"
+        response, match_id = await db.write(sportevent_tx, player_id, username, sport, num_teams,
+                                            update.effective_chat.id, group_name)
+        await update.message.reply_text(response)
+        if match_id:
+            supervisor.schedule(context.bot, match_id)
     except ValueError:
         logger.debug(f"Player {player_id} used invalid number of teams")
         await update.message.reply_text("Number of teams must be a number!")
@@ -1280,6 +3845,38 @@ async def sportevent(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in sportevent for player {player_id}: {str(e)}")
         await update.message.reply_text("An error occurred while creating sport event.")
 
+def acceptsport_tx(conn, player_id, username, match_id, chat_id, group_name):
+    # Returns (reply, scheduled); scheduled is True once the last team has joined
+    c = conn.cursor()
+    c.execute('SELECT * FROM matches WHERE match_id = ? AND status = "open"', (match_id,))
+    match = c.fetchone()
+    if not match:
+        logger.debug(f"Player {player_id} specified invalid or closed match id: {match_id}")
+        return "Invalid or closed match id!", False
+    team = ensure_player_team(conn, player_id, username)
+    if not team:
+        return "Failed to create your team!", False
+    team_ids = json.loads(match[2])
+    if team[0] in team_ids:
+        logger.debug(f"Player {player_id} is already in match {match_id}")
+        return "You have already joined this match!", False
+    if len(team_ids) >= match[3]:
+        logger.debug(f"Match {match_id} is already full")
+        return "This match is already full!", False
+    team_ids.append(team[0])
+    update_match(conn, match_id, 'open', team_ids=team_ids)
+    if len(team_ids) == match[3]:
+        # A random match keeps the start it was announced with
+        starts_at = match[10] or (datetime.now() + timedelta(seconds=supervisor.start_delay)).isoformat()
+        c.execute('''UPDATE matches SET status = 'scheduled', starts_at = ?, chat_id = COALESCE(chat_id, ?),
+                     group_name = COALESCE(group_name, ?) WHERE match_id = ?''', (starts_at, chat_id, group_name, match_id))
+        delay = max((datetime.fromisoformat(starts_at) - datetime.now()).total_seconds(), 0)
+        logger.debug(f"Match {match_id} is now full, starting in {delay:.0f} seconds")
+        return f"{match[1]} event full! Match starting in {delay:.0f} seconds...", True
+    logger.debug(f"Player {player_id} joined match {match_id}")
+    return (f"You joined {match[1]} match! Waiting for {match[3] - len(team_ids)} more teams. "
+            f"use /gamble {match_id} <team_name> <amount> to bet!"), False
+
 async def acceptsport(update: Update, context: ContextTypes.DEFAULT_TYPE):
     player_id = update.effective_user.id
     group_name = update.effective_chat.title or "group"
@@ -1289,57 +3886,11 @@ async def acceptsport(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     try:
         match_id = int(context.args[0])
-        conn = sqlite3.connect('battle_forge.db')
-        try:
-            c = conn.cursor()
-            c.execute('SELECT * FROM matches WHERE match_id = ? AND status = "open"', (match_id,))
-            match = c.fetchone()
-            if not match:
-                logger.debug(f"Player {player_id} specified invalid or closed match id: {match_id}")
-                await update.message.reply_text("Invalid or closed match id!")
-                return
-            player = get_player(conn, player_id)
-            if not player:
-                username = update.effective_user.username or f"user_{player_id}"
-                initialize_player_citizens(conn, player_id)
-                create_team(conn, player_id, f"@{username}_team")
-                player = get_player(conn, player_id)
-            team = get_player_team(conn, player_id)
-            if not team:
-                team_name = f"@{update.effective_user.username or f'user_{player_id}'}_team"
-                create_team(conn, player_id, team_name)
-                team = get_player_team(conn, player_id)
-                if not team:
-                    logger.error(f"Failed to create team for player {player_id}")
-                    await update.message.reply_text("Failed to create your team!")
-                    return
-            team_ids = json.loads(match[2])
-            if team[0] in team_ids:
-                logger.debug(f"Player {player_id} is already in match {match_id}")
-                await update.message.reply_text("You have already joined this match!")
-                return
-            if len(team_ids) >= match[3]:
-                logger.debug(f"Match {match_id} is already full")
-                await update.message.reply_text("This match is already full!")
-                return
-            team_ids.append(team[0])
-            update_match(conn, match_id, 'open', team_ids=team_ids)
-            if len(team_ids) == match[3]:
-                logger.debug(f"Match {match_id} is now full, starting in 30 seconds")
-                await update.message.reply_text(f"{match[1]} event full! Match starting in 30 seconds...")
-                await asyncio.sleep(30)  # 30-second delay before match starts
-                await simulate_match(update, context, match_id, match[1], team_ids)
-            else:
-                logger.debug(f"Player {player_id} joined match {match_id}")
-                await update.message.reply_text(
-                    f"You joined {match[1]} match! Waiting for {match[3] - len(team_ids)} more teams. "
-                    f"use /gamble {match_id} <team_name> <amount> to bet!"
-                )
-        except Exception as e:
-            logger.error(f"Error in acceptsport for player {player_id}: {str(e)}")
-            await update.message.reply_text("An error occurred while joining sport event.")
-        finally:
-            conn.close()
+        username = update.effective_user.username or f"user_{player_id}"
+        response, scheduled = await db.write(acceptsport_tx, player_id, username, match_id, update.effective_chat.id, group_name)
+        await update.message.reply_text(response)
+        if scheduled:
+            supervisor.schedule(context.bot, match_id)
     except ValueError:
         logger.debug(f"Player {player_id} used invalid match id")
         await update.message.reply_text("Match id must be a number!")
@@ -1347,31 +3898,182 @@ async def acceptsport(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in acceptsport for player {player_id}: {str(e)}")
         await update.message.reply_text("An error occurred while joining sport event.")
 
+def matchstatus_tx(conn, match_id):
+    match = get_match(conn, match_id)
+    if not match:
+        return "Invalid match id!"
+    teams = [team for team in get_teams(conn, json.loads(match[2])) if team]
+    response = f"Match {match_id} ({match[1]}): {match[4]}\n"
+    response += f"Teams ({len(teams)}/{match[3]}): {', '.join(team[2] for team in teams)}\n"
+    if match[4] in ('open', 'scheduled') and match[10]:
+        delay = max((datetime.fromisoformat(match[10]) - datetime.now()).total_seconds(), 0)
+        response += f"Starts in {delay:.0f} seconds\n"
+    elif match[4] == 'running' and match[11]:
+        elapsed = (datetime.now() - datetime.fromisoformat(match[11])).total_seconds()
+        response += f"Running for {elapsed:.0f} seconds\n"
+    return response
+
+async def matchstatus(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    player_id = update.effective_user.id
+    if not context.args:
+        stats = supervisor.stats()
+        await update.message.reply_text(f"Matches in progress: {stats['running']} running, "
+                                        f"{stats['supervised'] - stats['running']} waiting to start. "
+                                        "Use /matchstatus <match_id> for one match.")
+        return
+    try:
+        match_id = int(context.args[0])
+        await update.message.reply_text(await db.read(matchstatus_tx, match_id))
+    except ValueError:
+        logger.debug(f"Player {player_id} used invalid match id")
+        await update.message.reply_text("Match id must be a number!")
+    except Exception as e:
+        logger.error(f"Error in matchstatus for player {player_id}: {str(e)}")
+        await update.message.reply_text("An error occurred while checking the match.")
+
+def matchlog_tx(conn, match_id, page):
+    # Returns the reply lines for one page of a match's event log
+    match = get_match(conn, match_id)
+    if not match:
+        return ["Invalid match id!"]
+    names = [team[2] if team else "?" for team in get_teams(conn, json.loads(match[2]))]
+    total, rows = get_match_events(conn, match_id, (page - 1) * MATCH_LOG_PAGE_SIZE, MATCH_LOG_PAGE_SIZE)
+    if not total:
+        return [f"No events recorded for match {match_id} yet."]
+    pages = -(-total // MATCH_LOG_PAGE_SIZE)
+    if not rows:
+        return [f"Match {match_id} has only {pages} pages of events!"]
+    lines = [f"Match {match_id} ({match[1]}) events, page {page}/{pages}:"]
+    lines += [match_log_line(names, clock, kind, team, points, scores) for clock, kind, team, points, *scores in rows]
+    if page < pages:
+        lines.append(f"Use /matchlog {match_id} {page + 1} for more")
+    return lines
+
+async def matchlog(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    player_id = update.effective_user.id
+    if not 1 <= len(context.args) <= 2:
+        await update.message.reply_text("Usage: /matchlog <match_id> [page]")
+        return
+    try:
+        match_id = int(context.args[0])
+        page = int(context.args[1]) if len(context.args) > 1 else 1
+        if page < 1:
+            await update.message.reply_text("Page must be positive!")
+            return
+        for text in chunk_lines(await db.read(matchlog_tx, match_id, page)):
+            await update.message.reply_text(text)
+    except ValueError:
+        logger.debug(f"Player {player_id} used invalid matchlog arguments")
+        await update.message.reply_text("Match id and page must be numbers!")
+    except Exception as e:
+        logger.error(f"Error in matchlog for player {player_id}: {str(e)}")
+        await update.message.reply_text("An error occurred while loading the match log.")
+
+def cancelmatch_tx(conn, player_id, match_id):
+    # Returns (reply, cancelled); only the creator can cancel, and only before it starts
+    match = get_match(conn, match_id)
+    if not match or match[4] not in ('open', 'scheduled'):
+        return "Invalid or already started match id!", False
+    c = conn.cursor()
+    c.execute('SELECT 1 FROM tournament_fixtures WHERE match_id = ?', (match_id,))
+    if c.fetchone():
+        return "Tournament matches can't be cancelled!", False
+    creator = get_team(conn, json.loads(match[2])[0])
+    if not creator or creator[1] != player_id:
+        logger.debug(f"Player {player_id} tried to cancel match {match_id} they didn't create")
+        return "Only the player who created this match can cancel it!", False
+    refunds = cancel_match_tx(conn, match_id)
+    logger.debug(f"Player {player_id} cancelled match {match_id}, {refunds} wagers refunded")
+    return f"Match {match_id} cancelled. {refunds} wagers refunded.", True
+
+async def cancelmatch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    player_id = update.effective_user.id
+    if not context.args:
+        await update.message.reply_text("Usage: /cancelmatch <match_id>")
+        return
+    try:
+        match_id = int(context.args[0])
+        response, cancelled = await db.write(cancelmatch_tx, player_id, match_id)
+        if cancelled:
+            supervisor.cancel(match_id)
+        await update.message.reply_text(response)
+    except ValueError:
+        logger.debug(f"Player {player_id} used invalid match id")
+        await update.message.reply_text("Match id must be a number!")
+    except Exception as e:
+        logger.error(f"Error in cancelmatch for player {player_id}: {str(e)}")
+        await update.message.reply_text("An error occurred while cancelling the match.")
+
+def teamstats_tx(conn, player_id, username):
+    team = ensure_player_team(conn, player_id, username)
+    response = f"Team stats for {team[2]}:\n"
+    response += f"Wins: {team[3]}\nWin streak: {team[4]}\nPower: {team[5]}\n"
+    response += "Supports all sports: basketball, soccer, volleyball, f1_racing, horse_racing, boxing"
+    return response
+
 async def teamstats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     player_id = update.effective_user.id
-    conn = sqlite3.connect('battle_forge.db')
+    username = update.effective_user.username or f"user_{player_id}"
     try:
-        player = get_player(conn, player_id)
-        if not player:
-            username = update.effective_user.username or f"user_{player_id}"
-            initialize_player_citizens(conn, player_id)
-            create_team(conn, player_id, f"@{username}_team")
-            player = get_player(conn, player_id)
-        team = get_player_team(conn, player_id)
-        if not team:
-            team_name = f"@{update.effective_user.username or f'user_{player_id}'}_team"
-            create_team(conn, player_id, team_name)
-            team = get_player_team(conn, player_id)
-        response = f"Team stats for {team[2]}:\n"
-        response += f"Wins: {team[3]}\nWin streak: {team[4]}\nPower: {team[5]}\n"
-        response += "Supports all sports: basketball, soccer, volleyball, f1_racing, horse_racing, boxing"
+        response = await db.write(teamstats_tx, player_id, username)
         logger.debug(f"Player {player_id} viewed team stats")
         await update.message.reply_text(response)
     except Exception as e:
         logger.error(f"Error in teamstats for player {player_id}: {str(e)}")
         await update.message.reply_text("An error occurred while viewing team stats.")
-    finally:
-        conn.close()
+
+def quoted_field(conn, match, teams):
+    # Races are quoted on their full field. Places still empty go to AI teams
+    # at the start, drawn from those not in the race (see fill_with_ai_teams),
+    # so each counts at their mean power; if there aren't enough, all of them
+    # race and the rest are new AI teams at the base power of 100.
+    missing = match[3] - len(teams)
+    if match[1] not in RACING_SPORTS or missing <= 0:
+        return teams
+    c = conn.cursor()
+    available = 'FROM teams WHERE player_id IS NULL AND team_id NOT IN (SELECT value FROM json_each(?))'
+    c.execute(f'SELECT COUNT(*), AVG(power) {available}', (match[2],))
+    count, mean_power = c.fetchone()
+    if count >= missing:
+        return teams + [(None, None, None, 0, 0, round(mean_power))] * missing
+    c.execute(f'SELECT * {available}', (match[2],))
+    return teams + c.fetchall() + [(None, None, None, 0, 0, 100)] * (missing - count)
+
+def gamble_quote_tx(conn, match_id, team_name):
+    # Returns (reply, team id, multiplier), the reply None when a bet can be
+    # placed. Runs on a reader: the trials behind a quote never hold up writes.
+    match = get_match(conn, match_id)
+    if not match or match[4] not in ('open', 'scheduled'):
+        return "Invalid or closed match id!", None, None
+    teams = [team for team in get_teams(conn, json.loads(match[2])) if team]
+    if team_name not in [team[2] for team in teams]:
+        return "Invalid team name!", None, None
+    team_id = next(team[0] for team in teams if team[2] == team_name)
+    field = quoted_field(conn, match, teams)
+    if len(field) < 2:
+        return "Betting opens once a second team has joined!", None, None
+    odds = odds_cache.get(match[1], field)
+    multiplier = odds.multipliers[odds.team_ids.index(team_id)]
+    if multiplier is None:
+        return f"{team_name} can't win this match, bets on it are closed!", None, None
+    return None, team_id, multiplier
+
+def gamble_tx(conn, player_id, username, match_id, team_id, team_name, amount, multiplier, group_name):
+    # The payout is fixed at the multiplier quoted just before; bets close
+    # when the match starts running
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM matches WHERE match_id = ? AND status IN ('open', 'scheduled')", (match_id,))
+    if not c.fetchone():
+        logger.debug(f"Player {player_id} specified invalid or closed match id: {match_id}")
+        return "Invalid or closed match id!"
+    if not get_player(conn, player_id):
+        provision_player(conn, player_id, username)
+    if not add_coins(conn, player_id, -amount):
+        logger.debug(f"Player {player_id} has insufficient {group_name} coins")
+        return f"Not enough {group_name} coins!"
+    create_wager(conn, player_id, match_id, team_id, amount, multiplier)
+    logger.debug(f"Player {player_id} placed bet of {amount} on {team_name} for match {match_id} at {multiplier}x")
+    return f"Bet placed: {amount} {group_name} coins on {team_name} for match {match_id} at {multiplier}x!"
 
 async def gamble(update: Update, context: ContextTypes.DEFAULT_TYPE):
     player_id = update.effective_user.id
@@ -1388,42 +4090,14 @@ async def gamble(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.debug(f"Player {player_id} specified invalid bet amount: {amount}")
             await update.message.reply_text("Bet amount must be positive!")
             return
-        conn = sqlite3.connect('battle_forge.db')
-        try:
-            c = conn.cursor()
-            c.execute('SELECT * FROM matches WHERE match_id = ? AND status = "open"', (match_id,))
-            match = c.fetchone()
-            if not match:
-                logger.debug(f"Player {player_id} specified invalid or closed match id: {match_id}")
-                await update.message.reply_text("Invalid or closed match id!")
-                return
-            team_ids = json.loads(match[2])
-            teams = [get_team(conn, team_id) for team_id in team_ids]
-            if not teams or team_name not in [team[2] for team in teams if team]:
-                logger.debug(f"Player {player_id} specified invalid team: {team_name}")
-                await update.message.reply_text("Invalid team name!")
-                return
-            team_id = next(team[0] for team in teams if team and team[2] == team_name)
-            player = get_player(conn, player_id)
-            if not player:
-                username = update.effective_user.username or f"user_{player_id}"
-                initialize_player_citizens(conn, player_id)
-                create_team(conn, player_id, f"@{username}_team")
-                player = get_player(conn, player_id)
-            if player[12] < amount:
-                logger.debug(f"Player {player_id} has insufficient {group_name} coins")
-                await update.message.reply_text(f"Not enough {group_name} coins!")
-                return
-            create_wager(conn, player_id, match_id, team_id, amount)
-            update_player(conn, player_id, player[1], player[2], player[3], player[4], player[5], player[6], player[7],
-                         player[8], player[9], player[10], player[11], player[12] - amount, player[13], player[14], player[15], player[16])
-            logger.debug(f"Player {player_id} placed bet of {amount} on {team_name} for match {match_id}")
-            await update.message.reply_text(f"Bet placed: {amount} {group_name} coins on {team_name} for match {match_id}!")
-        except Exception as e:
-            logger.error(f"Error in gamble for player {player_id}: {str(e)}")
-            await update.message.reply_text("An error occurred while placing bet.")
-        finally:
-            conn.close()
+        response, team_id, multiplier = await db.read(gamble_quote_tx, match_id, team_name)
+        if response:
+            logger.debug(f"Player {player_id} can't bet on {team_name} in match {match_id}: {response}")
+            await update.message.reply_text(response)
+            return
+        username = update.effective_user.username or f"user_{player_id}"
+        await update.message.reply_text(await db.write(gamble_tx, player_id, username, match_id, team_id, team_name, amount,
+                                                       multiplier, group_name))
     except ValueError:
         logger.debug(f"Player {player_id} used invalid match id or amount")
         await update.message.reply_text("Match id and amount must be numbers!")
@@ -1431,6 +4105,217 @@ async def gamble(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in gamble for player {player_id}: {str(e)}")
         await update.message.reply_text("An error occurred while placing bet.")
 
+def odds_tx(conn, match_id):
+    match = get_match(conn, match_id)
+    if not match or match[4] not in ('open', 'scheduled'):
+        return "Invalid or closed match id!"
+    teams = [team for team in get_teams(conn, json.loads(match[2])) if team]
+    field = quoted_field(conn, match, teams)
+    if len(field) < 2:
+        return "Odds are quoted once a second team has joined!"
+    odds = odds_cache.get(match[1], field)
+    response = f"Odds for match {match_id} ({match[1]}):\n"
+    for team, probability, multiplier in zip(teams, odds.probabilities, odds.multipliers):
+        response += f"{team[2]}: {probability:.1%} to win, pays {f'{multiplier}x' if multiplier else 'nothing'}\n"
+    if len(field) > len(teams):
+        response += f"{len(field) - len(teams)} empty places go to AI teams at the start\n"
+    if odds.tie:
+        response += f"Tie: {odds.tie:.1%} (all bets lose)\n"
+    return response
+
+async def odds(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    player_id = update.effective_user.id
+    if not context.args:
+        await update.message.reply_text("Usage: /odds <match_id>")
+        return
+    try:
+        match_id = int(context.args[0])
+        await update.message.reply_text(await db.read(odds_tx, match_id))
+    except ValueError:
+        logger.debug(f"Player {player_id} used invalid match id")
+        await update.message.reply_text("Match id must be a number!")
+    except Exception as e:
+        logger.error(f"Error in odds for player {player_id}: {str(e)}")
+        await update.message.reply_text("An error occurred while fetching odds.")
+
+def tournament_tx(conn, player_id, username, sport, format, size, chat_id, group_name):
+    # Returns (reply, tournament id to schedule); one tournament at a time per chat
+    c = conn.cursor()
+    c.execute("SELECT tournament_id FROM tournaments WHERE chat_id = ? AND status IN ('open', 'running')", (chat_id,))
+    running = c.fetchone()
+    if running:
+        return f"Tournament {running[0]} is still on in this chat!", None
+    team = ensure_player_team(conn, player_id, username)
+    if not team:
+        return "Failed to create your team!", None
+    starts_at = (datetime.now() + timedelta(seconds=TOURNAMENT_JOIN_SECONDS)).isoformat()
+    c.execute('''INSERT INTO tournaments (sport, format, size, status, chat_id, group_name, created_by, starts_at)
+                 VALUES (?, ?, ?, 'open', ?, ?, ?, ?)''', (sport, format, size, chat_id, group_name, player_id, starts_at))
+    tournament_id = c.lastrowid
+    c.execute('INSERT INTO tournament_teams (tournament_id, team_id) VALUES (?, ?)', (tournament_id, team[0]))
+    logger.debug(f"Player {player_id} created tournament {tournament_id}: {sport} {format} for {size} teams")
+    return (f"{sport} {format.replace('_', ' ')} tournament for {size} teams created (id: {tournament_id}). {team[2]} has joined. "
+            f"Use /jointournament {tournament_id} to join! It starts in {TOURNAMENT_JOIN_SECONDS:.0f} seconds; "
+            "AI teams take any empty places."), tournament_id
+
+async def tournament(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    player_id = update.effective_user.id
+    group_name = update.effective_chat.title or "group"
+    if len(context.args) != 3:
+        await update.message.reply_text(f"Usage: /tournament <sport> <{'|'.join(TOURNAMENT_FORMATS)}> <num_teams> "
+                                        f"(sports: {', '.join(TOURNAMENT_SPORTS)})")
+        return
+    sport, format, size = context.args
+    try:
+        size = int(size)
+        if sport not in TOURNAMENT_SPORTS:
+            await update.message.reply_text(f"Invalid sport! Choose from: {', '.join(TOURNAMENT_SPORTS)}")
+            return
+        if format not in TOURNAMENT_FORMATS:
+            await update.message.reply_text(f"Invalid format! Choose from: {', '.join(TOURNAMENT_FORMATS)}")
+            return
+        if not 2 <= size <= TOURNAMENT_MAX_TEAMS:
+            await update.message.reply_text(f"Tournaments take 2–{TOURNAMENT_MAX_TEAMS} teams, got {size}")
+            return
+        username = update.effective_user.username or f"user_{player_id}"
+        response, tournament_id = await db.write(tournament_tx, player_id, username, sport, format, size,
+                                                 update.effective_chat.id, group_name)
+        await update.message.reply_text(response)
+        if tournament_id:
+            tournament_scheduler.schedule(context.bot, tournament_id)
+    except ValueError:
+        logger.debug(f"Player {player_id} used invalid number of teams")
+        await update.message.reply_text("Number of teams must be a number!")
+    except Exception as e:
+        logger.error(f"Error in tournament for player {player_id}: {str(e)}")
+        await update.message.reply_text("An error occurred while creating the tournament.")
+
+def jointournament_tx(conn, player_id, username, tournament_id):
+    tournament = get_tournament(conn, tournament_id)
+    if not tournament or tournament[4] != 'open':
+        return "Invalid or already started tournament id!"
+    team = ensure_player_team(conn, player_id, username)
+    if not team:
+        return "Failed to create your team!"
+    c = conn.cursor()
+    c.execute('SELECT COUNT(*) FROM tournament_teams WHERE tournament_id = ?', (tournament_id,))
+    if c.fetchone()[0] >= tournament[3]:
+        return "This tournament is already full!"
+    c.execute('INSERT OR IGNORE INTO tournament_teams (tournament_id, team_id) VALUES (?, ?)', (tournament_id, team[0]))
+    if c.rowcount == 0:
+        return "You have already joined this tournament!"
+    logger.debug(f"Player {player_id} joined tournament {tournament_id}")
+    return f"{team[2]} joined tournament {tournament_id}!"
+
+async def jointournament(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    player_id = update.effective_user.id
+    if not context.args:
+        await update.message.reply_text("Usage: /jointournament <tournament_id>")
+        return
+    try:
+        tournament_id = int(context.args[0])
+        username = update.effective_user.username or f"user_{player_id}"
+        await update.message.reply_text(await db.write(jointournament_tx, player_id, username, tournament_id))
+    except ValueError:
+        logger.debug(f"Player {player_id} used invalid tournament id")
+        await update.message.reply_text("Tournament id must be a number!")
+    except Exception as e:
+        logger.error(f"Error in jointournament for player {player_id}: {str(e)}")
+        await update.message.reply_text("An error occurred while joining the tournament.")
+
+def tournamentstatus_tx(conn, tournament_id):
+    tournament = get_tournament(conn, tournament_id)
+    if not tournament:
+        return ["Invalid tournament id!"]
+    names = get_tournament_team_names(conn, tournament_id)
+    lines = [f"Tournament {tournament_id} ({tournament[1]} {tournament[2].replace('_', ' ')}): {tournament[4]}"]
+    if tournament[4] == 'open':
+        delay = max((datetime.fromisoformat(tournament[10]) - datetime.now()).total_seconds(), 0)
+        lines.append(f"Teams ({len(names)}/{tournament[3]}): {', '.join(names.values())}")
+        lines.append(f"Starts in {delay:.0f} seconds")
+        return lines
+    if tournament[4] == 'finished':
+        lines.append(f"Winner: {names.get(tournament[11], '?')}")
+    elif tournament[4] == 'running':
+        fixtures = get_fixtures(conn, tournament_id, tournament[5])
+        done = sum(1 for fixture in fixtures if fixture[6] == 'done')
+        lines.append(f"Round {tournament[5]}/{tournament[6]}: {done}/{len(fixtures)} fixtures played")
+        lines += [f"{names[fixture[4]]} vs {names[fixture[5]]} (match id: {fixture[8]})"
+                  for fixture in fixtures if fixture[6] == 'running']
+    if tournament[2] == 'round_robin':
+        lines.append("Standings:")
+        lines += [f"{place}. {name}: {points} pts ({diff:+})"
+                  for place, (name, points, diff) in enumerate(get_standings(conn, tournament_id, TOURNAMENT_STANDINGS), 1)]
+    elif tournament[4] == 'running':
+        c = conn.cursor()
+        c.execute('SELECT COUNT(*) FROM tournament_teams WHERE tournament_id = ? AND eliminated = 0', (tournament_id,))
+        lines.append(f"{c.fetchone()[0]} teams still in")
+    return lines
+
+async def tournamentstatus(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    player_id = update.effective_user.id
+    if not context.args:
+        await update.message.reply_text("Usage: /tournamentstatus <tournament_id>")
+        return
+    try:
+        tournament_id = int(context.args[0])
+        for text in chunk_lines(await db.read(tournamentstatus_tx, tournament_id)):
+            await update.message.reply_text(text)
+    except ValueError:
+        logger.debug(f"Player {player_id} used invalid tournament id")
+        await update.message.reply_text("Tournament id must be a number!")
+    except Exception as e:
+        logger.error(f"Error in tournamentstatus for player {player_id}: {str(e)}")
+        await update.message.reply_text("An error occurred while checking the tournament.")
+
+def war_tx(conn, player_id, opponent_id, fighter_count, group_name):
+    player = get_player(conn, player_id)
+    opponent = get_player(conn, opponent_id)
+    if not player or not opponent:
+        logger.debug(f"Player {player_id} or opponent {opponent_id} not found")
+        return "Player or opponent not found!"
+    if player_id == opponent_id:
+        logger.debug(f"Player {player_id} tried to war themselves")
+        return "You can't war yourself!"
+    player_fighters = count_citizens(get_population(conn, player_id), 'fighter', 'active')
+    opponent_fighters = count_citizens(get_population(conn, opponent_id), 'fighter', 'active')
+    if player_fighters < fighter_count or opponent_fighters < fighter_count:
+        logger.debug(f"Insufficient fighters for war: player {player_id} has {player_fighters}, opponent {opponent_id} has {opponent_fighters}")
+        return "Not enough fighters available!"
+    player_power = fighter_power(conn, player_id, fighter_count) * quality_modifier(player[11])
+    opponent_power = fighter_power(conn, opponent_id, fighter_count) * quality_modifier(opponent[11])
+    player_score = random.randint(0, 100) + player_power
+    opponent_score = random.randint(0, 100) + opponent_power
+    player_affected = int(fighter_count * random.uniform(0.1, 0.3))
+    opponent_affected = int(fighter_count * random.uniform(0.1, 0.3))
+    injured_until = (datetime.now() + timedelta(hours=24)).isoformat()
+    for side_id, affected in ((player_id, player_affected), (opponent_id, opponent_affected)):
+        dead = sum(1 for _ in range(affected) if random.random() < 0.5)
+        move_citizens(conn, side_id, 'fighter', 'active', 'dead', dead)
+        move_citizens(conn, side_id, 'fighter', 'active', 'injured', affected - dead, injured_until)
+    resources_stolen = {}
+    response = f"War result: {group_name}\n@{player[1]} (power: {player_power:.2f}) vs @{opponent[1]} (power: {opponent_power:.2f})\n"
+    if player_score > opponent_score:
+        coins_change = 5
+        winner, loser = player, opponent
+    else:
+        coins_change = -5
+        winner, loser = opponent, player
+    add_coins(conn, winner[0], 5)
+    adjust_resources(conn, winner[0], war_wins=1)
+    add_coins(conn, loser[0], -5, clamp=True)
+    for index, resource in enumerate(PLAYER_RESOURCES, 2):
+        amount = random.randint(0, int(loser[index] * 0.1))
+        if amount > 0 and adjust_resources(conn, loser[0], **{resource: -amount}):
+            adjust_resources(conn, winner[0], **{resource: amount})
+            resources_stolen[resource] = amount
+    response += f"Resources stolen: {', '.join(f'{amount} {res}' for res, amount in resources_stolen.items())}\n" if resources_stolen else ""
+    response += f"@{player[1]} {'wins' if player_score > opponent_score else 'loses' if opponent_score > player_score else 'ties'}! "
+    response += f"Coins: {coins_change:+d}, losses: {player_affected} population\n"
+    response += f"@{opponent[1]} losses: {opponent_affected} population"
+    logger.debug(f"War executed by player {player_id} against {opponent_id}: {player_score} vs {opponent_score}")
+    return response
+
 async def war(update: Update, context: ContextTypes.DEFAULT_TYPE):
     player_id = update.effective_user.id
     group_name = update.effective_chat.title or "group"
@@ -1444,90 +4329,7 @@ async def war(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.debug(f"Player {player_id} specified invalid fighter count: {fighter_count}")
             await update.message.reply_text("Fighter count must be positive!")
             return
-        conn = sqlite3.connect('battle_forge.db')
-        try:
-            player = get_player(conn, player_id)
-            opponent = get_player(conn, opponent_id)
-            if not player or not opponent:
-                logger.debug(f"Player {player_id} or opponent {opponent_id} not found")
-                await update.message.reply_text("Player or opponent not found!")
-                return
-            if player_id == opponent_id:
-                logger.debug(f"Player {player_id} tried to war themselves")
-                await update.message.reply_text("You can't war yourself!")
-                return
-            player_fighters = [c for c in get_citizens(conn, player_id) if c[3] == 'fighter' and c[8] == 'active']
-            opponent_fighters = [c for c in get_citizens(conn, opponent_id) if c[3] == 'fighter' and c[8] == 'active']
-            if len(player_fighters) < fighter_count or len(opponent_fighters) < fighter_count:
-                logger.debug(f"Insufficient fighters for war: player {player_id} has {len(player_fighters)}, opponent {opponent_id} has {len(opponent_fighters)}")
-                await update.message.reply_text("Not enough fighters available!")
-                return
-            player_power = sum(f[5] * f[4] / 100 for f in player_fighters[:fighter_count]) * quality_modifier(player[11])
-            opponent_power = sum(f[5] * f[4] / 100 for f in opponent_fighters[:fighter_count]) * quality_modifier(opponent[11])
-            player_score = random.randint(0, 100) + player_power
-            opponent_score = random.randint(0, 100) + opponent_power
-            player_affected = random.sample(player_fighters, k=int(fighter_count * random.uniform(0.1, 0.3)))
-            opponent_affected = random.sample(opponent_fighters, k=int(fighter_count * random.uniform(0.1, 0.3)))
-            for fighter in player_affected:
-                if random.random() < 0.5:
-                    update_citizen(conn, fighter[0], 'dead')
-                else:
-                    update_citizen(conn, fighter[0], 'injured', (datetime.now() + timedelta(hours=24)).isoformat())
-            for fighter in opponent_affected:
-                if random.random() < 0.5:
-                    update_citizen(conn, fighter[0], 'dead')
-                else:
-                    update_citizen(conn, fighter[0], 'injured', (datetime.now() + timedelta(hours=24)).isoformat())
-            resources_stolen = {}
-            coins_change = 0
-            response = f"War result: {group_name}\n@{player[1]} (power: {player_power:.2f}) vs @{opponent[1]} (power: {opponent_power:.2f})\n"
-            if player_score > opponent_score:
-                coins_change = 5
-                update_player(conn, player_id, player[1], player[2], player[3], player[4], player[5], player[6], player[7],
-                             player[8], player[9], player[10], player[11], player[12] + 5, player[13] + 1, player[14], player[15], player[16])
-                update_player(conn, opponent_id, opponent[1], opponent[2], opponent[3], opponent[4], opponent[5], opponent[6], opponent[7],
-                             opponent[8], opponent[9], opponent[10], opponent[11], max(opponent[12] - 5, 0), opponent[13], opponent[14], opponent[15], opponent[16])
-                for resource in ['sperms', 'eggs', 'water', 'food', 'medicine', 'ore']:
-                    index = {'sperms': 2, 'eggs': 3, 'water': 4, 'food': 5, 'medicine': 6, 'ore': 7}[resource]
-                    amount = random.randint(0, int(opponent[index] * 0.1))
-                    if amount > 0:
-                        resources_stolen[resource] = amount
-                        player_data = list(player)
-                        opponent_data = list(opponent)
-                        player_data[index] += amount
-                        opponent_data[index] -= amount
-                        update_player(conn, player_id, player[1], *player_data[2:])
-                        update_player(conn, opponent_id, opponent[1], *opponent_data[2:])
-                response += f"Resources stolen: {', '.join(f'{amount} {res}' for res, amount in resources_stolen.items())}\n" if resources_stolen else ""
-            else:
-                coins_change = -5
-                update_player(conn, player_id, player[1], player[2], player[3], player[4], player[5], player[6], player[7],
-                             player[8], player[9], player[10], player[11], max(player[12] - 5, 0), player[13], player[14], player[15], player[16])
-                update_player(conn, opponent_id, opponent[1], opponent[2], opponent[3], opponent[4], opponent[5], opponent[6], opponent[7],
-                             opponent[8], opponent[9], opponent[10], opponent[11], opponent[12] + 5, opponent[13] + 1, opponent[14], opponent[15], opponent[16])
-                for resource in ['sperms', 'eggs', 'water', 'food', 'medicine', 'ore']:
-                    index = {'sperms': 2, 'eggs': 3, 'water': 4, 'food': 5, 'medicine': 6, 'ore': 7}[resource]
-                    amount = random.randint(0, int(player[index] * 0.1))
-                    if amount > 0:
-                        resources_stolen[resource] = amount
-                        player_data = list(player)
-                        opponent_data = list(opponent)
-                        player_data[index] -= amount
-                        opponent_data[index] += amount
-                        update_player(conn, player_id, player[1], *player_data[2:])
-                        update_player(conn, opponent_id, opponent[1], *opponent_data[2:])
-                response += f"Resources stolen: {', '.join(f'{amount} {res}' for res, amount in resources_stolen.items())}\n" if resources_stolen else ""
-            response += f"@{player[1]} {'wins' if player_score > opponent_score else 'loses' if opponent_score > player_score else 'ties'}! "
-            response += f"Coins: {coins_change:+d}, losses: {len(player_affected)} population\n"
-            response += f"@{opponent[1]} losses: {len(opponent_affected)} population"
-            conn.commit()
-            logger.debug(f"War executed by player {player_id} against {opponent_id}: {player_score} vs {opponent_score}")
-            await update.message.reply_text(response)
-        except Exception as e:
-            logger.error(f"Error in war for player {player_id}: {str(e)}")
-            await update.message.reply_text("An error occurred during the war.")
-        finally:
-            conn.close()
+        await update.message.reply_text(await db.write(war_tx, player_id, opponent_id, fighter_count, group_name))
     except ValueError:
         logger.debug(f"Player {player_id} used invalid war arguments")
         await update.message.reply_text("Opponent id and fighter count must be numbers!")
@@ -1535,31 +4337,56 @@ async def war(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in war for player {player_id}: {str(e)}")
         await update.message.reply_text("An error occurred during the war.")
 
+LEADERBOARD_SIZE = int(os.getenv('BATTLE_FORGE_LEADERBOARD_SIZE', '10'))
+
+def leaderboard_tx(conn, group_name):
+    # Only the players shown are read
+    response = f"🏆 Leaderboard for {group_name} 🏆\n\n"
+    for i, (player_id, coins, war_wins) in enumerate(rankings.top(LEADERBOARD_SIZE), 1):
+        player = get_player(conn, player_id)
+        if not player:
+            continue
+        currency_value = calculate_currency_value(player, count_population(conn, player_id))
+        response += f"{i}. @{player[1]}\n"
+        response += f"   {group_name} coins: {coins}\n"
+        response += f"   War wins: {war_wins}\n"
+        response += f"   @{player[1]} coin value: {currency_value:.2f} {group_name} coins\n\n"
+    return response
+
 async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     player_id = update.effective_user.id
     group_name = update.effective_chat.title or "group"
-    conn = sqlite3.connect('battle_forge.db')
     try:
-        c = conn.cursor()
-        c.execute('SELECT player_id, username, coins, war_wins FROM players ORDER BY coins DESC, war_wins DESC LIMIT 10')
-        players = c.fetchall()
-        response = f"🏆 Leaderboard for {group_name} 🏆\n\n"
-        for i, player in enumerate(players, 1):
-            player_data = get_player(conn, player[0])
-            citizens = get_citizens(conn, player[0])
-            babies = get_babies(conn, player[0])
-            currency_value = calculate_currency_value(player_data, citizens, babies)
-            response += f"{i}. @{player[1]}\n"
-            response += f"   {group_name} coins: {player[2]}\n"
-            response += f"   War wins: {player[3]}\n"
-            response += f"   @{player[1]} coin value: {currency_value:.2f} {group_name} coins\n\n"
+        response = await db.read(leaderboard_tx, group_name)
         logger.debug(f"Player {player_id} viewed leaderboard")
         await update.message.reply_text(response or "No players on the leaderboard yet!")
     except Exception as e:
         logger.error(f"Error in leaderboard for player {player_id}: {str(e)}")
         await update.message.reply_text("An error occurred while viewing the leaderboard.")
-    finally:
-        conn.close()
+
+def myrank_tx(conn, player_id, group_name):
+    standing = rankings.rank(player_id)
+    if not standing:
+        return "You're not on the leaderboard yet! Use /start to join."
+    rank, total, above = standing
+    player = get_player(conn, player_id)
+    response = f"@{player[1]}: rank {rank} of {total}\n"
+    response += f"{group_name} coins: {player[12]}\nWar wins: {player[13]}\n"
+    if above:
+        above_player = get_player(conn, above[0])
+        gap = above[1] - player[12]
+        response += (f"Next up: @{above_player[1] if above_player else above[0]}, "
+                     + (f"{gap} {group_name} coins ahead" if gap else f"{above[2] - player[13]} war wins ahead"))
+    return response
+
+async def myrank(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    player_id = update.effective_user.id
+    group_name = update.effective_chat.title or "group"
+    try:
+        await update.message.reply_text(await db.read(myrank_tx, player_id, group_name))
+    except Exception as e:
+        logger.error(f"Error in myrank for player {player_id}: {str(e)}")
+        await update.message.reply_text("An error occurred while looking up your rank.")
 
 def main():
     try:
@@ -1571,7 +4398,22 @@ def main():
             logger.warning("Using hardcoded token for testing. Consider using a .env file for security.")
         
         # Initialize the bot
-        application = Application.builder().token(token).build()
+        # Unfinished matches and tournaments, and every chat's jobs, are
+        # picked up again on startup and left to resume on shutdown
+        async def post_init(application):
+            await supervisor.resume(application.bot)
+            await tournament_scheduler.resume(application.bot)
+            await chat_jobs.start(application.bot)
+
+        async def post_shutdown(application):
+            await chat_jobs.shutdown()
+            await tournament_scheduler.shutdown()
+            await supervisor.shutdown()
+
+        application = (Application.builder().token(token)
+                       .post_init(post_init)
+                       .post_shutdown(post_shutdown)
+                       .build())
 
         # Add command handlers
         application.add_handler(CommandHandler('start', start))
@@ -1580,20 +4422,36 @@ def main():
         application.add_handler(CommandHandler('merge', merge))
         application.add_handler(CommandHandler('upgradequality', upgradequality))
         application.add_handler(CommandHandler('mystats', mystats))
+        application.add_handler(CommandHandler('citizens', citizens))
+        application.add_handler(CallbackQueryHandler(citizens_page, pattern=r'^citizens:'))
         application.add_handler(CommandHandler('currencies', currencies))
         application.add_handler(CommandHandler('sellable', sellable))
         application.add_handler(CommandHandler('trade', trade))
         application.add_handler(CommandHandler('accepttrade', accepttrade))
+        application.add_handler(CommandHandler('buy', buy))
+        application.add_handler(CommandHandler('book', book))
+        application.add_handler(CommandHandler('myorders', myorders))
+        application.add_handler(CommandHandler('cancelorder', cancelorder))
         application.add_handler(CommandHandler('sportevent', sportevent))
         application.add_handler(CommandHandler('acceptsport', acceptsport))
+        application.add_handler(CommandHandler('matchstatus', matchstatus))
+        application.add_handler(CommandHandler('matchlog', matchlog))
+        application.add_handler(CommandHandler('cancelmatch', cancelmatch))
         application.add_handler(CommandHandler('teamstats', teamstats))
         application.add_handler(CommandHandler('gamble', gamble))
+        application.add_handler(CommandHandler('odds', odds))
+        application.add_handler(CommandHandler('tournament', tournament))
+        application.add_handler(CommandHandler('jointournament', jointournament))
+        application.add_handler(CommandHandler('tournamentstatus', tournamentstatus))
         application.add_handler(CommandHandler('war', war))
         application.add_handler(CommandHandler('leaderboard', leaderboard))
+        application.add_handler(CommandHandler('myrank', myrank))
 
         # Start the bot
         logger.info("Starting BattleForgeBot...")
         application.run_polling(allowed_updates=Update.ALL_TYPES)
+        db.shutdown()
+        db_pool.close_all()
     except Exception as e:
         logger.error(f"Error starting bot: {str(e)}")
         print(f"Failed to start bot: {str(e)}")
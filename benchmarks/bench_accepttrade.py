@@ -0,0 +1,109 @@
+# Lists citizens and resource orders from sellers with increasingly many
+# citizens of their own (up to 50k), then has several buyers race to accept
+# every listing at once through the database executor, as concurrent
+# /accepttrade commands would. Reports acceptance time per seller size
+# (should stay flat), how many accepts won each trade (should be exactly
+# one), and checks coins and goods are conserved.
+#
+#   python benchmarks/bench_accepttrade.py [listings_per_seller] [buyers]
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bf_bench_')
+os.chdir(WORKDIR)
+os.environ['BATTLE_FORGE_DB'] = os.path.join(WORKDIR, 'accepttrade.db')
+
+import battle_forge_bot as bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+SELLER_SIZES = (100, 10000, 50000)
+GROUP = 'bench'
+BUYER_BASE = 1000
+
+
+def populate(conn, listings, buyers):
+    # -> {seller_id: [trade_id]}
+    c = conn.cursor()
+    now = bot.datetime.now().isoformat()
+    sellers = {}
+    for seller_id, size in enumerate(SELLER_SIZES, 1):
+        c.execute('INSERT INTO players (player_id, username, water, coins) VALUES (?, ?, ?, ?)', (seller_id, f"s{seller_id}", 10 ** 6, 0))
+        c.executemany('INSERT INTO citizens (player_id, name, role, health, attack, defense, created_at, status) VALUES (?, ?, ?, 60, 10, 10, ?, ?)',
+                      [(seller_id, f"c{i}", bot.CITIZEN_ROLES[i % len(bot.CITIZEN_ROLES)], now, 'active') for i in range(size)])
+        c.execute('SELECT citizen_id FROM citizens WHERE player_id = ? ORDER BY random() LIMIT ?', (seller_id, listings))
+        for (citizen_id,) in c.fetchall():
+            bot.create_trade(conn, seller_id, f"citizen_{citizen_id}", 1, 10, f"{GROUP} coin")
+        for _ in range(listings):
+            bot.place_order(conn, seller_id, 'sell', 'water', 10, 2, GROUP)
+        c.execute("SELECT trade_id FROM trades WHERE seller_id = ? AND status = 'open'", (seller_id,))
+        sellers[seller_id] = [row[0] for row in c.fetchall()]
+    c.executemany('INSERT INTO players (player_id, username, coins) VALUES (?, ?, ?)',
+                  [(BUYER_BASE + buyer, f"b{buyer}", 10 ** 6) for buyer in range(buyers)])
+    return sellers
+
+
+async def race(sellers, buyers):
+    # Every buyer tries to take every listing, all at once
+    attempts = [(trade_id, BUYER_BASE + buyer) for trade_ids in sellers.values() for trade_id in trade_ids for buyer in range(buyers)]
+    random.Random(7).shuffle(attempts)
+    responses = await asyncio.gather(*(bot.db.write(bot.accepttrade_tx, buyer_id, f"b{buyer_id}", trade_id, GROUP)
+                                       for trade_id, buyer_id in attempts))
+    return Counter(trade_id for (trade_id, buyer_id), response in zip(attempts, responses) if response.startswith('Trade accepted'))
+
+
+async def timed_accepts(trade_ids, buyer_id):
+    start = time.perf_counter()
+    for trade_id in trade_ids:
+        response = await bot.db.write(bot.accepttrade_tx, buyer_id, f"b{buyer_id}", trade_id, GROUP)
+        assert response.startswith('Trade accepted'), response
+    return (time.perf_counter() - start) / len(trade_ids)
+
+
+def totals(conn):
+    # Coins, water and citizens: owned, or held by open orders
+    c = conn.cursor()
+    bot.player_cache.flush(conn)
+    c.execute('SELECT SUM(coins), SUM(water) FROM players')
+    coins, water = c.fetchone()
+    c.execute("SELECT COALESCE(SUM(remaining), 0) FROM trades WHERE status = 'open' AND item = 'water' AND side = 'sell'")
+    water += c.fetchone()[0]
+    c.execute('SELECT COUNT(*) FROM citizens')
+    return coins, water, c.fetchone()[0]
+
+
+async def run(listings, buyers):
+    sellers = await bot.db.write(populate, listings, buyers)
+    before = await bot.db.write(totals)
+    print(f"{'seller citizens':>15} {'per accept':>11}")
+    for seller_id, size in enumerate(SELLER_SIZES, 1):
+        # Half of each seller's listings, one buyer, one after another
+        half = sellers[seller_id][::2]
+        sellers[seller_id] = sellers[seller_id][1::2]
+        print(f"{size:15} {await timed_accepts(half, BUYER_BASE) * 1000:9.2f}ms")
+    wins = await race(sellers, buyers)
+    trades = sum(len(trade_ids) for trade_ids in sellers.values())
+    print(f"{buyers} buyers racing for {trades} trades: {sum(wins.values())} accepted, "
+          f"at most {max(wins.values())} per trade")
+    assert len(wins) == trades and set(wins.values()) == {1}
+    assert before == await bot.db.write(totals)
+    print("coins, goods and citizens conserved")
+
+
+def main():
+    listings = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    buyers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    asyncio.run(run(listings, buyers))
+    bot.db.shutdown()
+
+
+if __name__ == '__main__':
+    main()
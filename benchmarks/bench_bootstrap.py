@@ -0,0 +1,65 @@
+# Measures first-time player bootstrap: the old per-citizen INSERT + commit
+# loop versus the single-transaction provision_player path.
+#
+#   python benchmarks/bench_bootstrap.py [players]
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bf_bench_')
+os.chdir(WORKDIR)
+
+import battle_forge_bot as bot  # noqa: E402  (initializes the db in WORKDIR)
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def legacy_bootstrap(conn, player_id, username):
+    c = conn.cursor()
+    for i in range(bot.STARTING_CITIZENS):
+        role = random.choice(bot.CITIZEN_ROLES)
+        health, attack, defense = bot.roll_citizen_stats(role)
+        c.execute('INSERT INTO citizens (player_id, name, role, health, attack, defense, created_at, status) VALUES (?, ?, ?, ?, ?, ?, ?, "active")',
+                  (player_id, f"citizen_{i+1}", role, health, attack, defense, datetime.now().isoformat()))
+        conn.commit()
+        bot.logger.debug(f"Created citizen for player {player_id}")
+    bot.create_team(conn, player_id, f"@{username}_team")
+    c.execute('INSERT OR REPLACE INTO players (player_id, username) VALUES (?, ?)', (player_id, username))
+    conn.commit()
+
+
+def provision(conn, player_id, username):
+    with bot.unit_of_work(conn):
+        bot.provision_player(conn, player_id, username)
+
+
+def run(label, bootstrap, first_id, players):
+    conn = sqlite3.connect('battle_forge.db')
+    try:
+        start = time.perf_counter()
+        for player_id in range(first_id, first_id + players):
+            bootstrap(conn, player_id, f"bench_{player_id}")
+        elapsed = time.perf_counter() - start
+    finally:
+        conn.close()
+    print(f"{label:<10} {players} players, {elapsed / players * 1000:9.1f} ms/player")
+    return elapsed / players
+
+
+def main():
+    players = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    print(f"database: {os.path.join(WORKDIR, 'battle_forge.db')}")
+    before = run('legacy', legacy_bootstrap, 1_000_000, players)
+    after = run('provision', provision, 2_000_000, players)
+    print(f"speedup    {before / after:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# Registers the random match job for many chats, with every chat sending
+# /start several times, then steps a virtual clock through two days a minute
+# at a time, claiming due jobs as the scheduler does. Reports the jobs kept
+# per chat (should be one), runs per chat per day, the busiest minute, and
+# the cost of a claim; then the same after a 12 hour outage, with overdue
+# jobs spread out on restart instead of all firing at once.
+#
+#   python benchmarks/bench_chat_jobs.py [chats] [starts_per_chat]
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bf_bench_')
+os.chdir(WORKDIR)
+os.environ['BATTLE_FORGE_DB'] = os.path.join(WORKDIR, 'chat_jobs.db')
+
+import battle_forge_bot as bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+STEP = timedelta(minutes=1)
+
+
+def step_through(conn, chats, start, duration):
+    # -> (runs per chat, busiest minute, mean claim seconds)
+    runs = Counter()
+    per_minute = []
+    claims = 0.0
+    now = start
+    while now < start + duration:
+        began = time.perf_counter()
+        with bot.unit_of_work(conn):
+            due, next_run_at = bot.claim_due_jobs_tx(conn, now, chats)
+        claims += time.perf_counter() - began
+        runs.update(chat_id for chat_id, job, group_name in due)
+        per_minute.append(len(due))
+        now += STEP
+    return runs, max(per_minute), claims / len(per_minute)
+
+
+def report(label, chats, runs, busiest, claim, days):
+    print(f"{label:16} {sum(runs.values()) / chats / days:12.2f} {busiest:14} {claim * 1e6:10.1f}us")
+
+
+def main():
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    starts = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    conn = bot.open_connection()
+    start = bot.datetime.now()
+    # Chats /start over the first hour, each several times
+    for repeat in range(starts):
+        with bot.unit_of_work(conn):
+            for chat_id in range(chats):
+                bot.register_chat_job_tx(conn, -chat_id, 'random_match', f"g{chat_id}",
+                                         start + timedelta(seconds=3600 * chat_id / chats + repeat))
+    jobs = conn.execute('SELECT COUNT(*) FROM chat_jobs').fetchone()[0]
+    print(f"{chats} chats, {starts} /start each: {jobs / chats:.2f} jobs per chat")
+    print(f"{'period':16} {'runs/chat/day':>12} {'busiest minute':>14} {'per claim':>12}")
+    runs, busiest, claim = step_through(conn, chats, start, timedelta(days=2))
+    report('steady', chats, runs, busiest, claim, 2)
+    # Down for 12 hours, then restarted
+    restart = start + timedelta(days=2, hours=12)
+    with bot.unit_of_work(conn):
+        bot.spread_overdue_jobs_tx(conn, restart, bot.CHAT_JOB_RESUME_SPREAD)
+    runs, busiest, claim = step_through(conn, chats, restart, timedelta(days=1))
+    report('after restart', chats, runs, busiest, claim, 1)
+    bot.db.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# Compares the old connect-per-command pattern (default rollback journal,
+# fresh connection and cold caches every time) with the shared, tuned
+# connection pool. Each "command" is a read-mostly mix similar to /mystats
+# followed by a small write.
+#
+#   python benchmarks/bench_connections.py [commands] [players]
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bf_bench_')
+os.chdir(WORKDIR)
+os.environ['BATTLE_FORGE_DB'] = os.path.join(WORKDIR, 'pooled.db')
+
+import battle_forge_bot as bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def command(conn, player_id):
+    bot.get_player(conn, player_id)
+    bot.get_population(conn, player_id)
+    bot.get_player_team(conn, player_id)
+    conn.execute('UPDATE players SET coins = coins + 1 WHERE player_id = ?', (player_id,))
+    conn.commit()
+
+
+def connect_per_command(path, player_ids):
+    for player_id in player_ids:
+        conn = sqlite3.connect(path)
+        try:
+            command(conn, player_id)
+        finally:
+            conn.close()
+
+
+def pooled(player_ids):
+    for player_id in player_ids:
+        conn = bot.db_pool.acquire()
+        try:
+            command(conn, player_id)
+        finally:
+            bot.db_pool.release(conn)
+
+
+def main():
+    commands = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    players = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    conn = bot.db_pool.acquire()
+    for player_id in range(1, players + 1):
+        with bot.unit_of_work(conn):
+            bot.provision_player(conn, player_id, f"bench_{player_id}")
+    bot.db_pool.release(conn)
+    bot.db_pool.close_all()
+
+    legacy_path = os.path.join(WORKDIR, 'legacy.db')
+    shutil.copy(bot.DB_PATH, legacy_path)
+    conn = sqlite3.connect(legacy_path)
+    conn.execute('PRAGMA journal_mode = DELETE')
+    conn.close()
+
+    player_ids = [random.randint(1, players) for _ in range(commands)]
+    start = time.perf_counter()
+    connect_per_command(legacy_path, player_ids)
+    before = time.perf_counter() - start
+    start = time.perf_counter()
+    pooled(player_ids)
+    after = time.perf_counter() - start
+    print(f"pragmas: {bot.DB_PRAGMAS}")
+    print(f"connect-per-command {commands} commands, {before / commands * 1e6:8.1f} us/command")
+    print(f"pooled              {commands} commands, {after / commands * 1e6:8.1f} us/command")
+    print(f"speedup             {before / after:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
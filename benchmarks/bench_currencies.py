@@ -0,0 +1,112 @@
+# /currencies over many players (1k by default, 10k citizens each, some
+# listed on the market and some babies): the old per-player loop (player
+# row plus a population count per player) next to the single paginated
+# query over the population counters. Reports time and SQL statements per
+# call, and checks both give every player the same value.
+#
+#   python benchmarks/bench_currencies.py [players] [citizens_per_player]
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bf_bench_')
+os.chdir(WORKDIR)
+os.environ['BATTLE_FORGE_DB'] = os.path.join(WORKDIR, 'currencies.db')
+
+import battle_forge_bot as bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def populate(conn, players, citizens):
+    # Cohorts and babies go in through the usual tables, so the population
+    # counters are filled by their triggers
+    rng = random.Random(7)
+    c = conn.cursor()
+    c.executemany('INSERT INTO players (player_id, username, water, food, medicine, ore) VALUES (?, ?, ?, ?, ?, ?)',
+                  [(player_id, f"p{player_id}", *(rng.randint(0, 5000) for _ in range(4))) for player_id in range(1, players + 1)])
+    for player_id in range(1, players + 1):
+        roles = rng.choices(bot.CITIZEN_ROLES, k=citizens)
+        c.executemany('INSERT INTO citizen_cohorts (player_id, role, status, count) VALUES (?, ?, ?, ?)',
+                      [(player_id, role, 'active', roles.count(role)) for role in bot.CITIZEN_ROLES])
+        for _ in range(3):
+            bot.materialize_citizen(conn, player_id, rng.choice(bot.CITIZEN_ROLES))
+        c.executemany('INSERT INTO babies (player_id, name, created_at, count) VALUES (?, ?, ?, ?)',
+                      [(player_id, 'baby', bot.datetime.now().isoformat(), rng.randint(1, 50)) for _ in range(rng.randint(0, 3))])
+
+
+def legacy_count_population(conn, player_id):
+    c = conn.cursor()
+    c.execute('SELECT COALESCE(SUM(count), 0) FROM babies WHERE player_id = ?', (player_id,))
+    return bot.count_citizens(bot.get_population(conn, player_id)) + c.fetchone()[0]
+
+
+def legacy_currencies(conn, group_name):
+    # What currencies_tx did before the counters: every player, one message
+    c = conn.cursor()
+    c.execute('SELECT player_id, username FROM players')
+    response = f"Currency values in {group_name}:\n"
+    for player in c.fetchall():
+        currency_value = bot.calculate_currency_value(bot.get_player(conn, player[0]), legacy_count_population(conn, player[0]))
+        response += f"@{player[1]} coin: {currency_value:.2f} {group_name} coins\n"
+    return response.splitlines()[1:]
+
+
+def paged_currencies(conn, group_name):
+    lines = []
+    page = 1
+    while True:
+        page_lines = bot.currencies_tx(conn, group_name, page)
+        lines += [line for line in page_lines if line.startswith('@')]
+        if not page_lines[-1].startswith('Use /currencies'):
+            return lines
+        page += 1
+
+
+class Statements:
+    def __init__(self, conn):
+        self.count = 0
+        conn.set_trace_callback(self._seen)
+
+    def _seen(self, statement):
+        self.count += 1
+
+
+def measure(label, statements, fn, calls=3):
+    before = statements.count
+    start = time.perf_counter()
+    for _ in range(calls):
+        result = fn()
+    elapsed = (time.perf_counter() - start) / calls
+    print(f"{label:24} {elapsed * 1000:9.1f}ms {(statements.count - before) / calls:10.0f}")
+    return result
+
+
+def values(lines):
+    return sorted(re.match(r"@(\S+) coin: (\S+)", line).groups() for line in lines)
+
+
+def main():
+    players = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    citizens = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    conn = bot.open_connection()
+    with bot.unit_of_work(conn):
+        populate(conn, players, citizens)
+    statements = Statements(conn)
+    print(f"{players} players x {citizens} citizens, pages of {bot.CURRENCIES_PAGE_SIZE}")
+    print(f"{'path':24} {'per call':>11} {'statements':>10}")
+    legacy = measure('per-player, all', statements, lambda: legacy_currencies(conn, 'G'))
+    measure('counters, first page', statements, lambda: bot.currencies_tx(conn, 'G', 1), calls=20)
+    paged = measure('counters, every page', statements, lambda: paged_currencies(conn, 'G'))
+    assert values(legacy) == values(paged)
+    bot.db.shutdown()
+
+
+if __name__ == '__main__':
+    main()
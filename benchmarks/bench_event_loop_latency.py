@@ -0,0 +1,95 @@
+# Measures how long heavy commands stall the asyncio event loop. A ticker
+# coroutine stands in for live match commentary and records how late each
+# 10 ms tick fires while new players join and /currencies is spammed. The
+# same load runs twice: with database work inline on the event loop (the old
+# behaviour) and through the db executor threads.
+#
+#   python benchmarks/bench_event_loop_latency.py [players] [currencies_calls]
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bf_bench_')
+os.chdir(WORKDIR)
+os.environ['BATTLE_FORGE_DB'] = os.path.join(WORKDIR, 'latency.db')
+
+import battle_forge_bot as bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+TICK = 0.01
+
+
+class Message:
+    async def reply_text(self, text, **kwargs):
+        return self
+
+
+def fake_update(player_id):
+    update = types.SimpleNamespace(
+        effective_user=types.SimpleNamespace(id=player_id, username=f"bench_{player_id}"),
+        effective_chat=types.SimpleNamespace(id=-1, title='bench'),
+        message=Message(),
+    )
+    context = types.SimpleNamespace(args=[])
+    return update, context
+
+
+async def ticker(lags, done):
+    while not done.is_set():
+        expected = time.perf_counter() + TICK
+        await asyncio.sleep(TICK)
+        lags.append(max(time.perf_counter() - expected, 0))
+
+
+async def load(first_player, players, currencies_calls):
+    commands = []
+    for player_id in range(first_player, first_player + players):
+        commands.append(bot.mystats(*fake_update(player_id)))
+    for i in range(currencies_calls):
+        commands.append(bot.currencies(*fake_update(first_player)))
+    await asyncio.gather(*commands)
+
+
+async def run(first_player, players, currencies_calls):
+    lags = []
+    done = asyncio.Event()
+    tick = asyncio.create_task(ticker(lags, done))
+    start = time.perf_counter()
+    await load(first_player, players, currencies_calls)
+    elapsed = time.perf_counter() - start
+    done.set()
+    await tick
+    lags.sort()
+    return elapsed, lags
+
+
+def report(label, elapsed, lags):
+    p99 = lags[int(len(lags) * 0.99)] if lags else 0
+    worst = lags[-1] if lags else 0
+    print(f"{label:9} load {elapsed:6.2f}s, {len(lags):5d} ticks, p99 lag {p99 * 1000:8.1f} ms, max lag {worst * 1000:8.1f} ms")
+
+
+def main():
+    players = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    currencies_calls = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    bot.db = bot.DatabaseExecutor(bot.DB_READERS, inline=True)
+    elapsed, lags = asyncio.run(run(1, players, currencies_calls))
+    report('inline', elapsed, lags)
+    bot.db.shutdown()
+
+    bot.db = bot.DatabaseExecutor(bot.DB_READERS)
+    elapsed, lags = asyncio.run(run(players + 1, players, currencies_calls))
+    report('executor', elapsed, lags)
+    bot.db.shutdown()
+
+
+if __name__ == '__main__':
+    main()
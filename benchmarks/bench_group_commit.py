@@ -0,0 +1,83 @@
+# Compares commit strategies on a write-heavy mix of /war commands and match
+# commentary ticks, with synchronous=FULL so every commit pays for an fsync:
+#
+#   per-helper  every statement commits on its own (the old helper behaviour)
+#   unit        one transaction per command through the db executor
+#   group       units from concurrent commands share a commit (5 ms window)
+#
+#   python benchmarks/bench_group_commit.py [commands] [players]
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bf_bench_')
+os.chdir(WORKDIR)
+os.environ['BATTLE_FORGE_DB'] = os.path.join(WORKDIR, 'group_commit.db')
+os.environ.setdefault('BATTLE_FORGE_DB_SYNCHRONOUS', 'FULL')
+
+import battle_forge_bot as bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def workload(commands, players, match_id):
+    work = []
+    for i in range(commands):
+        if i % 2:
+            player_id, opponent_id = random.sample(range(1, players + 1), 2)
+            work.append((bot.war_tx, (player_id, opponent_id, 10, 'bench')))
+        else:
+            work.append((bot.update_match, (match_id, 'open', None, i)))
+    return work
+
+
+def per_helper(work):
+    conn = bot.open_connection()
+    conn.isolation_level = None  # autocommit: each statement is its own transaction
+    try:
+        for fn, args in work:
+            fn(conn, *args)
+            bot.player_cache.flush(conn)  # player changes are written straight away too
+    finally:
+        conn.close()
+
+
+async def through_executor(executor, work):
+    await asyncio.gather(*(executor.write(fn, *args) for fn, args in work))
+
+
+def main():
+    commands = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    players = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    conn = bot.open_connection()
+    for player_id in range(1, players + 1):
+        with bot.unit_of_work(conn):
+            bot.provision_player(conn, player_id, f"bench_{player_id}")
+    with bot.unit_of_work(conn):
+        match_id = bot.create_match(conn, 'soccer', 1, 2)
+    conn.close()
+    bot.db.shutdown()
+
+    print(f"synchronous={bot.DB_PRAGMAS['synchronous']}, {commands} commands")
+    start = time.perf_counter()
+    per_helper(workload(commands, players, match_id))
+    elapsed = time.perf_counter() - start
+    print(f"per-helper {elapsed / commands * 1000:7.2f} ms/command")
+
+    for label, window in (('unit', 0), ('group', 5)):
+        executor = bot.DatabaseExecutor(bot.DB_READERS, group_commit_ms=window)
+        start = time.perf_counter()
+        asyncio.run(through_executor(executor, workload(commands, players, match_id)))
+        elapsed = time.perf_counter() - start
+        executor.shutdown()
+        print(f"{label:10} {elapsed / commands * 1000:7.2f} ms/command, {executor.commits} commits for {executor.units} units")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# grow_babies for a player with 10k citizens and 10k pending babies (half
+# ready to grow up, half ready to be born): the previous per-baby loop versus
+# the single-pass growth engine. Each variant runs on its own identical player.
+#
+#   python benchmarks/bench_grow_babies.py [citizens] [babies]
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bf_bench_')
+os.chdir(WORKDIR)
+os.environ['BATTLE_FORGE_DB'] = os.path.join(WORKDIR, 'grow_babies.db')
+
+import battle_forge_bot as bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def legacy_grow_babies(conn, player_id):
+    babies = bot.get_babies(conn, player_id)
+    player = bot.get_player(conn, player_id)
+    now = datetime.now()
+    population = len(babies) + bot.count_citizens(bot.get_population(conn, player_id))
+    overpopulation = population > (player[4] + player[5] + player[6] + player[7]) / 10
+    for baby in babies:
+        if baby[5] == 1:
+            born_at = datetime.fromisoformat(baby[4])
+            teachers = bot.count_citizens(bot.get_population(conn, player_id), 'teacher')
+            growth_modifier = max(0.5, 1.0 - teachers * 0.1)
+            if now >= born_at + timedelta(hours=24 * growth_modifier):
+                role = random.choice(bot.CITIZEN_ROLES)
+                health, attack, defense = bot.roll_citizen_stats(role)
+                bot.add_citizens(conn, player_id, [(role, health, attack, defense)])
+                conn.execute('DELETE FROM babies WHERE baby_id = ?', (baby[0],))
+        elif now >= datetime.fromisoformat(baby[3]) + timedelta(hours=9):
+            professors = bot.count_citizens(bot.get_population(conn, player_id), 'professor')
+            chance = 0.5 + sum(bot.quality_modifier(player[i]) for i in [8, 9, 10, 11]) + professors * 0.1
+            if overpopulation:
+                chance *= 0.8
+            if random.random() < chance and bot.adjust_resources(conn, player_id, water=-5, food=-5, medicine=-5, ore=-5):
+                bot.update_baby(conn, baby[0], 1, now.isoformat())
+
+
+def setup(conn, player_id, citizens, babies):
+    with bot.unit_of_work(conn):
+        conn.execute('INSERT INTO players (player_id, username, water, food, medicine, ore) VALUES (?, ?, ?, ?, ?, ?)',
+                     (player_id, f"bench_{player_id}", 10 ** 6, 10 ** 6, 10 ** 6, 10 ** 6))
+        bot.initialize_player_citizens(conn, player_id, citizens)
+        long_ago = (datetime.now() - timedelta(days=2)).isoformat()
+        conn.executemany('INSERT INTO babies (player_id, name, created_at, born_at, is_born) VALUES (?, ?, ?, ?, ?)',
+                         [(player_id, f"baby_{i}", long_ago, long_ago if i % 2 else None, i % 2) for i in range(babies)])
+
+
+def run(label, grow, conn, player_id):
+    start = time.perf_counter()
+    with bot.unit_of_work(conn):
+        grow(conn, player_id)
+    elapsed = time.perf_counter() - start
+    remaining = conn.execute('SELECT COUNT(*), SUM(is_born) FROM babies WHERE player_id = ?', (player_id,)).fetchone()
+    print(f"{label:8} {elapsed * 1000:9.1f} ms, babies left {remaining[0]} ({remaining[1]} born)")
+    return elapsed
+
+
+def main():
+    citizens = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    babies = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    conn = bot.open_connection()
+    setup(conn, 1, citizens, babies)
+    setup(conn, 2, citizens, babies)
+    before = run('legacy', legacy_grow_babies, conn, 1)
+    after = run('engine', bot.grow_babies, conn, 2)
+    print(f"speedup  {before / after:.1f}x")
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# Ranks many players (10k by default) two ways: the old /leaderboard query
+# (sort the players table, merge in every dirty cached player) next to the
+# in-memory rankings, and a player's rank by counting the players ahead in
+# SQL next to a binary search. Also times coin changes, which now keep the
+# rankings current as they commit, and checks both orders agree.
+#
+#   python benchmarks/bench_leaderboard.py [players] [lookups]
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bf_bench_')
+os.chdir(WORKDIR)
+os.environ['BATTLE_FORGE_DB'] = os.path.join(WORKDIR, 'leaderboard.db')
+
+import battle_forge_bot as bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+TOP = 10
+
+
+def populate(conn, players):
+    rng = random.Random(7)
+    c = conn.cursor()
+    c.executemany('INSERT INTO players (player_id, username, coins, war_wins) VALUES (?, ?, ?, ?)',
+                  [(player_id, f"p{player_id}", rng.randint(0, 5000), rng.randint(0, 50)) for player_id in range(1, players + 1)])
+
+
+def legacy_top(conn):
+    # What leaderboard_tx did before the rankings
+    c = conn.cursor()
+    c.execute('SELECT player_id FROM players ORDER BY coins DESC, war_wins DESC LIMIT ?', (TOP,))
+    candidates = {row[0] for row in c.fetchall()} | set(bot.player_cache.dirty_ids())
+    players = sorted(filter(None, (bot.get_player(conn, player_id) for player_id in candidates)),
+                     key=lambda p: (p[12], p[13]), reverse=True)[:TOP]
+    return [player[0] for player in players]
+
+
+def sql_rank(conn, player_id):
+    c = conn.cursor()
+    # Ties go to the lower player id, as in the rankings
+    c.execute('''SELECT COUNT(*) + 1 FROM players, (SELECT player_id, coins, war_wins FROM players WHERE player_id = ?) AS me
+                 WHERE (players.coins, players.war_wins, -players.player_id) > (me.coins, me.war_wins, -me.player_id)''',
+              (player_id,))
+    return c.fetchone()[0]
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def main():
+    players = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    conn = bot.open_connection()
+    with bot.unit_of_work(conn):
+        populate(conn, players)
+    bot.rankings.load(conn)
+    rng = random.Random(3)
+    ids = [rng.randint(1, players) for _ in range(lookups)]
+    # Coin changes through the player cache, one unit of work each
+    start = time.perf_counter()
+    for player_id in ids:
+        with bot.unit_of_work(conn):
+            bot.add_coins(conn, player_id, rng.randint(1, 500))
+    update = (time.perf_counter() - start) / lookups
+    print(f"{players} players, {bot.player_cache.dirty_count()} with unflushed changes")
+    print(f"{'query':10} {'SQL':>10} {'rankings':>10}")
+    legacy, legacy_ids = timed(lambda: legacy_top(conn), 20)
+    top, top_ids = timed(lambda: [player_id for player_id, coins, war_wins in bot.rankings.top(TOP)], 20)
+    assert legacy_ids == top_ids, (legacy_ids, top_ids)
+    print(f"{'top ' + str(TOP):10} {legacy * 1000:8.2f}ms {top * 1000:8.3f}ms")
+    with bot.unit_of_work(conn):
+        bot.player_cache.flush(conn)
+    sql, sql_ranks = timed(lambda: [sql_rank(conn, player_id) for player_id in ids], 1)
+    memory, ranks = timed(lambda: [bot.rankings.rank(player_id)[0] for player_id in ids], 1)
+    assert sql_ranks == ranks
+    print(f"{'rank':10} {sql / lookups * 1000:8.2f}ms {memory / lookups * 1000:8.3f}ms")
+    print(f"coin change with rankings kept current: {update * 1e6:.1f}us per unit of work")
+    bot.db.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+# Simulates matches of every sport with the pure engine (no sleeps, no I/O)
+# and reports the cost per match and the share of wins for the stronger side,
+# which is the kind of bulk run odds and backtesting need.
+#
+#   python benchmarks/bench_match_engine.py [matches_per_sport]
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bf_bench_')
+os.chdir(WORKDIR)
+os.environ['BATTLE_FORGE_DB'] = os.path.join(WORKDIR, 'match_engine.db')
+
+import battle_forge_bot as bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def main():
+    matches = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    teams = [('strong', 140), ('weak', 100)]
+    print(f"{'sport':13} {'us/match':>9} {'events':>7}  outcomes")
+    for sport in bot.SPORTS:
+        outcomes = Counter()
+        events = 0
+        start = time.perf_counter()
+        for seed in range(matches):
+            match_events, result = bot.play_match(sport, teams, seed)
+            outcomes[result.winner or 'tie'] += 1
+            events += len(match_events)
+        elapsed = time.perf_counter() - start
+        shares = ', '.join(f"{name} {count / matches:.0%}" for name, count in outcomes.most_common())
+        print(f"{sport:13} {elapsed / matches * 1e6:9.1f} {events / matches:7.1f}  {shares}")
+    # The same seed replays the same match
+    assert bot.play_match('soccer', teams, 42) == bot.play_match('soccer', teams, 42)
+    bot.db.shutdown()
+
+
+if __name__ == '__main__':
+    main()
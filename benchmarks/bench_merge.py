@@ -0,0 +1,69 @@
+# /merge latency for growing merge sizes: the previous one-row-per-baby insert
+# loop versus a single counted batch row, followed by the grow_babies pass
+# that advances the merged babies once they are due.
+#
+#   python benchmarks/bench_merge.py [max_babies]
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bf_bench_')
+os.chdir(WORKDIR)
+os.environ['BATTLE_FORGE_DB'] = os.path.join(WORKDIR, 'merge.db')
+
+import battle_forge_bot as bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def legacy_merge(conn, player_id, username, sperm_count, egg_count):
+    if not bot.adjust_resources(conn, player_id, sperms=-sperm_count, eggs=-egg_count):
+        return "Not enough sperms or eggs!"
+    for i in range(min(sperm_count, egg_count)):
+        conn.execute('INSERT INTO babies (player_id, name, created_at) VALUES (?, ?, ?)',
+                     (player_id, f"baby_{random.randint(1000, 9999)}", datetime.now().isoformat()))
+
+
+def timed(fn, conn, *args):
+    start = time.perf_counter()
+    with bot.unit_of_work(conn):
+        fn(conn, *args)
+    return time.perf_counter() - start
+
+
+def main():
+    max_babies = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    conn = bot.open_connection()
+    player_id = 1
+    size = 10
+    print(f"{'babies':>8} {'legacy':>10} {'batch':>10} {'rows':>6} {'grow':>10}")
+    while size <= max_babies:
+        for merge in (legacy_merge, bot.merge_tx):
+            player_id += 1
+            with bot.unit_of_work(conn):
+                conn.execute('INSERT INTO players (player_id, username, sperms, eggs, water, food, medicine, ore) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (player_id, f"bench_{player_id}", size, size,
+                                                                 10 ** 9, 10 ** 9, 10 ** 9, 10 ** 9))
+            elapsed = timed(merge, conn, player_id, 'bench', size, size)
+            if merge is legacy_merge:
+                legacy = elapsed
+        rows = conn.execute('SELECT COUNT(*) FROM babies WHERE player_id = ?', (player_id,)).fetchone()[0]
+        # Make the batch due for birth and time the aggregate pass
+        long_ago = (datetime.now() - timedelta(days=2)).isoformat()
+        with bot.unit_of_work(conn):
+            conn.execute('UPDATE babies SET created_at = ? WHERE player_id = ?', (long_ago, player_id))
+        grow = timed(bot.grow_babies, conn, player_id)
+        print(f"{size:8d} {legacy * 1000:8.2f}ms {elapsed * 1000:8.2f}ms {rows:6d} {grow * 1000:8.2f}ms")
+        size *= 10
+    bot.db.shutdown()
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# /mystats and /citizens for a player whose citizens increasingly have ids
+# of their own (up to 50k by default): the old reply that listed every such citizen
+# next to the summary and one keyset page deep into the list. Reports time
+# and reply size, which should stay flat for the new paths.
+#
+#   python benchmarks/bench_mystats.py [named_citizens]
+import logging
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bf_bench_')
+os.chdir(WORKDIR)
+os.environ['BATTLE_FORGE_DB'] = os.path.join(WORKDIR, 'mystats.db')
+
+import battle_forge_bot as bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+PLAYER_ID = 1
+
+
+def add_named(conn, count):
+    c = conn.cursor()
+    now = bot.datetime.now().isoformat()
+    c.executemany('INSERT INTO citizens (player_id, name, role, health, attack, defense, created_at, status) VALUES (?, ?, ?, 60, 10, 10, ?, ?)',
+                  [(PLAYER_ID, f"c{i}", bot.CITIZEN_ROLES[i % len(bot.CITIZEN_ROLES)], now, 'active' if i % 7 else 'injured')
+                   for i in range(count)])
+    c.execute("UPDATE citizens SET injured_until = ? WHERE status = 'injured'", (now,))
+
+
+def legacy_named(conn):
+    # The per-citizen listing /mystats used to append
+    response = "\nNamed citizens:\n"
+    for citizen in bot.get_citizens(conn, PLAYER_ID):
+        status = f" ({citizen[8]}{', until ' + bot.datetime.fromisoformat(citizen[9]).strftime('%Y-%m-%d %H:%M') if citizen[8] == 'injured' else ''})"
+        response += f"id: {citizen[0]}, name: {citizen[2]}, role: {citizen[3]}, health: {citizen[4]}, attack: {citizen[5]}, defense: {citizen[6]}{status}\n"
+    return response
+
+
+def timed(fn, repeat=5):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def main():
+    largest = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    conn = bot.open_connection()
+    with bot.unit_of_work(conn):
+        bot.provision_player(conn, PLAYER_ID, 'bench')
+    print(f"{'named':>7} {'old mystats':>12} {'chars':>9} {'mystats':>9} {'chars':>6} {'page':>9} {'chars':>6}")
+    named = 0
+    for target in sorted({min(size, largest) for size in (100, 1000, 10000, largest)}):
+        with bot.unit_of_work(conn):
+            add_named(conn, target - named)
+        named = target
+        def summary():
+            with bot.unit_of_work(conn):
+                return bot.mystats_tx(conn, PLAYER_ID, 'bench', 'G')
+        new, response = timed(summary)
+        old, listing = timed(lambda: legacy_named(conn))
+        middle = conn.execute('SELECT citizen_id FROM citizens WHERE player_id = ? ORDER BY citizen_id LIMIT 1 OFFSET ?',
+                              (PLAYER_ID, named // 2)).fetchone()[0]
+        page, lines = timed(lambda: bot.citizens_page_tx(conn, PLAYER_ID, None, after=middle)[0], 50)
+        print(f"{named:7} {(old + new) * 1000:10.1f}ms {len(listing) + len(response):9} {new * 1000:7.1f}ms "
+              f"{len(response):6} {page * 1000:7.2f}ms {len(chr(10).join(lines)):6}")
+    bot.db.shutdown()
+
+
+if __name__ == '__main__':
+    main()
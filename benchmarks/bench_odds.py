@@ -0,0 +1,55 @@
+# Odds for a 140 vs 100 power line-up in every sport: the vectorized Monte
+# Carlo estimate (time per 10k-trial estimate and per cache hit) next to the
+# win rates from replaying the match engine itself, as a correctness check.
+#
+#   python benchmarks/bench_odds.py [trials] [engine_matches]
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bf_bench_')
+os.chdir(WORKDIR)
+os.environ['BATTLE_FORGE_DB'] = os.path.join(WORKDIR, 'odds.db')
+
+import battle_forge_bot as bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def engine_rates(sport, teams, matches):
+    outcomes = Counter(bot.play_match(sport, teams, seed)[1].winner for seed in range(matches))
+    return [outcomes[name] / matches for name, power in teams], outcomes[None] / matches
+
+
+def main():
+    trials = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    matches = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    teams = [('strong', 140), ('weak', 100)]
+    rows = [(1, 1, 'strong', 0, 0, 140), (2, 2, 'weak', 0, 0, 100)]
+    cache = bot.OddsCache(64, trials)
+    print(f"{'sport':13} {'estimate':>9} {'hit':>7}  {'odds (strong/weak/tie)':24} engine ({matches} matches)")
+    for sport in bot.SPORTS:
+        bot.estimate_odds(sport, (140, 100), trials)  # warm the step tables
+        start = time.perf_counter()
+        for _ in range(20):
+            probabilities, tie = bot.estimate_odds(sport, (140, 100), trials)
+        estimate = (time.perf_counter() - start) / 20
+        cache.get(sport, rows)
+        start = time.perf_counter()
+        for _ in range(1000):
+            cache.get(sport, rows)
+        hit = (time.perf_counter() - start) / 1000
+        rates, engine_tie = engine_rates(sport, teams, matches)
+        print(f"{sport:13} {estimate * 1000:7.2f}ms {hit * 1e6:5.1f}us  "
+              f"{probabilities[0]:6.1%} {probabilities[1]:6.1%} {tie:6.1%}     "
+              f"{rates[0]:6.1%} {rates[1]:6.1%} {engine_tie:6.1%}")
+    bot.db.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# Fills the water book with many resting orders (20k by default) from many
+# players, then compares the old way to see the market (list every open
+# trade, looking up each seller) with a /book snapshot from memory, and
+# times incoming orders that cross the book and fill against several
+# resting orders each. Checks that goods and coins are conserved and that
+# the in-memory book matches one reloaded from the trades table.
+#
+#   python benchmarks/bench_orderbook.py [resting_orders] [incoming_orders]
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bf_bench_')
+os.chdir(WORKDIR)
+os.environ['BATTLE_FORGE_DB'] = os.path.join(WORKDIR, 'orderbook.db')
+
+import battle_forge_bot as bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+PLAYERS = 500
+GROUP = 'bench'
+
+
+def populate(conn):
+    c = conn.cursor()
+    c.executemany('INSERT INTO players (player_id, username, water, coins) VALUES (?, ?, ?, ?)',
+                  [(player_id, f"p{player_id}", 10 ** 7, 10 ** 9) for player_id in range(1, PLAYERS + 1)])
+
+
+def totals(conn):
+    # Water and coins owned or held by open orders
+    c = conn.cursor()
+    bot.player_cache.flush(conn)
+    c.execute('SELECT SUM(water), SUM(coins) FROM players')
+    water, coins = c.fetchone()
+    c.execute('''SELECT COALESCE(SUM(CASE WHEN side = 'sell' THEN remaining END), 0),
+                        COALESCE(SUM(CASE WHEN side = 'buy' THEN remaining * price END), 0)
+                 FROM trades WHERE status = 'open' ''')
+    held_water, held_coins = c.fetchone()
+    return water + held_water, coins + held_coins
+
+
+def legacy_listing(conn):
+    # What /accepttrade without arguments did before the book
+    c = conn.cursor()
+    c.execute('SELECT * FROM trades WHERE status = "open"')
+    response = "Open trades:\n"
+    for trade in c.fetchall():
+        seller = bot.get_player(conn, trade[1])
+        response += f"id: {trade[0]}, seller: @{seller[1]}, item: {trade[2]}, quantity: {trade[3]}, price: {trade[4]} {trade[5]}\n"
+    return response
+
+
+def place(conn, rng, side, low, high):
+    with bot.unit_of_work(conn):
+        return bot.place_order(conn, rng.randint(1, PLAYERS), side, 'water', rng.randint(1, 100), rng.randint(low, high), GROUP)
+
+
+def main():
+    resting = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    incoming = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    conn = bot.open_connection()
+    with bot.unit_of_work(conn):
+        populate(conn)
+    rng = random.Random(7)
+    # Asks from 101 up and bids up to 100, so nothing crosses while filling
+    start = time.perf_counter()
+    for i in range(resting):
+        if i % 2:
+            place(conn, rng, 'sell', 101, 200)
+        else:
+            place(conn, rng, 'buy', 1, 100)
+    placed = (time.perf_counter() - start) / resting
+    with bot.unit_of_work(conn):
+        before = totals(conn)
+    print(f"{resting} resting orders, {placed * 1e6:.0f}us each to place")
+    start = time.perf_counter()
+    listing = legacy_listing(conn)
+    legacy = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(100):
+        snapshot = bot.book_text('water', GROUP)
+    snap = (time.perf_counter() - start) / 100
+    print(f"{'view':18} {'time':>10} {'chars':>9}")
+    print(f"{'list every trade':18} {legacy * 1000:8.1f}ms {len(listing):9}")
+    print(f"{'/book snapshot':18} {snap * 1000:8.3f}ms {len(snapshot):9}")
+    # Marketable orders that sweep a few levels each
+    fills = 0
+    start = time.perf_counter()
+    for i in range(incoming):
+        response = place(conn, rng, 'buy', 105, 110) if i % 2 else place(conn, rng, 'sell', 90, 95)
+        fills += response.count('Filled')
+    matched = (time.perf_counter() - start) / incoming
+    print(f"crossing orders: {matched * 1e6:.0f}us each, {fills / incoming:.1f} fills per order")
+    with bot.unit_of_work(conn):
+        after = totals(conn)
+    assert before == after, (before, after)
+    reloaded = bot.OrderBook()
+    reloaded.load(conn)
+    for side_levels, reloaded_levels in zip(bot.order_book.depth(f"{GROUP} coin", 'water', 10 ** 6),
+                                            reloaded.depth(f"{GROUP} coin", 'water', 10 ** 6)):
+        assert side_levels == reloaded_levels
+    print("goods and coins conserved, book matches the trades table")
+    bot.db.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# Hot-player workload (reads plus coin and resource increments, as in /mystats,
+# /gamble and wager settlement) with the player cache flushing after every
+# write versus write-behind with the default flush policy.
+#
+#   python benchmarks/bench_player_cache.py [commands] [players]
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bf_bench_')
+os.chdir(WORKDIR)
+os.environ['BATTLE_FORGE_DB'] = os.path.join(WORKDIR, 'player_cache.db')
+
+import battle_forge_bot as bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def hot_command(conn, player_id):
+    bot.get_player(conn, player_id)
+    bot.add_coins(conn, player_id, 1)
+    bot.adjust_resources(conn, player_id, water=1, food=1, ore=1)
+    return bot.get_player(conn, player_id)
+
+
+async def run(commands, players):
+    executor = bot.DatabaseExecutor(bot.DB_READERS)
+    player_ids = [random.randint(1, players) for _ in range(commands)]
+    start = time.perf_counter()
+    for player_id in player_ids:
+        await executor.write(hot_command, player_id)
+    elapsed = time.perf_counter() - start
+    executor.shutdown()
+    return elapsed
+
+
+def main():
+    commands = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    players = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    conn = bot.open_connection()
+    with bot.unit_of_work(conn):
+        conn.executemany('INSERT INTO players (player_id, username) VALUES (?, ?)',
+                         ((player_id, f"bench_{player_id}") for player_id in range(1, players + 1)))
+    conn.close()
+    bot.db.shutdown()
+
+    for label, max_dirty in (('flush-every-write', 1), ('write-behind', bot.PLAYER_CACHE_MAX_DIRTY)):
+        bot.player_cache = bot.PlayerCache(bot.PLAYER_CACHE_SIZE, bot.PLAYER_CACHE_FLUSH_SECONDS, max_dirty)
+        elapsed = asyncio.run(run(commands, players))
+        stats = bot.player_cache.stats()
+        print(f"{label:17} {elapsed / commands * 1e6:8.1f} us/command, {stats['flushes']:5d} flushes, "
+              f"{stats['rows_flushed']:5d} rows written, hits {stats['hits']} / misses {stats['misses']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+# Races fields of growing size through the match engine and reports the cost
+# per race and per tick, the live updates per race and the longest tick text,
+# which should all stay flat as the field grows, plus the cost of quoting
+# odds for the field.
+#
+#   python benchmarks/bench_racing.py [races_per_field]
+import logging
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bf_bench_')
+os.chdir(WORKDIR)
+os.environ['BATTLE_FORGE_DB'] = os.path.join(WORKDIR, 'racing.db')
+
+import battle_forge_bot as bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def main():
+    races = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    print(f"{'teams':>5} {'us/race':>9} {'us/tick':>8} {'updates':>8} {'max chars':>10} {'odds':>9}")
+    for size in (2, 4, 10, 25, 50, 100, 200):
+        teams = [(f"{bot.AI_TEAM_NAMES[i % len(bot.AI_TEAM_NAMES)]}{i}", 80 + i % 40) for i in range(size)]
+        updates = 0
+        start = time.perf_counter()
+        for seed in range(races):
+            events, result = bot.play_match('f1_racing', teams, seed)
+            updates += len(events)
+        elapsed = (time.perf_counter() - start) / races
+        longest = max(len(event.text) for event in events)
+        odds = float('inf')
+        for _ in range(3):
+            start = time.perf_counter()
+            bot.estimate_odds('f1_racing', tuple(power for name, power in teams))
+            odds = min(odds, time.perf_counter() - start)
+        print(f"{size:5} {elapsed * 1e6:9.1f} {elapsed / bot.RACING_TICKS * 1e6:8.1f} {updates / races:8.1f} "
+              f"{longest:10} {odds * 1000:7.1f}ms")
+    bot.db.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# Settles one match carrying many wagers (10k by default) two ways: the old
+# per-wager loop (one player read and one coin update per wager, one message
+# each) and settle_match_tx, which credits every winner with set-based SQL
+# and builds a single summary. Reports time per settlement and the number of
+# Telegram messages each would send, and checks both pay every bettor the
+# same. The teams belong to two players who don't bet, so their rewards stay
+# out of the comparison.
+#
+#   python benchmarks/bench_settlement.py [wagers] [players]
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bf_bench_')
+os.chdir(WORKDIR)
+os.environ['BATTLE_FORGE_DB'] = os.path.join(WORKDIR, 'settlement.db')
+
+import battle_forge_bot as bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def populate(conn, wagers, players):
+    rng = random.Random(7)
+    c = conn.cursor()
+    c.execute('DELETE FROM wagers')
+    c.execute('DELETE FROM matches')
+    c.execute('DELETE FROM teams')
+    c.execute('DELETE FROM players')
+    c.executemany('INSERT INTO players (player_id, username, coins) VALUES (?, ?, 1000)',
+                  [(player_id, f"p{player_id}") for player_id in range(1, players + 3)])
+    c.executemany('INSERT INTO teams (team_id, player_id, name, wins, win_streak, power) VALUES (?, ?, ?, 0, 0, 100)',
+                  [(1, players + 1, 'home'), (2, players + 2, 'away')])
+    c.execute("INSERT INTO matches (match_id, sport, team_ids, max_teams, status, start_time, group_name) "
+              "VALUES (1, 'soccer', ?, 2, 'running', ?, 'G')", (json.dumps([1, 2]), bot.datetime.now().isoformat()))
+    c.executemany('INSERT INTO wagers (player_id, match_id, team_id, amount, multiplier) VALUES (?, 1, ?, ?, ?)',
+                  [(rng.randint(1, players), rng.choice((1, 2)), rng.randint(1, 50), rng.choice((1.6, 2.05, 3.4)))
+                   for _ in range(wagers)])
+
+
+def legacy_settle(conn, match_id, winner_id, group_name):
+    # The loop settle_match_tx used before: one read, write and message per wager
+    messages = []
+    for wager in bot.get_wagers(conn, match_id):
+        player = bot.get_player(conn, wager[1])
+        if wager[3] == winner_id:
+            payout = int(wager[4] * wager[5])
+            bot.add_coins(conn, wager[1], payout)
+            messages.append(f"@{player[1]} won {payout} {group_name} coins from wager!")
+        else:
+            messages.append(f"@{player[1]} lost {wager[4]} {group_name} coins from wager.")
+    return messages
+
+
+def coins(conn, players):
+    # -> {bettor: coins}
+    with bot.unit_of_work(conn):
+        bot.player_cache.flush(conn)
+    return dict(conn.execute('SELECT player_id, coins FROM players WHERE player_id <= ?', (players,)).fetchall())
+
+
+def run(conn, label, settle, wagers, players):
+    # Both runs start from the same tables and an empty player cache
+    bot.player_cache.clear()
+    with bot.unit_of_work(conn):
+        populate(conn, wagers, players)
+    teams = bot.get_teams(conn, [1, 2])
+    before = coins(conn, players)
+    start = time.perf_counter()
+    with bot.unit_of_work(conn):
+        messages = settle(conn, teams)
+    elapsed = time.perf_counter() - start
+    paid = {player_id: amount - before[player_id] for player_id, amount in coins(conn, players).items()}
+    print(f"{label:10} {elapsed * 1000:9.1f}ms {len(messages):9} {sum(paid.values()):10}")
+    return paid
+
+
+def main():
+    wagers = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    players = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    conn = bot.open_connection()
+    print(f"{wagers} wagers from {players} players")
+    print(f"{'path':10} {'settle':>11} {'messages':>9} {'paid':>10}")
+    legacy = run(conn, 'per-wager', lambda conn, teams: legacy_settle(conn, 1, 1, 'G'), wagers, players)
+    set_based = run(conn, 'set-based', lambda conn, teams: bot.settle_match_tx(conn, 1, teams, 1, 'G'), wagers, players)
+    assert set_based == legacy, [(player_id, legacy[player_id], paid) for player_id, paid in set_based.items() if paid != legacy[player_id]]
+    bot.db.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+# Runs the real handlers headlessly: a temporary SQLite database, a fake
+# context.bot that records every Bot API call instead of talking to Telegram,
+# and (by default) a time-warp event loop whose clock jumps straight to the
+# next timer whenever nothing is ready to run, so match pacing, start delays
+# and rate limiting cost no wall time. For every sport it plays matches end
+# to end (/sportevent, /gamble, /acceptsport, supervisor, settlement), then
+# runs /war and random_event, and reports match events per second, database
+# statements per run (every statement SQLite executes, including BEGIN,
+# SAVEPOINT and COMMIT) and Bot API calls per run.
+#
+#   python benchmarks/bench_simulation.py [matches_per_sport] [--real-time]
+#
+# --real-time keeps the normal event loop and every sleep; use it with a
+# handful of matches to see the pacing as players would.
+import asyncio
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bf_bench_')
+os.chdir(WORKDIR)
+os.environ['BATTLE_FORGE_DB'] = os.path.join(WORKDIR, 'simulation.db')
+
+import battle_forge_bot as bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+CHAT_ID = -100
+BETTOR_ID = 99
+
+
+class TimeWarpLoop(asyncio.SelectorEventLoop):
+    # Virtual clock: when no callback is ready, skip ahead to the earliest
+    # live timer instead of waiting for it. I/O and executor threads still
+    # run in real time.
+    def __init__(self):
+        super().__init__()
+        self.warped = 0.0
+
+    def time(self):
+        return super().time() + self.warped
+
+    def _run_once(self):
+        if not self._ready and not self._stopping:
+            timers = [handle.when() for handle in self._scheduled if not handle.cancelled()]
+            if timers:
+                self.warped += max(min(timers) - self.time(), 0)
+        super()._run_once()
+
+
+class Statements:
+    # Counts statements on every connection the bot opens from now on
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def traced(self, conn):
+        conn.set_trace_callback(self._seen)
+        return conn
+
+    def _seen(self, statement):
+        with self._lock:
+            self.count += 1
+
+
+class FakeMessage:
+    def __init__(self, fake_bot, chat_id, message_id, text=''):
+        self.bot = fake_bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        return await self.bot.send_message(chat_id=self.chat_id, text=text, **kwargs)
+
+
+class FakeBot:
+    def __init__(self):
+        self.calls = Counter()
+        self._ids = 0
+
+    def message(self, chat_id, text=''):
+        self._ids += 1
+        return FakeMessage(self, chat_id, self._ids, text)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls['send_message'] += 1
+        return self.message(chat_id, text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.calls['edit_message_text'] += 1
+        return self.message(chat_id, text)
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        self.calls['delete_message'] += 1
+        return True
+
+
+async def command(fake_bot, handler, player_id, *args, chat_id=CHAT_ID):
+    # Runs one command handler and returns its replies
+    update = types.SimpleNamespace(
+        effective_user=types.SimpleNamespace(id=player_id, username=f"bench_{player_id}"),
+        effective_chat=types.SimpleNamespace(id=chat_id, title='bench'),
+        message=fake_bot.message(chat_id),
+    )
+    context = types.SimpleNamespace(args=[str(arg) for arg in args], bot=fake_bot)
+    await handler(update, context)
+    return update.message.replies
+
+
+async def play(fake_bot, sport, teams, chat_id):
+    # Each match in its own group chat, as Telegram's per-chat limits expect
+    replies = await command(fake_bot, bot.sportevent, 1, sport, teams, chat_id=chat_id)
+    created = re.search(r"(\S+) has joined \(match id: (\d+)\)", replies[-1])
+    team_name, match_id = created.group(1), int(created.group(2))
+    await command(fake_bot, bot.acceptsport, 2, match_id, chat_id=chat_id)
+    await command(fake_bot, bot.gamble, BETTOR_ID, match_id, team_name, 1, chat_id=chat_id)
+    for player_id in range(3, teams + 1):
+        await command(fake_bot, bot.acceptsport, player_id, match_id, chat_id=chat_id)
+
+
+async def settle_all():
+    # Waiting on the match tasks themselves; polling would spin under time warp
+    while bot.supervisor._tasks:
+        await asyncio.wait(list(bot.supervisor._tasks.values()))
+
+
+class Measure:
+    def __init__(self, label, runs, fake_bot, statements):
+        self.label = label
+        self.runs = runs
+        self.fake_bot = fake_bot
+        self.statements = statements
+        self.events = 0
+
+    def __enter__(self):
+        self.loop = asyncio.get_running_loop()
+        self.start = time.perf_counter()
+        self.warped = getattr(self.loop, 'warped', 0.0)
+        self.calls = sum(self.fake_bot.calls.values())
+        self.statements_before = self.statements.count
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        warped = getattr(self.loop, 'warped', 0.0) - self.warped
+        calls = sum(self.fake_bot.calls.values()) - self.calls
+        statements = self.statements.count - self.statements_before
+        events = f"{self.events / elapsed:10.0f}" if self.events else f"{'-':>10}"
+        print(f"{self.label:13} {self.runs:5} {elapsed / self.runs * 1000:9.2f}ms {events} "
+              f"{statements / self.runs:9.1f} {calls / self.runs:7.1f} {warped / self.runs:9.1f}s")
+
+
+async def run(matches, statements):
+    fake_bot = FakeBot()
+    for player_id in (1, 2, 3, 4, BETTOR_ID):
+        await command(fake_bot, bot.start, player_id)
+    events = []
+    play_match = bot.play_match
+
+    def counted_play_match(sport, teams, seed=None):
+        match_events, result = play_match(sport, teams, seed)
+        events.append(len(match_events))
+        return match_events, result
+
+    bot.play_match = counted_play_match
+    print(f"{'scenario':13} {'runs':>5} {'wall/run':>11} {'events/s':>10} {'stmts/run':>9} "
+          f"{'api/run':>7} {'warped/run':>10}")
+    for sport in bot.SPORTS:
+        teams = 4 if sport in bot.RACING_SPORTS else 2
+        with Measure(sport, matches, fake_bot, statements) as measure:
+            await asyncio.gather(*(play(fake_bot, sport, teams, CHAT_ID - i) for i in range(matches)))
+            await settle_all()
+            measure.events = sum(events)
+        events.clear()
+    bot.play_match = play_match
+    with Measure('war', matches, fake_bot, statements):
+        for _ in range(matches):
+            await command(fake_bot, bot.war, 1, 2, 10)
+    with Measure('random_event', matches, fake_bot, statements):
+        for _ in range(matches):
+            await bot.db.write(bot.random_event, CHAT_ID)
+    print(f"Bot API calls: {dict(fake_bot.calls)}")
+
+
+def main():
+    real_time = '--real-time' in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != '--real-time']
+    matches = int(args[0]) if args else 50
+    statements = Statements()
+    open_connection = bot.open_connection
+    bot.open_connection = lambda: statements.traced(open_connection())
+    with asyncio.Runner(loop_factory=None if real_time else TimeWarpLoop) as runner:
+        runner.run(run(matches, statements))
+    bot.db.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+# Plays all-AI tournaments (a 64-team knockout and a round robin) through the
+# tournament scheduler with no delay between rounds, while a ticker records
+# how late each 10 ms tick fires and /tournamentstatus is asked every 50 ms,
+# as players would between rounds. Reports fixtures per second, round
+# digests sent, and the ticker lag and command latency during the run.
+#
+#   python benchmarks/bench_tournament.py [knockout_teams] [round_robin_teams]
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bf_bench_')
+os.chdir(WORKDIR)
+os.environ['BATTLE_FORGE_DB'] = os.path.join(WORKDIR, 'tournament.db')
+os.environ['BATTLE_FORGE_TOURNAMENT_ROUND_DELAY'] = '0'
+os.environ['BATTLE_FORGE_OUTBOX_CHAT_RATE'] = '1000'
+os.environ['BATTLE_FORGE_OUTBOX_CHAT_BURST'] = '1000'
+
+import battle_forge_bot as bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+TICK = 0.01
+STATUS_INTERVAL = 0.05
+CHAT_ID = -100
+
+
+class FakeMessage:
+    def __init__(self, message_id):
+        self.message_id = message_id
+
+    async def reply_text(self, text, **kwargs):
+        return self
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+        return FakeMessage(self.sent)
+
+
+def open_ai_tournament(conn, sport, format, size):
+    c = conn.cursor()
+    c.execute('''INSERT INTO tournaments (sport, format, size, status, chat_id, group_name, starts_at)
+                 VALUES (?, ?, ?, 'open', ?, 'bench', ?)''', (sport, format, size, CHAT_ID, bot.datetime.now().isoformat()))
+    return c.lastrowid
+
+
+def count_fixtures(conn, tournament_id):
+    c = conn.cursor()
+    c.execute('SELECT COUNT(*) FROM tournament_fixtures WHERE tournament_id = ? AND away_team_id IS NOT NULL', (tournament_id,))
+    return c.fetchone()[0]
+
+
+async def ticker(lags, done):
+    while not done.is_set():
+        expected = time.perf_counter() + TICK
+        await asyncio.sleep(TICK)
+        lags.append(max(time.perf_counter() - expected, 0))
+
+
+async def status_requests(tournament_id, latencies, done):
+    update = types.SimpleNamespace(effective_user=types.SimpleNamespace(id=1, username='bench'),
+                                   effective_chat=types.SimpleNamespace(id=CHAT_ID, title='bench'),
+                                   message=FakeMessage(0))
+    context = types.SimpleNamespace(args=[str(tournament_id)])
+    while not done.is_set():
+        start = time.perf_counter()
+        await bot.tournamentstatus(update, context)
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(STATUS_INTERVAL)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0
+
+
+async def run(label, sport, format, size):
+    fake_bot = FakeBot()
+    tournament_id = await bot.db.write(open_ai_tournament, sport, format, size)
+    lags, latencies = [], []
+    done = asyncio.Event()
+    watchers = [asyncio.create_task(ticker(lags, done)), asyncio.create_task(status_requests(tournament_id, latencies, done))]
+    start = time.perf_counter()
+    bot.tournament_scheduler.schedule(fake_bot, tournament_id)
+    await asyncio.wait(list(bot.tournament_scheduler._tasks.values()))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await asyncio.gather(*watchers)
+    tournament = await bot.db.read(bot.get_tournament, tournament_id)
+    fixtures = await bot.db.read(count_fixtures, tournament_id)
+    print(f"{label:22} {tournament[4]:9} {tournament[6]:6} {fixtures:8} {elapsed:7.2f}s {fixtures / elapsed:10.0f} "
+          f"{fake_bot.sent:9} {percentile(lags, 0.99) * 1000:7.1f}ms {max(lags, default=0) * 1000:7.1f}ms "
+          f"{percentile(latencies, 0.99) * 1000:7.1f}ms")
+
+
+async def run_all(knockout_teams, round_robin_teams):
+    print(f"{'tournament':22} {'status':9} {'rounds':>6} {'fixtures':>8} {'elapsed':>8} {'fixtures/s':>10} "
+          f"{'messages':>9} {'p99 lag':>9} {'max lag':>9} {'p99 status':>9}")
+    for sport in bot.TOURNAMENT_SPORTS:
+        await run(f"{sport} knockout {knockout_teams}", sport, 'knockout', knockout_teams)
+    await run(f"soccer round robin {round_robin_teams}", 'soccer', 'round_robin', round_robin_teams)
+
+
+def main():
+    knockout_teams = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    round_robin_teams = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    asyncio.run(run_all(knockout_teams, round_robin_teams))
+    bot.db.shutdown()
+
+
+if __name__ == '__main__':
+    main()
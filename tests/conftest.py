@@ -0,0 +1,41 @@
+# The bot opens its database and starts the db executor at import, so point
+# it at a scratch directory first. Every test shares that database and the
+# in-memory caches, and keeps to players of its own (see player_ids).
+import asyncio
+import itertools
+import logging
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix='bf_test_')
+os.chdir(WORKDIR)
+os.environ['BATTLE_FORGE_DB'] = os.path.join(WORKDIR, 'test.db')
+
+import battle_forge_bot as bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+_player_ids = itertools.count(1000)
+
+
+@pytest.fixture
+def player_ids():
+    # -> callable returning n player ids no other test uses
+    return lambda n=1: [next(_player_ids) * 1000 + i for i in range(n)]
+
+
+def write(fn, *args, **kwargs):
+    return asyncio.run(bot.db.write(fn, *args, **kwargs))
+
+
+def read(fn, *args, **kwargs):
+    return asyncio.run(bot.db.read(fn, *args, **kwargs))
+
+
+def pytest_sessionfinish(session, exitstatus):
+    bot.db.shutdown()
@@ -0,0 +1,99 @@
+import asyncio
+import json
+import threading
+import types
+
+import battle_forge_bot as bot
+from conftest import read, write
+
+
+class Message:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def command(player_id, *args):
+    # -> (update, context) for player_id sending a command with args
+    update = types.SimpleNamespace(effective_user=types.SimpleNamespace(id=player_id, username=f"p{player_id}"),
+                                   effective_chat=types.SimpleNamespace(id=-1, title='bets'), message=Message())
+    return update, types.SimpleNamespace(args=[str(arg) for arg in args])
+
+
+def open_match(conn, sport, owners, max_teams):
+    # -> (match id, team names), one team per owner
+    names = []
+    for owner in owners:
+        conn.execute('INSERT INTO players (player_id, username, coins) VALUES (?, ?, 1000)', (owner, f"p{owner}"))
+        names.append(bot.ensure_player_team(conn, owner, f"p{owner}")[2])
+    team_ids = [bot.get_player_team(conn, owner)[0] for owner in owners]
+    match_id = bot.create_match(conn, sport, team_ids[0], max_teams)
+    bot.update_match(conn, match_id, 'open', team_ids=team_ids)
+    return match_id, names
+
+
+def test_bets_are_quoted_off_the_writer(player_ids, monkeypatch):
+    owner, rival, bettor = player_ids(3)
+    match_id, names = write(open_match, 'boxing', [owner, rival], 2)
+    write(lambda conn: conn.execute('INSERT INTO players (player_id, username, coins) VALUES (?, ?, 1000)', (bettor, 'b')))
+    threads = []
+    estimate_odds = bot.estimate_odds
+
+    def recording(*args, **kwargs):
+        threads.append(threading.current_thread().name)
+        return estimate_odds(*args, **kwargs)
+
+    monkeypatch.setattr(bot, 'estimate_odds', recording)
+    update, context = command(bettor, match_id, names[1], 100)
+    asyncio.run(bot.gamble(update, context))
+    assert update.message.replies[0].startswith(f"Bet placed: 100 bets coins on {names[1]}")
+    assert threads and 'db-writer' not in threads
+    quoted = read(bot.gamble_quote_tx, match_id, names[1])[2]
+    assert read(lambda conn: conn.execute('SELECT amount, multiplier FROM wagers WHERE player_id = ?', (bettor,)).fetchall()) == [(100, quoted)]
+    assert write(bot.get_player, bettor)[12] == 900
+
+
+def test_bets_close_when_the_match_starts(player_ids):
+    owner, rival, bettor = player_ids(3)
+    match_id, names = write(open_match, 'boxing', [owner, rival], 2)
+    _, team_id, multiplier = read(bot.gamble_quote_tx, match_id, names[0])
+    write(bot.start_match_tx, match_id)
+    response = write(bot.gamble_tx, bettor, 'b', match_id, team_id, names[0], 100, multiplier, 'bets')
+    assert response == "Invalid or closed match id!"
+    assert read(bot.gamble_quote_tx, match_id, names[0]) == ("Invalid or closed match id!", None, None)
+
+
+def test_quotes_refuse_unknown_teams_and_lone_teams(player_ids):
+    (owner,) = player_ids()
+    match_id, names = write(open_match, 'soccer', [owner], 2)
+    assert read(bot.gamble_quote_tx, match_id, 'nobody')[0] == "Invalid team name!"
+    assert read(bot.gamble_quote_tx, match_id, names[0])[0] == "Betting opens once a second team has joined!"
+
+
+def test_races_are_quoted_on_the_ai_teams_that_will_fill_them(player_ids):
+    (owner,) = player_ids()
+    match_id, names = write(open_match, 'horse_racing', [owner], 8)
+
+    def strengthen_ai_teams(conn):
+        bot.fill_with_ai_teams(conn, [], 7)
+        conn.execute('UPDATE teams SET power = 400 WHERE player_id IS NULL')
+
+    write(strengthen_ai_teams)
+    match = read(bot.get_match, match_id)
+    teams = [team for team in read(bot.get_teams, json.loads(match[2])) if team]
+    field = read(bot.quoted_field, match, teams)
+    assert len(field) == 8 and all(team[5] == 400 for team in field[1:])
+    # The owner's team of power 100 against seven of power 400 rarely wins
+    odds = bot.odds_cache.get('horse_racing', field)
+    assert odds.probabilities[0] < 0.05
+
+
+def test_payouts_keep_the_house_edge():
+    assert bot.payout_multiplier(0.5) == round(2 * (1 - bot.ODDS_HOUSE_EDGE), 2)
+    assert bot.payout_multiplier(0.95) == 1
+    assert bot.payout_multiplier(0.0001) == bot.ODDS_MAX_MULTIPLIER
+    assert bot.payout_multiplier(0) is None
+    for probability in (0.02, 0.1, 0.3, 0.6, 0.9):
+        assert probability * bot.payout_multiplier(probability) <= 1 - bot.ODDS_HOUSE_EDGE + 0.005
@@ -0,0 +1,154 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import pytest
+
+import battle_forge_bot as bot
+from conftest import read, write
+
+
+def coins(conn, player_id):
+    return bot.get_player(conn, player_id)[12]
+
+
+def test_writes_run_in_order_on_one_thread(player_ids):
+    (player_id,) = player_ids()
+    write(bot.provision_player, player_id, 'p')
+    seen = []
+
+    def step(conn, i):
+        seen.append((i, threading.current_thread().name))
+        bot.add_coins(conn, player_id, 1)
+        return coins(conn, player_id)
+
+    async def run():
+        return await asyncio.gather(*(bot.db.write(step, i) for i in range(50)))
+
+    before = write(coins, player_id)
+    assert asyncio.run(run()) == [before + i + 1 for i in range(50)]
+    assert [i for i, _ in seen] == list(range(50))
+    assert {name for _, name in seen} == {'db-writer'}
+
+
+def test_reads_see_committed_writes(player_ids):
+    (player_id,) = player_ids()
+    write(bot.provision_player, player_id, 'p')
+    write(bot.add_coins, player_id, 7)
+    assert read(coins, player_id) == write(coins, player_id)
+    assert read(lambda conn: threading.current_thread().name).startswith('db-reader')
+
+
+def test_errors_reach_the_caller_and_roll_back(player_ids):
+    (player_id,) = player_ids()
+    write(bot.provision_player, player_id, 'p')
+    before = write(coins, player_id)
+
+    def failing(conn):
+        bot.add_coins(conn, player_id, 100)
+        conn.execute('INSERT INTO trades (seller_id, item) VALUES (?, ?)', (player_id, 'oops'))
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError, match='boom'):
+        write(failing)
+    assert write(coins, player_id) == before
+    assert read(lambda conn: conn.execute('SELECT COUNT(*) FROM trades WHERE seller_id = ?', (player_id,)).fetchone()[0]) == 0
+    with pytest.raises(ZeroDivisionError):
+        read(lambda conn: 1 / 0)
+
+
+def test_one_failing_unit_leaves_its_batch_alone(player_ids):
+    first, second = player_ids(2)
+    executor = bot.DatabaseExecutor(1, group_commit_ms=50)
+
+    def failing(conn):
+        bot.add_coins(conn, first, 100)
+        raise ValueError('boom')
+
+    async def run():
+        return await asyncio.gather(executor.write(bot.provision_player, first, 'a'),
+                                    executor.write(failing),
+                                    executor.write(bot.provision_player, second, 'b'),
+                                    return_exceptions=True)
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        executor.shutdown()
+    assert isinstance(results[1], ValueError)
+    assert executor.commits == 1
+    assert read(coins, first) == read(coins, second)
+
+
+def test_failed_batch_fails_every_write():
+    executor = bot.DatabaseExecutor(1, group_commit_ms=50)
+
+    @contextmanager
+    def broken_unit_of_work(conn):
+        raise sqlite3.OperationalError('disk I/O error')
+        yield conn
+
+    async def run():
+        writes = [executor.write(lambda conn: 'done') for _ in range(5)]
+        return await asyncio.wait_for(asyncio.gather(*writes, return_exceptions=True), 5)
+
+    original = bot.unit_of_work
+    bot.unit_of_work = broken_unit_of_work
+    try:
+        results = asyncio.run(run())
+    finally:
+        bot.unit_of_work = original
+        executor.shutdown()
+    assert len(results) == 5
+    assert all(isinstance(result, sqlite3.OperationalError) for result in results)
+
+
+def test_nested_unit_rolls_back_alone(player_ids):
+    (player_id,) = player_ids()
+    write(bot.provision_player, player_id, 'p')
+    before = write(coins, player_id)
+
+    def nested(conn):
+        bot.add_coins(conn, player_id, 10)
+        with pytest.raises(ValueError):
+            with bot.unit_of_work(conn):
+                bot.add_coins(conn, player_id, 5)
+                bot.place_order(conn, player_id, 'buy', 'ore', 1, 1, 'nested')
+                assert coins(conn, player_id) == before + 14
+                raise ValueError('undo')
+        assert coins(conn, player_id) == before + 10
+        return conn.execute('SELECT COUNT(*) FROM trades WHERE seller_id = ?', (player_id,)).fetchone()[0]
+
+    assert write(nested) == 0
+    assert write(coins, player_id) == before + 10
+    assert read(coins, player_id) == before + 10
+    assert (player_id, before + 10, 0) in bot.rankings.top(10 ** 6)
+    assert bot.order_book.depth('nested coin', 'ore', 10) == ([], [])
+
+
+def test_event_loop_keeps_ticking_under_load(player_ids):
+    # A ticker stands in for live match commentary while new players join
+    # and stats are read; the database work must stay off the event loop
+    new_players = player_ids(20)
+    lags = []
+
+    async def ticker(done):
+        while not done.is_set():
+            expected = time.perf_counter() + 0.01
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - expected)
+
+    async def run():
+        done = asyncio.Event()
+        tick = asyncio.create_task(ticker(done))
+        await asyncio.gather(*(bot.db.write(bot.mystats_tx, player_id, 'p', 'test') for player_id in new_players),
+                             *(bot.db.read(bot.currencies_tx, 'test', 1) for _ in range(20)))
+        done.set()
+        await tick
+
+    asyncio.run(run())
+    lags.sort()
+    assert len(lags) > 5
+    assert lags[int(len(lags) * 0.99)] < 0.1, lags[-5:]
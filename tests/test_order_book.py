@@ -0,0 +1,101 @@
+import random
+
+import pytest
+
+import battle_forge_bot as bot
+from conftest import read, write
+
+
+def add_traders(conn, player_ids, water=1000, coins=100000):
+    conn.executemany('INSERT INTO players (player_id, username, water, coins) VALUES (?, ?, ?, ?)',
+                     [(player_id, f"t{player_id}", water, coins) for player_id in player_ids])
+
+
+def holdings(conn, player_ids, group):
+    # Water and coins the players own or have on the book
+    rows = [bot.get_player(conn, player_id) for player_id in player_ids]
+    held_water, held_coins = conn.execute('''SELECT COALESCE(SUM(CASE WHEN side = 'sell' THEN remaining END), 0),
+                                                 COALESCE(SUM(CASE WHEN side = 'buy' THEN remaining * price END), 0)
+                                          FROM trades WHERE status = 'open' AND currency = ?''', (f"{group} coin",)).fetchone()
+    return sum(row[4] for row in rows) + held_water, sum(row[12] for row in rows) + held_coins
+
+
+def player(conn, player_id):
+    return bot.get_player(conn, player_id)
+
+
+def test_fills_best_price_then_oldest(player_ids):
+    first, second, cheapest, buyer = player_ids(4)
+    write(add_traders, [first, second, cheapest, buyer])
+    write(bot.place_order, first, 'sell', 'water', 10, 10, 'priority')
+    write(bot.place_order, second, 'sell', 'water', 10, 10, 'priority')
+    write(bot.place_order, cheapest, 'sell', 'water', 10, 9, 'priority')
+    response = write(bot.place_order, buyer, 'buy', 'water', 25, 10, 'priority')
+    assert response.count('Filled') == 3
+    assert 'Completely filled' in response
+    # 10 at 9 and 15 at 10: the limit price held back for the cheaper fill is refunded
+    assert write(player, buyer)[12] == 100000 - 240
+    assert write(player, buyer)[4] == 1025
+    assert [write(player, seller)[12] for seller in (first, second, cheapest)] == [100100, 100050, 100090]
+    asks, bids = bot.order_book.depth('priority coin', 'water', 10)
+    assert asks == [(10, 5, 1)] and bids == []
+
+
+def test_never_trades_with_itself(player_ids):
+    trader, other = player_ids(2)
+    write(add_traders, [trader, other])
+    write(bot.place_order, trader, 'sell', 'water', 10, 5, 'self')
+    write(bot.place_order, other, 'sell', 'water', 10, 6, 'self')
+    response = write(bot.place_order, trader, 'buy', 'water', 10, 6, 'self')
+    assert response.count('Filled') == 1
+    asks, bids = bot.order_book.depth('self coin', 'water', 10)
+    assert asks == [(5, 10, 1)] and bids == []
+
+
+def test_cancel_returns_what_is_held(player_ids):
+    seller, buyer = player_ids(2)
+    write(add_traders, [seller, buyer])
+    write(bot.place_order, seller, 'sell', 'water', 10, 7, 'cancel')
+    write(bot.place_order, buyer, 'buy', 'water', 4, 7, 'cancel')
+    (trade_id,) = read(lambda conn: conn.execute("SELECT trade_id FROM trades WHERE seller_id = ? AND status = 'open'",
+                                                 (seller,)).fetchone())
+    assert write(bot.cancelorder_tx, seller, trade_id) == f"Order #{trade_id} cancelled, 6 water withdrawn."
+    assert write(bot.cancelorder_tx, seller, trade_id) == "No open order of yours with that id!"
+    assert write(player, seller)[4] == 996 and write(player, seller)[12] == 100028
+    assert bot.order_book.depth('cancel coin', 'water', 10) == ([], [])
+
+
+def test_random_orders_conserve_goods_and_coins(player_ids):
+    traders = player_ids(20)
+    write(add_traders, traders)
+    before = write(holdings, traders, 'random')
+    rng = random.Random(3)
+    for _ in range(500):
+        side = rng.choice(('buy', 'sell'))
+        write(bot.place_order, rng.choice(traders), side, 'water', rng.randint(1, 50), rng.randint(90, 110), 'random')
+    open_orders = read(lambda conn: conn.execute("SELECT trade_id, seller_id FROM trades WHERE status = 'open' AND currency = ?",
+                                                 ('random coin',)).fetchall())
+    for trade_id, seller_id in open_orders[::3]:
+        write(bot.cancelorder_tx, seller_id, trade_id)
+    assert write(holdings, traders, 'random') == before
+    asks, bids = bot.order_book.depth('random coin', 'water', 10 ** 6)
+    assert not asks or not bids or asks[0][0] > bids[0][0]
+    reloaded = bot.OrderBook()
+    read(reloaded.load)
+    assert reloaded.depth('random coin', 'water', 10 ** 6) == (asks, bids)
+
+
+def test_orders_of_a_failed_command_never_reach_the_book(player_ids):
+    seller, buyer = player_ids(2)
+    write(add_traders, [seller, buyer])
+    write(bot.place_order, seller, 'sell', 'water', 10, 5, 'failed')
+
+    def failing(conn):
+        bot.place_order(conn, buyer, 'buy', 'water', 4, 5, 'failed')
+        bot.place_order(conn, buyer, 'buy', 'water', 3, 4, 'failed')
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        write(failing)
+    assert bot.order_book.depth('failed coin', 'water', 10) == ([(5, 10, 1)], [])
+    assert write(player, buyer)[4] == 1000 and write(player, buyer)[12] == 100000
@@ -0,0 +1,52 @@
+import pytest
+
+import battle_forge_bot as bot
+from conftest import write
+
+
+def stored(player_id):
+    # The players row as SQLite has it, past the cache
+    conn = bot.open_connection()
+    try:
+        return conn.execute('SELECT water, coins FROM players WHERE player_id = ?', (player_id,)).fetchone()
+    finally:
+        conn.close()
+
+
+def add_players(conn, player_ids):
+    conn.executemany('INSERT INTO players (player_id, username, water, coins) VALUES (?, ?, 100, 100)',
+                     [(player_id, f"c{player_id}") for player_id in player_ids])
+
+
+def test_player_only_changes_are_written_behind(player_ids, monkeypatch):
+    monkeypatch.setattr(bot.player_cache, 'flush_interval', 3600)
+    (player_id,) = player_ids()
+    write(add_players, [player_id])
+    write(bot.adjust_resources, player_id, water=5)
+    assert player_id in bot.player_cache.dirty_ids()
+    assert stored(player_id) == (100, 100)
+
+
+def test_changes_commit_with_the_rows_they_go_with(player_ids):
+    seller, buyer = player_ids(2)
+    write(add_players, [seller, buyer])
+    # Water held by a resting order, then coins paid for part of it
+    write(bot.place_order, seller, 'sell', 'water', 30, 2, 'through')
+    assert stored(seller) == (70, 100)
+    write(bot.place_order, buyer, 'buy', 'water', 10, 2, 'through')
+    assert stored(seller) == (70, 120) and stored(buyer) == (110, 80)
+    assert not {seller, buyer} & set(bot.player_cache.dirty_ids())
+
+
+def test_rolled_back_changes_are_never_written(player_ids):
+    (player_id,) = player_ids()
+    write(add_players, [player_id])
+
+    def failing(conn):
+        bot.place_order(conn, player_id, 'sell', 'water', 30, 2, 'through')
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        write(failing)
+    assert stored(player_id) == (100, 100)
+    assert write(bot.get_player, player_id)[4] == 100
@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import battle_forge_bot as bot
+from conftest import read, write
+
+
+@pytest.fixture(autouse=True)
+def steady_market(monkeypatch):
+    monkeypatch.setattr(bot, 'market_accepts', lambda conn, player_id: True)
+
+
+def bookkeeping(conn, player_id):
+    # -> ({role: head count in cohorts}, {(role, stat): histogram samples},
+    # living citizens from the counters, living citizens counted directly)
+    cohorts = dict(conn.execute('SELECT role, SUM(count) FROM citizen_cohorts WHERE player_id = ? GROUP BY role',
+                                (player_id,)).fetchall())
+    samples = {(role, stat): count for role, stat, count in conn.execute(
+        'SELECT role, stat, SUM(count) FROM citizen_stats WHERE player_id = ? GROUP BY role, stat', (player_id,))}
+    assert conn.execute('SELECT COUNT(*) FROM citizen_stats WHERE player_id = ? AND count < 0', (player_id,)).fetchone()[0] == 0
+    counted = conn.execute('SELECT citizens FROM player_population WHERE player_id = ?', (player_id,)).fetchone()[0]
+    return cohorts, samples, counted, bot.count_citizens(bot.get_population(conn, player_id))
+
+
+def assert_consistent(player_id):
+    cohorts, samples, counted, living = read(bookkeeping, player_id)
+    for role in bot.CITIZEN_ROLES:
+        for stat in ('health', 'attack', 'defense'):
+            assert samples.get((role, stat), 0) == cohorts.get(role, 0), (role, stat)
+    assert counted == living
+    return cohorts, living
+
+
+def test_starting_population(player_ids):
+    (player_id,) = player_ids()
+    write(bot.provision_player, player_id, 'p')
+    cohorts, living = assert_consistent(player_id)
+    assert sum(cohorts.values()) == living == bot.STARTING_CITIZENS
+
+
+def test_trading_a_citizen_by_role(player_ids):
+    seller, buyer = player_ids(2)
+    write(bot.provision_player, seller, 's')
+    write(bot.provision_player, buyer, 'b')
+    write(bot.add_coins, buyer, 100)
+    response = write(bot.trade_tx, seller, 's', 'citizen_healer', 1, 10, 'pop')
+    assert response.startswith('Trade created: 1 citizen_')
+    (trade_id, item), = read(lambda conn: conn.execute("SELECT trade_id, item FROM trades WHERE seller_id = ? AND status = 'open'",
+                                                       (seller,)).fetchall())
+    cohorts, living = assert_consistent(seller)
+    # Listed citizens leave the cohort but still belong to the seller
+    assert sum(cohorts.values()) == bot.STARTING_CITIZENS - 1 and living == bot.STARTING_CITIZENS
+    assert write(bot.accepttrade_tx, buyer, 'b', trade_id, 'pop').startswith('Trade accepted')
+    assert assert_consistent(seller)[1] == bot.STARTING_CITIZENS - 1
+    assert assert_consistent(buyer)[1] == bot.STARTING_CITIZENS + 1
+    citizen_id = int(item[len('citizen_'):])
+    assert read(lambda conn: conn.execute('SELECT player_id, role FROM citizens WHERE citizen_id = ?', (citizen_id,)).fetchone()) == (buyer, 'healer')
+
+
+def test_listing_by_role_needs_cohort_citizens(player_ids):
+    (player_id,) = player_ids()
+    write(bot.provision_player, player_id, 'p')
+
+    def materialize_scouts(conn):
+        while bot.materialize_citizen(conn, player_id, 'scout'):
+            pass
+
+    write(materialize_scouts)
+    assert write(bot.trade_tx, player_id, 'p', 'citizen_scout', 1, 10, 'pop').startswith('No active scout citizens')
+    assert write(bot.trade_tx, player_id, 'p', 'citizen_worker', 2, 10, 'pop') == "Citizens are listed one at a time: use a quantity of 1!"
+    assert read(lambda conn: conn.execute("SELECT COUNT(*) FROM trades WHERE seller_id = ?", (player_id,)).fetchone()[0]) == 0
+    assert_consistent(player_id)
+
+
+def test_war_casualties(player_ids):
+    attacker, defender = player_ids(2)
+    write(bot.provision_player, attacker, 'a')
+    write(bot.provision_player, defender, 'd')
+    fighters = read(lambda conn: bot.count_citizens(bot.get_population(conn, attacker), 'fighter', 'active'))
+    for _ in range(5):
+        write(bot.war_tx, attacker, defender, fighters // 10, 'pop')
+    for player_id in (attacker, defender):
+        cohorts, living = assert_consistent(player_id)
+        assert living == sum(cohorts.values()) < bot.STARTING_CITIZENS
+
+
+def test_merged_babies_grow_into_the_cohorts(player_ids):
+    (player_id,) = player_ids()
+    write(bot.provision_player, player_id, 'p')
+    write(bot.adjust_resources, player_id, sperms=300, eggs=300)
+    assert write(bot.merge_tx, player_id, 'p', 250, 300) == "Merged 250 sperms and eggs to create babies!"
+    grown_up = (datetime.now() - timedelta(days=30)).isoformat()
+    write(lambda conn: conn.execute('UPDATE babies SET is_born = 1, born_at = ? WHERE player_id = ?', (grown_up, player_id)))
+    write(bot.grow_babies, player_id)
+    cohorts, living = assert_consistent(player_id)
+    assert living == sum(cohorts.values()) == bot.STARTING_CITIZENS + 250
+    assert read(bot.count_population, player_id) == living